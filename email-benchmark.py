@@ -0,0 +1,357 @@
+import sys
+import os
+import re
+import time
+import random
+import threading
+import socketserver
+import importlib.util
+import tempfile
+import io
+import contextlib
+
+#Load rubric-grading.py as a module (its name has a dash in it)
+spec = importlib.util.spec_from_file_location('rubric_grading',\
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rubric-grading.py'))
+rubric_grading = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rubric_grading)
+
+#Common stuff for the stand-in servers
+#latency is seconds to wait before every response, and failure_rate is the
+#chance that a message is refused with a temporary error
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, handler, latency = 0, failure_rate = 0, host = '127.0.0.1',\
+            port = 0):
+        super().__init__((host, port), handler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.thread = None
+
+    #Get the server as "host:port", as EmailManager takes it
+    def get_address(self):
+        return "%s:%d"%self.server_address
+
+    #Start serving in the background
+    def start(self):
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    #Stop serving
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def should_fail(self):
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    def send_line(self, line):
+        self.wfile.write(line.encode('utf-8') + b'\r\n')
+
+    def wait(self):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+#Handler speaking enough SMTP for smtplib's login and send_message
+class StandInSMTPHandler(StandInHandler):
+    def reply(self, line):
+        self.wait()
+        self.send_line(line)
+
+    def handle(self):
+        self.reply("220 localhost stand-in SMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            words = line.decode('utf-8', 'replace').strip().split(' ', 1)
+            command = words[0].upper()
+            if command in ['EHLO', 'HELO']:
+                self.send_line("250-localhost")
+                self.send_line("250-8BITMIME")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif command == 'AUTH':
+                mechanism = words[1].split()[0].upper() if len(words) > 1 else ''
+                if mechanism == 'LOGIN':
+                    #Username, then password
+                    for prompt in ["VXNlcm5hbWU6", "UGFzc3dvcmQ6"]:
+                        self.reply("334 %s"%prompt)
+                        self.rfile.readline()
+                elif len(words[1].split()) < 2:
+                    self.reply("334 ")
+                    self.rfile.readline()
+                self.reply("235 2.7.0 Authentication successful")
+            elif command == 'MAIL':
+                self.recipients = []
+                self.reply("250 2.1.0 Ok")
+            elif command == 'RCPT':
+                self.recipients.append(words[1])
+                self.reply("250 2.1.5 Ok")
+            elif command == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b'.\r\n':
+                        break
+                    size += len(data_line)
+                if self.server.should_fail():
+                    self.reply("451 4.3.0 Temporary failure (stand-in)")
+                else:
+                    with self.server.lock:
+                        self.server.messages += 1
+                        self.server.bytes += size
+                    self.reply("250 2.0.0 Ok: queued")
+            elif command in ['RSET', 'NOOP']:
+                self.reply("250 2.0.0 Ok")
+            elif command == 'QUIT':
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("502 5.5.2 Command not recognized")
+
+#Stand-in SMTP server, counting the messages it accepts
+class StandInSMTPServer(StandInServer):
+    def __init__(self, **kwargs):
+        super().__init__(StandInSMTPHandler, **kwargs)
+        self.messages = 0
+        self.bytes = 0
+
+#Handler speaking enough IMAP for imaplib's login, select, append, search,
+#store and logout
+class StandInIMAPHandler(StandInHandler):
+    #Quoted strings, parenthesized lists, literals and atoms
+    token_re = re.compile(r'"((?:[^"\\]|\\.)*)"|\(([^)]*)\)|\{(\d+)\}$|(\S+)')
+
+    def tagged(self, tag, line):
+        self.wait()
+        self.send_line("%s %s"%(tag, line))
+
+    def get_args(self, rest):
+        args = []
+        for match in StandInIMAPHandler.token_re.finditer(rest):
+            if match.group(1) is not None:
+                args.append(re.sub(r'\\(.)', r'\1', match.group(1)))
+            elif match.group(2) is not None:
+                args.append(match.group(2).split())
+            elif match.group(3) is not None:
+                #Literal; the client sends it once we say to go ahead
+                self.send_line("+ Ready for literal data")
+                literal = self.rfile.read(int(match.group(3)))
+                args.append(literal)
+                args += self.get_args(self.rfile.readline().decode('utf-8',\
+                    'replace').strip())
+            else:
+                args.append(match.group(4))
+        return args
+
+    #Turn a sequence set like 1:3,5 or 2:* into numbers
+    def get_numbers(self, sequence, highest):
+        numbers = []
+        for piece in sequence.split(','):
+            ends = [highest if end == '*' else int(end) for end in piece.split(':')]
+            numbers += range(min(ends), max(ends) + 1)
+        return numbers
+
+    def handle(self):
+        server = self.server
+        folder = None
+        self.send_line("* OK [CAPABILITY IMAP4rev1 UIDPLUS] stand-in IMAP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            pieces = line.decode('utf-8', 'replace').strip().split(' ', 2)
+            if len(pieces) < 2:
+                self.send_line("* BAD Missing command")
+                continue
+            tag = pieces[0]
+            command = pieces[1].upper()
+            args = self.get_args(pieces[2] if len(pieces) > 2 else '')
+            use_uids = command == 'UID'
+            if use_uids:
+                command = args[0].upper()
+                args = args[1:]
+            if command == 'CAPABILITY':
+                self.send_line("* CAPABILITY IMAP4rev1 UIDPLUS")
+                self.tagged(tag, "OK CAPABILITY completed")
+            elif command == 'LOGIN':
+                self.tagged(tag, "OK LOGIN completed")
+            elif command in ['SELECT', 'EXAMINE']:
+                if args[0] not in server.folders:
+                    self.tagged(tag, "NO No such mailbox")
+                    continue
+                folder = args[0]
+                with server.lock:
+                    count = len(server.folders[folder])
+                self.send_line("* %d EXISTS"%count)
+                self.send_line("* 0 RECENT")
+                self.send_line("* OK [UIDVALIDITY 1] UIDs valid")
+                self.tagged(tag, "OK [READ-WRITE] SELECT completed")
+            elif command == 'APPEND':
+                if args[0] not in server.folders:
+                    self.tagged(tag, "NO [TRYCREATE] No such mailbox")
+                    continue
+                flags = args[1] if isinstance(args[1], list) else []
+                with server.lock:
+                    server.next_uid += 1
+                    uid = server.next_uid
+                    server.folders[args[0]].append([uid, set(flags), args[-1]])
+                self.tagged(tag, "OK [APPENDUID 1 %d] APPEND completed"%uid)
+            elif command == 'SEARCH' and folder is not None:
+                criteria = [str(arg).upper() for arg in args]
+                found = []
+                with server.lock:
+                    for number, message in enumerate(server.folders[folder], 1):
+                        seen = '\\Seen' in message[1]
+                        if ('SEEN' in criteria and not seen) or\
+                                ('UNSEEN' in criteria and seen):
+                            continue
+                        found.append(str(message[0] if use_uids else number))
+                self.send_line("* SEARCH %s"%' '.join(found))
+                self.tagged(tag, "OK SEARCH completed")
+            elif command == 'STORE' and folder is not None:
+                with server.lock:
+                    messages = server.folders[folder]
+                    if use_uids:
+                        by_uid = dict([(m[0], (n, m)) for n, m in enumerate(messages, 1)])
+                        numbers = [by_uid[uid][0] for uid in self.get_numbers(args[0],\
+                            max(by_uid) if by_uid else 0) if uid in by_uid]
+                    else:
+                        numbers = [n for n in self.get_numbers(args[0], len(messages))\
+                            if 1 <= n <= len(messages)]
+                    for number in numbers:
+                        flags = messages[number - 1][1]
+                        if args[1].upper().startswith('+'):
+                            flags.update(args[2])
+                        elif args[1].upper().startswith('-'):
+                            flags.difference_update(args[2])
+                        else:
+                            flags.clear()
+                            flags.update(args[2])
+                        self.send_line("* %d FETCH (FLAGS (%s))"%(number, ' '.join(flags)))
+                self.tagged(tag, "OK STORE completed")
+            elif command in ['NOOP', 'CHECK', 'CLOSE']:
+                self.tagged(tag, "OK %s completed"%command)
+            elif command == 'LOGOUT':
+                self.send_line("* BYE stand-in IMAP logging out")
+                self.tagged(tag, "OK LOGOUT completed")
+                return
+            else:
+                self.tagged(tag, "BAD Command not recognized")
+
+#Stand-in IMAP server, keeping messages in memory
+#folders are the names of the folders it has
+class StandInIMAPServer(StandInServer):
+    def __init__(self, folders = ["Sent"], **kwargs):
+        super().__init__(StandInIMAPHandler, **kwargs)
+        self.folders = dict([(folder, []) for folder in folders])
+        self.next_uid = 0
+
+#Send messages through the stand-in servers, one at a time with
+#send_message, or all at once with a BackgroundSender like send_batch
+#Returns how many messages per second went through
+def benchmark(messages, attachment_size, latency, failure_rate, batch, verbose):
+    smtp = StandInSMTPServer(latency = latency, failure_rate = failure_rate).start()
+    imap = StandInIMAPServer(latency = latency).start()
+    tmp_dir = tempfile.TemporaryDirectory()
+    try:
+        manager = rubric_grading.EmailManager.from_settings("Bench Mark",\
+            "bench@localhost", "password", imap.get_address(), "None",\
+            smtp.get_address(), "None", verbose = verbose)
+        #Don't let the rate limit or retry backoff hide how fast it is
+        manager.messages_per_minute = float('inf')
+        rubric_grading.EMAIL_SEND_BACKOFF = 0.01
+        pdf_prefix = os.path.join(tmp_dir.name, "bench")
+        students = []
+        for i in range(messages):
+            student = rubric_grading.Student("Student", "Number%d"%i,\
+                "student%d@localhost"%i)
+            with open(rubric_grading.make_pdf_name(pdf_prefix, student), 'wb') as fd:
+                fd.write(os.urandom(attachment_size))
+            students.append(student)
+        template = rubric_grading.EmailTemplate(message = "Your rubric is attached.",\
+            closing = "Bench", subject = "Benchmark", my_email = manager.get_email(),\
+            my_name = manager.get_name(), pdf_prefix = pdf_prefix)
+        email_msgs = [template.render(student) for student in students]
+        #Only time the sending, not the printing
+        quiet = io.StringIO() if not verbose else sys.stdout
+        start = time.monotonic()
+        failed = 0
+        with contextlib.redirect_stdout(quiet):
+            manager.login()
+            if batch:
+                sender = rubric_grading.BackgroundSender(manager, report = verbose)
+                for email_msg in email_msgs:
+                    sender.submit(email_msg)
+                failed = len(sender.finish())
+            else:
+                for email_msg in email_msgs:
+                    try:
+                        manager.send_message(email_msg)
+                    except rubric_grading.smtplib.SMTPException:
+                        failed += 1
+            manager.logout()
+        elapsed = time.monotonic() - start
+        print("Sent %d of %d messages (%d copied to Sent) in %.2f seconds"%\
+            (smtp.messages, messages, len(imap.folders["Sent"]), elapsed))
+        if failed > 0:
+            print("%d messages failed"%failed)
+        return smtp.messages/elapsed
+    finally:
+        smtp.stop()
+        imap.stop()
+        tmp_dir.cleanup()
+
+if __name__ == '__main__':
+    #-m followed by how many messages to send (default 200)
+    #-a followed by attachment size in KiB (default 100)
+    #-l followed by server latency in milliseconds (default 0)
+    #-f followed by the chance of a temporary SMTP failure (default 0)
+    #-b to send with send_batch instead of one at a time
+    #-v (verbose)
+    messages = 200
+    attachment_size = 100
+    latency = 0
+    failure_rate = 0
+    batch = False
+    verbose = False
+    usage_str = 'usage: python3 email-benchmark.py [-m messages] [-a attachment KiB] '\
+        '[-l latency ms] [-f failure rate] [-b] [-v]\n'
+    flag = None
+    try:
+        for arg in sys.argv[1:]:
+            if arg[0] == '-' and flag is None:
+                if arg == '-b':
+                    batch = True
+                elif arg == '-v':
+                    verbose = True
+                elif arg in ['-m', '-a', '-l', '-f']:
+                    flag = arg
+                else:
+                    raise ValueError(arg)
+            else:
+                if flag == '-m':
+                    messages = int(arg)
+                elif flag == '-a':
+                    attachment_size = int(arg)
+                elif flag == '-l':
+                    latency = float(arg)
+                elif flag == '-f':
+                    failure_rate = float(arg)
+                else:
+                    raise ValueError(arg)
+                flag = None
+    except ValueError as err:
+        print('Unexpected argument: %s'%str(err))
+        print(usage_str)
+        sys.exit(0)
+    rubric_grading.verbose = verbose
+    rate = benchmark(messages, attachment_size*1024, latency/1000, failure_rate,\
+        batch, verbose)
+    print("%.1f messages per second"%rate)
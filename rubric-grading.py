@@ -5,13 +5,41 @@ import readline
 import collections.abc
 import subprocess
 import webbrowser
+import atexit
 
 import email.message
+import email.policy
+import email.utils
+import html
 import imaplib
 import smtplib
 import time
 import getpass
+import threading
+import queue
+import concurrent.futures
 import mimetypes
+import mailbox
+import shlex
+import mmap
+import socket
+import hashlib
+import functools
+import bisect
+import ast
+import heapq
+import operator
+
+import gzip
+import lzma
+import warnings
+import gc
+
+#Statistics need NumPy, but nothing else does
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #Facilitate grading stuff with a rubric for lots of students
 #Input 1: class list, with email addresses and optional groups
@@ -26,6 +54,7 @@ import mimetypes
 #Converts text files to .tex files
 #Compiles .tex files into pdf
 #Export grades to .csv, alphabetized
+#Combine the grades from several assignments into one gradebook .csv
 #Ability to change name of "TOTAL"
 #Import comments from other students
 #Interface for subject line of email
@@ -43,13 +72,30 @@ RUBRIC_COMMENT = '#'
 RUBRIC_FRONT_MATTER = '&'
 RUBRIC_CATEGORY = '!'
 RUBRIC_POINT_SEP = '~'
+RUBRIC_FORMULA = '='
 
 SAVE_VERSION_HEADER = 'V1\u1004'
+SAVE_VERSION_HEADER_V2 = 'V2\u1004'
 
 ROSTER_SAVE_SYMBOL = '\u1000'
 RUBRIC_SAVE_SEPARATOR = '\u1001'
 RUBRIC_FRONT_MATTER_SAVE_INDICATOR = '\u1002'
 RUBRIC_ATTACHMENT_INDICATOR = '\u1003'
+SAVE_COMMENT_TABLE_INDICATOR = '\u1005'
+
+#Compression for save files
+SAVE_COMPRESSION_GZIP = 'gzip'
+SAVE_COMPRESSION_LZMA = 'lzma'
+SAVE_COMPRESSION_EXTENSIONS = {
+    '.gz':SAVE_COMPRESSION_GZIP,
+    '.xz':SAVE_COMPRESSION_LZMA,
+    '.lzma':SAVE_COMPRESSION_LZMA
+}
+SAVE_LOCK_EXTENSION = '.lock'
+SNAPSHOT_DIRECTORY_EXTENSION = '.snapshots'
+
+GZIP_MAGIC = b'\x1f\x8b'
+LZMA_MAGIC = b'\xfd7zXZ\x00'
 
 ROSTER_SAVE_SYMBOL_OLD = '?'
 RUBRIC_SAVE_SEPARATOR_OLD = ':'
@@ -81,10 +127,90 @@ def get_rubric_attachment_indicator(old = False):
     else:
         return RUBRIC_ATTACHMENT_INDICATOR
 
+#Figure out how to compress a save file based on its extension
+def get_save_compression(file):
+    for extension in SAVE_COMPRESSION_EXTENSIONS:
+        if file.endswith(extension):
+            return SAVE_COMPRESSION_EXTENSIONS[extension]
+    return None
+
+#Open a save file for reading or writing text
+#When reading, compression is detected from the first few bytes of the file
+#When writing, compression of None means uncompressed
+def open_save_file(file, mode = 'r', compression = None):
+    if mode == 'r':
+        with open(file, 'rb') as bfd:
+            magic = bfd.read(len(LZMA_MAGIC))
+        if magic.startswith(GZIP_MAGIC):
+            compression = SAVE_COMPRESSION_GZIP
+        elif magic.startswith(LZMA_MAGIC):
+            compression = SAVE_COMPRESSION_LZMA
+        else:
+            compression = None
+    if compression == SAVE_COMPRESSION_GZIP:
+        return gzip.open(file, mode + 't', encoding = 'utf-8')
+    elif compression == SAVE_COMPRESSION_LZMA:
+        return lzma.open(file, mode + 't', encoding = 'utf-8')
+    else:
+        return open(file, mode)
+
 EMAIL_CONFIG_COMMENT = '#'
 
+#Gradebook files list one assignment per line (see Gradebook)
+GRADEBOOK_COMMENT = '#'
+GRADEBOOK_NBSP = '~'
+
+OUTBOX_EXTENSION = '.outbox'
+
+#How many emails to render ahead of the one being reviewed
+EMAIL_PREFETCH = 5
+
+#Attachments this big or bigger are memory-mapped instead of read
+ATTACHMENT_MMAP_THRESHOLD = 1 << 20
+#Most bytes of attachments to keep encoded in memory
+ATTACHMENT_CACHE_MAX_BYTES = 256 << 20
+
+#How many times to retry sending an email after a temporary failure,
+#and how long to wait before the first retry (doubling each time)
+EMAIL_SEND_RETRIES = 5
+EMAIL_SEND_BACKOFF = 2
+
+#Command to hand emails to a local mail transfer agent, and how many
+#copies of it to run at once
+SENDMAIL_COMMAND = '/usr/sbin/sendmail -t -oi'
+SENDMAIL_BATCH = 10
+
 TEX_FONT_SIZE = 12
 
+EDIT_HISTORY_MAX_STEPS = 1000
+
+#How many comments given before to offer while grading
+COMMENT_SUGGESTIONS = 5
+
+#Entering several grades and comments on one line (see parse_quick_entry)
+QUICK_ENTRY_HELP = """Quick entry:
+  3 8.5 "missing header"    Scores for the next ungraded items, in order; a
+                            quoted comment goes with the score before it
+  Style=9 Quality=4 :"nice" Scores by name (or path, like SOFTWARE/Style);
+                            :comment (or :"a comment") goes with the one before
+  Style:"tabs and spaces"   Just a comment
+  _                         Leave the next item as it is
+Names with spaces need quotes, like "Enough work"=8"""
+
+#Searches over grades (see Query)
+QUERY_COMPARISONS = ['<', '<=', '>', '>=', '=', '==', '!=']
+QUERY_HELP = """Searches:
+  done, started                 Everything graded, or anything at all
+  graded FIELD, ungraded FIELD  Whether a score (or front matter) is filled in
+  missing FIELD                 Same as ungraded
+  FIELD < 50%, FIELD >= 8       Compare a score (points, or percent of the field)
+  FIELD has TEXT                Comment (or front matter) contains TEXT
+  FIELD = TEXT, FIELD != TEXT   Front matter is exactly TEXT
+  name has TEXT                 Student's name contains TEXT
+Combine with and, or, not and parentheses
+FIELD is a category, item (like SOFTWARE/Style), TOTAL or front matter, with
+"quotes" around anything with spaces"""
+
 if 'libedit' in readline.__doc__:
     readline.parse_and_bind("bind ^I rl_complete")
     libedit = True
@@ -238,13 +364,33 @@ def is_number(strg):
             return False
     return True
 
+#Format a score or an out-of, which formulas can make fractional
+def score_to_string(score):
+    if isinstance(score, int):
+        return "%d"%score
+    else:
+        return "%.2f"%score
+
+#Use "with PausedGC():" to keep the garbage collector from running while
+#building an index over everyone's rubrics, which makes lots of objects but
+#no garbage
+class PausedGC:
+    def __enter__(self):
+        self.was_enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *args):
+        if self.was_enabled:
+            gc.enable()
+
 #Print an email message
 def print_email(email_msg):
     print()
     for header in email_msg.items():
         print("%s: %s"%(header[0], header[1]))
     print()
-    print(email_msg.get_body())
+    #Show the plain text, not an HTML version
+    print(email_msg.get_body(preferencelist = ('plain',)).get_content())
     print()
     for att in email_msg.iter_attachments():
         print("Attachment [type=%s, filename=%s]"%(att.get_content_type(),\
@@ -322,6 +468,12 @@ def make_tex_name(prefix, student):
 def make_pdf_name(prefix, student):
     return make_file_name(prefix, student, 'pdf')
 
+#Join names like "A", "A and B", or "A, B and C"
+def join_names(names):
+    if len(names) <= 1:
+        return ''.join(names)
+    return "%s and %s"%(', '.join(names[:-1]), names[-1])
+
 #Helpers for splittable
 def in_char_range(char, a, b):
     return ord(char) >= ord(a) and ord(char) <= ord(b)
@@ -341,11 +493,136 @@ def make_tex_word(strg):
             ret.append('{\\allowbreak}')
     return ''.join(ret)
 
+#Class for caching email attachments, already MIME-encoded
+#Files are keyed on path, modification time and size, so an edited file
+#is read again; everything else is read and base64-encoded once per session
+class AttachmentCache:
+    cache = None
+    @staticmethod
+    def get_attachment_cache():
+        if AttachmentCache.cache is None:
+            AttachmentCache.cache = AttachmentCache()
+        return AttachmentCache.cache
+
+    def __init__(self, max_bytes = ATTACHMENT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        #Least recently used first
+        self.parts = collections.OrderedDict()
+        #Hashes of files' contents, with the same keys
+        self.digests = dict()
+        #Rendering can happen on more than one thread
+        self.lock = threading.Lock()
+
+    #Get a MIME part attaching a file
+    #The same part is shared by every message, so don't modify it
+    def get_part(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if key in self.parts:
+                self.parts.move_to_end(key)
+                return self.parts[key]
+        part = AttachmentCache.make_part(path, stat.st_size)
+        with self.lock:
+            if key not in self.parts:
+                self.parts[key] = part
+                self.total_bytes += stat.st_size
+                #Forget the least recently used, but always keep the newest
+                while self.total_bytes > self.max_bytes and len(self.parts) > 1:
+                    old_key, old_part = self.parts.popitem(last = False)
+                    self.total_bytes -= old_key[2]
+            return self.parts[key]
+
+    #Get a hash of a file's contents, to tell if an attachment has changed
+    def get_digest(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if key in self.digests:
+                return self.digests[key]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1 << 20), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.digests[key] = digest.hexdigest()
+            return self.digests[key]
+
+    #Read and encode a file as a MIME attachment part
+    @staticmethod
+    def make_part(path, size):
+        file_name = path[path.rfind(os.sep)+1:]
+        ctype, encoding = mimetypes.guess_type(path)
+        if ctype is None or encoding is not None:
+            # No guess could be made, or the file is encoded (compressed), so
+            # use a generic bag-of-bits type.
+            ctype = 'application/octet-stream'
+        maintype, subtype = ctype.split('/', 1)
+        part = email.message.EmailMessage()
+        with open(path, 'rb') as att:
+            if size < ATTACHMENT_MMAP_THRESHOLD:
+                part.set_content(att.read(), maintype=maintype, subtype=subtype,\
+                    filename=file_name)
+            else:
+                #Encode straight from the page cache instead of copying it all first
+                with mmap.mmap(att.fileno(), 0, access=mmap.ACCESS_READ) as att_map:
+                    att_view = memoryview(att_map)
+                    try:
+                        part.set_content(att_view, maintype=maintype, subtype=subtype,\
+                            filename=file_name)
+                    finally:
+                        att_view.release()
+        return part
+
+#Class for a mail-merge template, parsed once and then filled in for each email
+#Fields go in braces: {first}, {last} and {name} of who it's to, {total} and
+#{max} for the whole rubric, the name of any front matter or category for its
+#value or score, max:<category> for what the category is out of, and
+#comment:<category> for its comment
+#{{ and }} are literal braces
+class MailMerge:
+    ENTITY_FIELDS = ['first', 'last', 'name']
+    #known_fields are the fields that can be used; anything else is an error
+    def __init__(self, text, known_fields):
+        known_fields = set(known_fields)
+        fmt = []
+        keys = []
+        pos = 0
+        for match in re.finditer(r'\{\{|\}\}|\{([^{}]*)\}|[{}]', text):
+            fmt.append(text[pos:match.start()].replace('%', '%%'))
+            pos = match.end()
+            piece = match.group(0)
+            if piece in ['{{', '}}']:
+                fmt.append(piece[0])
+            elif match.group(1) is None:
+                raise ValueError("Unmatched %s in email template"%piece)
+            else:
+                key = match.group(1).strip()
+                if key not in known_fields:
+                    raise ValueError("Unknown field in email template: {%s}"%key)
+                fmt.append('%s')
+                keys.append(key)
+        fmt.append(text[pos:].replace('%', '%%'))
+        self.format = ''.join(fmt)
+        self.keys = keys
+        #Look up all the fields in one go
+        if len(keys) == 0:
+            self.getter = lambda fields: ()
+        elif len(keys) == 1:
+            self.getter = lambda fields: (fields[keys[0]],)
+        else:
+            self.getter = operator.itemgetter(*keys)
+
+    #Fill in the fields, from a dict like Rubric.get_merge_fields
+    def render(self, fields):
+        return self.format%self.getter(fields)
+
 #Class representing an email template
 class EmailTemplate:
     def __init__(self, message = None, closing = None, subject = None,\
             my_email = None, my_name = None, greeting = "Dear %s,",
-            pdf_prefix = "", attachments = []):
+            pdf_prefix = "", attachments = [], inline = False):
         self.message = message
         self.closing = closing
         self.greeting = greeting
@@ -354,56 +631,227 @@ class EmailTemplate:
         self.from_email = my_email
         self.from_name = my_name
         self.attachments = []
-
-    #Prepare an email to the given student
-    def render(self, student, message = None, attachments = []):
+        #Whether rubrics go in the body instead of as PDFs
+        self.inline = inline
+        #Fields mail-merge bodies can use, or None not to mail-merge
+        self.merge_fields = None
+        self.merges = dict()
+
+    #Allow mail-merge fields in the body; see MailMerge
+    def set_merge_fields(self, known_fields):
+        self.merge_fields = set(known_fields)
+        self.merges = dict()
+
+    #Get a body compiled into a MailMerge, compiling it only the first time
+    #Raises ValueError if it uses a field that doesn't exist
+    def get_merge(self, message):
+        if message not in self.merges:
+            self.merges[message] = MailMerge(message, self.merge_fields)
+        return self.merges[message]
+
+    #Get the Message-ID of the email to the given student or group
+    #content is a hash of its body and attachments, so it's the same every
+    #time for the same email, and a mailing that's run again can tell what
+    #was already sent, but an edited email gets a new one
+    def get_message_id(self, entity, content = ''):
+        if isinstance(entity, FrozenGroup):
+            to = ','.join([str(s.email) for s in entity])
+        else:
+            to = entity.email
+        key = "%s\n%s\n%s\n%s"%(self.pdf_prefix, self.subject, to, content)
+        if self.inline:
+            key += "\ninline"
+        domain = str(self.from_email)
+        domain = domain[domain.rfind('@')+1:]
+        if domain == '':
+            domain = 'localhost'
+        return "<%s@%s>"%(hashlib.sha1(key.encode('utf-8')).hexdigest(), domain)
+
+    #Prepare an email to the given student, or to everyone in the given group
+    #pdf_students are the students whose PDF rubrics get attached
+    #(by default, everyone it's to)
+    #fields are the values of mail-merge fields for it, if mail-merging
+    #If the template is inline, rubrics is a list of (student, rubric, group)
+    #to put in the body as text and HTML tables, and no PDFs are attached
+    def render(self, entity, message = None, attachments = [], pdf_students = None,\
+            fields = None, rubrics = []):
         body = message
         if body is None:
             body = self.message
+        if self.merge_fields is not None and fields is not None:
+            body = self.get_merge(body).render(fields)
+        if isinstance(entity, FrozenGroup):
+            students = [s for s in entity if s.has_email()]
+        else:
+            students = [entity]
+        if self.inline:
+            pdf_students = []
+        elif pdf_students is None:
+            pdf_students = students
         # the_directory = dirc
         # if the_directory[-1] != os.sep:
         #     the_directory += os.sep
         email_msg = email.message.EmailMessage()
         if "%s" in self.greeting:
-            greeting = self.greeting%student.fname
+            greeting = self.greeting%join_names([s.fname for s in students])
         else:
             greeting = self.greeting
-        email_msg.set_content("%s\n\n\t%s\n\n%s"%(greeting, body, self.closing))
+        text = "%s\n\n\t%s\n\n%s"%(greeting, body, self.closing)
+        #Everything that goes into the Message-ID
+        content = hashlib.sha1()
+        if self.inline:
+            text = '\n\n'.join([text] + [rubric.get_text(student, group)\
+                for student, rubric, group in rubrics])
+            html_text = "<html><body>\n%s\n%s</body></html>\n"%(\
+                '<p>%s</p>'%html.escape(text).replace('\t', '&emsp;').replace('\n', '<br>\n'),\
+                '\n'.join([rubric.get_html(student, group)\
+                for student, rubric, group in rubrics]))
+            email_msg.set_content(text)
+            email_msg.add_alternative(html_text, subtype = 'html')
+            content.update(html_text.encode('utf-8'))
+        else:
+            email_msg.set_content(text)
+        content.update(text.encode('utf-8'))
         email_msg['Subject'] = self.subject
         email_msg['From'] = "%s <%s>"%(self.from_name, self.from_email)
-        email_msg['To'] = "%s %s <%s>"%(student.fname, student.lname, student.email)
-        #Attach the PDF rubric
-        pdf_name = make_pdf_name(self.pdf_prefix, student)
-        file_name = pdf_name[pdf_name.rfind(os.sep)+1:]
-        with open(pdf_name, 'rb') as att:
-            att_data = att.read()
-        ctype, encoding = mimetypes.guess_type(pdf_name)
-        if ctype is None or encoding is not None:
-            # No guess could be made, or the file is encoded (compressed), so
-            # use a generic bag-of-bits type.
-            ctype = 'application/octet-stream'
-        maintype, subtype = ctype.split('/', 1)
-        email_msg.add_attachment(att_data, maintype=maintype, subtype=subtype, filename=file_name)
-        #Attach any other attachments
+        email_msg['To'] = ', '.join(["%s %s <%s>"%(s.fname, s.lname, s.email)\
+            for s in students])
+        #Attachments are encoded once and shared between messages
+        attachment_cache = AttachmentCache.get_attachment_cache()
         atts = set(self.attachments)
         for att in attachments:
             atts.add(att)
+        if len(pdf_students) + len(atts) > 0:
+            email_msg.make_mixed()
+        #Attach the PDF rubrics
+        for student in pdf_students:
+            pdf_name = make_pdf_name(self.pdf_prefix, student)
+            email_msg.attach(attachment_cache.get_part(pdf_name))
+            content.update(attachment_cache.get_digest(pdf_name).encode('utf-8'))
+        #Attach any other attachments, hashed in a set order
         for attachment in atts:
-            file_name = attachment[attachment.rfind(os.sep)+1:]
-            with open(attachment, 'rb') as att:
-                att_data = att.read()
-            ctype, encoding = mimetypes.guess_type(attachment)
-            if ctype is None or encoding is not None:
-                # No guess could be made, or the file is encoded (compressed), so
-                # use a generic bag-of-bits type.
-                ctype = 'application/octet-stream'
-            maintype, subtype = ctype.split('/', 1)
-            email_msg.add_attachment(att_data, maintype=maintype, subtype=subtype, filename=file_name)
+            email_msg.attach(attachment_cache.get_part(attachment))
+        for digest in sorted([attachment_cache.get_digest(att) for att in atts]):
+            content.update(digest.encode('utf-8'))
+        email_msg['Message-ID'] = self.get_message_id(entity, content.hexdigest())
         return email_msg
 
 
+#Class for an on-disk outbox of rendered emails, so a mailing that is
+#interrupted can pick up where it left off without sending anything twice
+#Each message is a .eml file named after its Message-ID, and it moves
+#between the queued, sent and failed directories with atomic renames
+class Outbox:
+    QUEUED = 'queued'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATES = [QUEUED, SENT, FAILED]
+    def __init__(self, directory):
+        self.directory = directory
+        for state in Outbox.STATES:
+            os.makedirs(os.path.join(self.directory, state), exist_ok = True)
+
+    def get_file(self, state, message_id):
+        return os.path.join(self.directory, state,\
+            hashlib.sha1(message_id.encode('utf-8')).hexdigest() + '.eml')
+
+    #Which state is the message with this Message-ID in? None if not in the outbox
+    def get_state(self, message_id):
+        for state in Outbox.STATES:
+            if os.path.isfile(self.get_file(state, message_id)):
+                return state
+        return None
+
+    #Queue up a message to be sent
+    def add(self, email_msg):
+        #It may be a retry of one that failed, or sending one again
+        failed_fname = self.get_file(Outbox.FAILED, email_msg['Message-ID'])
+        sent_fname = self.get_file(Outbox.SENT, email_msg['Message-ID'])
+        for old_fname in [failed_fname, failed_fname + '.err', sent_fname]:
+            if os.path.isfile(old_fname):
+                os.remove(old_fname)
+        fname = self.get_file(Outbox.QUEUED, email_msg['Message-ID'])
+        tmp_fname = "%s.%d.tmp"%(fname, os.getpid())
+        with open(tmp_fname, 'wb') as fd:
+            fd.write(bytes(email_msg))
+        os.replace(tmp_fname, fname)
+
+    #Move a message from one state to another
+    def move(self, email_msg, from_state, to_state):
+        message_id = email_msg['Message-ID']
+        os.replace(self.get_file(from_state, message_id),\
+            self.get_file(to_state, message_id))
+
+    #Record that the SMTP server accepted a message
+    def mark_sent(self, email_msg):
+        self.move(email_msg, Outbox.QUEUED, Outbox.SENT)
+
+    #Record that a message couldn't be sent
+    def mark_failed(self, email_msg, err):
+        self.move(email_msg, Outbox.QUEUED, Outbox.FAILED)
+        with open(self.get_file(Outbox.FAILED, email_msg['Message-ID']) + '.err', 'w') as fd:
+            fd.write("%s\n"%str(err))
+
+    #Why did a failed message fail?
+    def get_error(self, email_msg):
+        try:
+            with open(self.get_file(Outbox.FAILED, email_msg['Message-ID']) + '.err',\
+                    'r') as fd:
+                return fd.read().strip()
+        except FileNotFoundError:
+            return None
+
+    #Put all failed messages back in the queue
+    def requeue_failed(self):
+        for email_msg in self.get_messages(Outbox.FAILED):
+            err_fname = self.get_file(Outbox.FAILED, email_msg['Message-ID']) + '.err'
+            self.move(email_msg, Outbox.FAILED, Outbox.QUEUED)
+            if os.path.isfile(err_fname):
+                os.remove(err_fname)
+
+    #Throw away a queued message
+    def discard(self, email_msg):
+        os.remove(self.get_file(Outbox.QUEUED, email_msg['Message-ID']))
+
+    #Throw away everything still queued
+    def discard_queued(self):
+        for email_msg in self.get_messages(Outbox.QUEUED):
+            self.discard(email_msg)
+
+    #Forget what was sent, so sending it again doesn't ask first
+    def clear_sent(self):
+        state_dir = os.path.join(self.directory, Outbox.SENT)
+        for fname in os.listdir(state_dir):
+            if fname.endswith('.eml'):
+                os.remove(os.path.join(state_dir, fname))
+
+    #Get all the messages in a state
+    def get_messages(self, state):
+        ret = []
+        state_dir = os.path.join(self.directory, state)
+        for fname in sorted(os.listdir(state_dir)):
+            if fname.endswith('.eml'):
+                with open(os.path.join(state_dir, fname), 'rb') as fd:
+                    ret.append(email.message_from_binary_file(fd,\
+                        policy = email.policy.default))
+        return ret
+
+    #Print what's queued, sent and failed
+    def print_status(self):
+        for state in Outbox.STATES:
+            email_msgs = self.get_messages(state)
+            print("%s: %d"%(state.capitalize(), len(email_msgs)))
+            for email_msg in email_msgs:
+                if state == Outbox.FAILED:
+                    print("\t%s (%s)"%(email_msg['To'], self.get_error(email_msg)))
+                else:
+                    print("\t%s"%email_msg['To'])
+        print()
+
 #Class representing all the graded entities in the class
 class Roster:
+    #The roster whose indexes are kept up to date with edits (see get_index)
+    notified = None
     #Constructor
     def __init__(self, from_file):
         #The set of all entities being graded (students or groups)
@@ -414,6 +862,15 @@ class Roster:
         self.using_groups = None
         #Rubrics
         self.rubrics = dict()
+        #Blank rubric everyone started with
+        self.blank_rubric = None
+        #Which group each student is in, if groups are used
+        self.groups_by_student = dict()
+        #Indexes of everyone's grades, by class, each built when first needed:
+        #ScoreMatrix for statistics, GradeIndex for searches, CommentIndex for
+        #the words in comments, CommentBank for suggesting comments, and
+        #GradingQueue for what's left to grade
+        self.indexes = dict()
         #File for saving
         self.file = None
         #Open the file
@@ -478,7 +935,10 @@ class Roster:
         #If groups are in use, freeze them
         if self.using_groups:
             for group in groups.values():
-                self.graded_entities.add(FrozenGroup(group))
+                frozen_group = FrozenGroup(group)
+                self.graded_entities.add(frozen_group)
+                for student in frozen_group:
+                    self.groups_by_student[student] = frozen_group
 
     def __str__(self):
         ret = ""
@@ -499,6 +959,8 @@ class Roster:
 
     #Initialize a blank rubric for every graded entity
     def initialize_blank_rubrics(self, rubric):
+        self.blank_rubric = rubric
+        self.deactivate_indexes()
         for entity in self.graded_entities:
             #Copy the rubric for the entity
             self.rubrics[entity] = Rubric(rubric)
@@ -511,16 +973,115 @@ class Roster:
 
     def get_rubric(self, entity):
         if isinstance(entity, Student) and self.using_groups:
-            for group in self.graded_entities:
-                if entity in group:
-                    return self.rubrics[group].customize(entity)
+            group = self.get_group(entity)
+            if group is not None:
+                return self.rubrics[group].customize(entity)
         else:
             return self.rubrics[entity]
 
     def get_group(self, student):
-        for group in self.graded_entities:
-            if student in group:
-                return group
+        return self.groups_by_student.get(student)
+
+    #Get the index of the given class (see RosterIndex), building it the
+    #first time; it's kept up to date with every edit from then on
+    def get_index(self, index_class):
+        if Roster.notified is not self:
+            #Only one roster's indexes hear about edits
+            if Roster.notified is not None:
+                Roster.notified.deactivate_indexes()
+            Roster.notified = self
+        if index_class not in self.indexes:
+            self.indexes[index_class] = index_class(self)
+        return self.indexes[index_class]
+
+    #Throw away the indexes (e.g. when rubrics are replaced), so they're
+    #built again when next needed
+    def deactivate_indexes(self):
+        self.indexes = dict()
+
+    #Pass an edit on to every index that's been built, by calling the given
+    #RosterIndex method on each
+    @staticmethod
+    def notify(method, *args):
+        if Roster.notified is not None:
+            for index in list(Roster.notified.indexes.values()):
+                getattr(index, method)(*args)
+
+    #Get the index of the given class that's keeping up with edits, or None
+    #if it hasn't been built
+    @staticmethod
+    def get_notified_index(index_class):
+        if Roster.notified is None:
+            return None
+        return Roster.notified.indexes.get(index_class)
+
+    #Get the set of students a Query matches
+    def select_students(self, query):
+        return query.select(self.get_index(GradeIndex))
+
+    #Get the graded entities a Query matches, in order
+    #A group matches if anyone in it does
+    def select_entities(self, query):
+        students = self.select_students(query)
+        return [entity for entity in self if Roster.entity_matches(entity, students)]
+
+    #Is a student (or anyone in a group) in a set of students?
+    @staticmethod
+    def entity_matches(entity, students):
+        if isinstance(entity, FrozenGroup):
+            return any([student in students for student in entity])
+        return entity in students
+
+    #Switch to a new version of the roster file
+    #New entities get blank rubrics and unchanged entities keep theirs
+    #Groups are matched by number; if a group's members changed, it keeps its
+    #grades, and its individualized categories follow each student
+    #Returns lists of the names of entities added, removed and regrouped
+    def resync(self, from_file):
+        global saved
+        new_roster = Roster(from_file)
+        if new_roster.using_groups != self.using_groups:
+            raise ValueError("Can't switch between using groups and not using groups")
+        def entity_key(entity):
+            if isinstance(entity, FrozenGroup):
+                return entity.number
+            else:
+                return str(entity)
+        old_entities = dict()
+        for entity in self.graded_entities:
+            old_entities[entity_key(entity)] = entity
+        #Individualized categories, so students who switch groups keep them
+        carried = dict()
+        if self.using_groups:
+            for group in self.graded_entities:
+                self.rubrics[group].total.get_individual_categories(carried)
+        added = []
+        regrouped = []
+        new_rubrics = dict()
+        for entity in new_roster.graded_entities:
+            key = entity_key(entity)
+            if key not in old_entities:
+                new_rubrics[entity] = Rubric(self.blank_rubric)
+                new_rubrics[entity].individualize(entity)
+                added.append(str(entity))
+            else:
+                new_rubrics[entity] = self.rubrics[old_entities[key]]
+                if str(entity) != str(old_entities[key]):
+                    new_rubrics[entity].regroup(entity, carried)
+                    regrouped.append(str(entity))
+                del old_entities[key]
+        removed = [str(entity) for entity in old_entities.values()]
+        self.graded_entities = new_roster.graded_entities
+        self.students = new_roster.students
+        self.groups_by_student = new_roster.groups_by_student
+        self.rubrics = new_rubrics
+        #Rows and individualized categories changed
+        self.deactivate_indexes()
+        if len(added) + len(removed) + len(regrouped) > 0:
+            #Edits to rubrics that are gone can't be undone
+            EditHistory.get_edit_history().clear()
+            saved = False
+        return sorted(added), sorted(removed), sorted(regrouped)
 
     #Get a student from the roster
     #If necessary, make it one whose grading is in progress or done
@@ -536,64 +1097,111 @@ class Roster:
                 ret.add(student)
         return ret
 
+    #Get the saved contents of every rubric, keyed by entity name
+    def get_records(self):
+        ret = dict()
+        for entity in self.graded_entities:
+            ret[str(entity)] = self.rubrics[entity].get_records()
+        return ret
+
+    #Put saved contents (keyed by entity name) into the rubrics
+    #Entities no longer in the roster are skipped
+    #If replace, anything not in the records is cleared
+    def set_records(self, records, replace = False):
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            for entity in self.graded_entities:
+                if str(entity) in records:
+                    self.rubrics[entity].set_records(records[str(entity)], replace)
+                elif replace:
+                    self.rubrics[entity].set_records(RubricRecords(), replace)
+        finally:
+            history.end_step()
+
+    #Copy one entity's scores and comments (and front matter, if front_matter)
+    #to other entities, all as one undo step
+    #The source is read once, and its records are shared by every target;
+    #each target only gets set where it's different
+    def clone_rubric(self, source, targets, front_matter = False):
+        records = self.rubrics[source].get_records()
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            for target in targets:
+                if target != source:
+                    self.rubrics[target].copy_records(records, front_matter)
+        finally:
+            history.end_step()
+
+    #Merge save files from several graders into these rubrics
+    #base_file is the save they all started from (None if they started blank)
+    #See merge_records for resolve
+    #Returns the list of conflicts
+    def merge_saves(self, base_file, grader_files, resolve = None):
+        if base_file is None:
+            base = dict()
+        else:
+            base = read_save_file(base_file)
+        others = [read_save_file(fil) for fil in grader_files]
+        merged, conflicts = merge_records(base, others, resolve)
+        self.set_records(merged, replace = True)
+        return conflicts
+
+    #Describe a field from merge_records or diff_records
+    def describe_field(self, field):
+        kind, key = field
+        if kind == 'frontmatter':
+            return 'front matter "%s"'%key
+        elif kind == 'attachment':
+            return 'attachment %s'%key
+        names = dict()
+        def action(item):
+            names[item.get_id()] = item.name
+        next(iter(self.rubrics.values())).total.traverse(action, ignore_blanks = False)
+        name = names.get(key[0], 'item %d'%key[0])
+        if key[1] is not None:
+            name += " [%s]"%key[1]
+        return '%s of %s'%(kind, name)
+
+    #Restore rubrics from a snapshot in a SnapshotStore
+    #If entity is given, only restore that one
+    def restore_snapshot(self, store, name, entity = None):
+        if entity is None:
+            self.set_records(store.load(name), replace = True)
+        else:
+            records = store.load(name, [str(entity)])
+            self.rubrics[entity].set_records(records.get(str(entity),\
+                RubricRecords()), replace = True)
+
     #Save all the rubrics
-    def save(self, file):
+    #compression of None means use the file extension to decide
+    def save(self, file, compression = None):
         global saved
+        if compression is None:
+            compression = get_save_compression(file)
+        records = self.get_records()
         try:
-            fd = open(file, 'w')
+            write_save_file(file, records, compression)
         except FileNotFoundError:
             print("Error: File %s not found"%file)
             return
+        for rubric in self.rubrics.values():
+            rubric.save()
+        #Keep history
         try:
-            #Write the header to indicate the version
-            fd.write("%s\n"%SAVE_VERSION_HEADER)
-            for entity in self.graded_entities:
-                fd.write("%s%s\n"%(ROSTER_SAVE_SYMBOL, str(entity)))
-                fd.write("%s\n"%self.rubrics[entity].export_rubric())
-        except:
-            fd.close()
-            raise
-        fd.close()
+            SnapshotStore(file).record(records)
+        except OSError as err:
+            print("Warning: Failed to record snapshot: %s"%str(err))
         print("Successfully saved in %s\n"%file[file.rfind(os.sep)+1:])
         saved = True
 
     #Load all the rubrics
     def load(self, file):
         global saved
-        old = False
-        fd = open(file, 'r')
-        cur_entity = None
-        buffer = ""
-        def flush_buffer():
-            nonlocal buffer
-            if buffer != "":
-                self.rubrics[cur_entity].import_rubric(buffer, old)
-                buffer = ""
-        try:
-            first_line = True
-            for line in fd:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-                if first_line:
-                    first_line = False
-                    if line != SAVE_VERSION_HEADER:
-                        old = True
-                    else:
-                        continue
-                if line[0] == get_roster_save_symbol(old):
-                    for entity in self.graded_entities:
-                        if str(entity) == line[1:]:
-                            flush_buffer()
-                            cur_entity = entity
-                            break
-                else:
-                    buffer += "%s\n"%line
-            flush_buffer()
-        except:
-            fd.close()
-            raise
-        fd.close()
+        self.set_records(read_save_file(file))
+        for rubric in self.rubrics.values():
+            rubric.save()
         print("%s loaded successfully\n"%file[file.rfind(os.sep)+1:])
         saved = True
 
@@ -617,12 +1225,16 @@ class Roster:
         print("CSV %s written successfully\n"%csv_filename[csv_filename.rfind(os.sep)+1:])
 
     #Export rubrics into PDFs (via .tex files)
-    def export_pdfs(self, pdf_prefix, only_finished = False, all = False, verbose = False):
+    #If students is given, exactly those students' rubrics are exported
+    def export_pdfs(self, pdf_prefix, only_finished = False, all = False, verbose = False,\
+            students = None):
         #tex_files = []
         for student in self.get_students():
+            if students is not None and student not in students:
+                continue
             rubric = self.get_rubric(student)
-            if all or rubric.is_filled() or (not only_finished and\
-                    rubric.is_in_progress()):
+            if students is not None or all or rubric.is_filled() or\
+                    (not only_finished and rubric.is_in_progress()):
                 #Include this one
                 fname = make_file_name(pdf_prefix, student)
                 if self.is_using_groups():
@@ -656,24 +1268,146 @@ class Roster:
             print()
         print("All .pdf files compiled successfully\n")
 
+    #Figure out who to email, skipping anyone without a PDF
+    #Returns a list of (student or group, students whose PDFs to attach,
+    #extra attachments, mail-merge fields, (student, rubric, group) for each
+    #of those students)
+    #If by_group, there's one email per group with every member's PDF, or just
+    #one PDF if every member's rubric came out the same
+    #If inline, no PDFs are needed, and anyone with nothing graded is skipped
+    def get_email_recipients(self, pdf_prefix, by_group = False, inline = False):
+        ret = []
+        rubrics = dict()
+        def has_pdf(student):
+            if inline:
+                rubrics[student] = self.get_rubric(student)
+                if rubrics[student].is_in_progress():
+                    return True
+                if verbose:
+                    print("Nothing graded for %s\nSkipping...\n"%str(student))
+                return False
+            fname = make_pdf_name(pdf_prefix, student)
+            if os.path.isfile(fname):
+                return True
+            if verbose:
+                print("File not found: %s\nSkipping...\n"%fname)
+            return False
+        def get_rubric(student):
+            if student not in rubrics:
+                rubrics[student] = self.get_rubric(student)
+            return rubrics[student]
+        def get_views(students):
+            return [(s, get_rubric(s), self.get_group(s) if self.is_using_groups() else\
+                None) for s in students]
+        def get_fields(rubric, students):
+            fields = rubric.get_merge_fields()
+            fields['first'] = join_names([s.fname for s in students])
+            fields['last'] = join_names([s.lname for s in students])
+            fields['name'] = join_names([str(s) for s in students])
+            return fields
+        if not by_group:
+            for student in self.get_students():
+                if has_pdf(student):
+                    rubric = get_rubric(student)
+                    ret.append((student, [student], rubric.get_attachments(),\
+                        get_fields(rubric, [student]), get_views([student])))
+            return ret
+        for group in self:
+            pdf_students = [s for s in group if has_pdf(s)]
+            if len(pdf_students) == 0 or not any([s.has_email() for s in group]):
+                continue
+            contents = [get_rubric(s).get_contents() for s in pdf_students]
+            if all([c == contents[0] for c in contents]):
+                pdf_students = pdf_students[:1]
+            rubric = self.rubrics[group]
+            ret.append((group, pdf_students, rubric.get_attachments(),\
+                get_fields(rubric, [s for s in group if s.has_email()]),\
+                get_views(pdf_students)))
+        return ret
+
     #Send emails to students
+    #If groups are in use, they can be sent one email per group
     def email_students(self, pdf_prefix, email_manager):
+        #Writing files doesn't send anything, so there's no outbox to keep
+        if email_manager.writes_files():
+            outbox = None
+        else:
+            outbox = Outbox(pdf_prefix + OUTBOX_EXTENSION)
+        #Finish off an interrupted mailing first
+        leftovers = []
+        if outbox is not None:
+            leftovers = outbox.get_messages(Outbox.QUEUED)
+        if len(leftovers) > 0:
+            resume = None
+            def set_resume(val):
+                nonlocal resume
+                resume = val
+            resume_menu = Menu("%d messages from the last mailing were never sent:"\
+                %len(leftovers), back = False)
+            resume_menu.add_item("Send them now", set_resume, True)
+            resume_menu.add_item("Discard them", set_resume, False)
+            resume_menu.prompt()
+            if resume:
+                email_manager.login()
+                failures = email_manager.send_batch(leftovers, outbox)
+                print("\n%d messages sent, %d failed\n"%(len(leftovers) - len(failures),\
+                    len(failures)))
+                email_manager.logout()
+                return
+            outbox.discard_queued()
+        by_group = False
+        if self.is_using_groups():
+            def set_by_group(val):
+                nonlocal by_group
+                by_group = val
+            by_group_menu = Menu("Send one email per:", back = False)
+            by_group_menu.add_item("Student", set_by_group, False)
+            by_group_menu.add_item("Group", set_by_group, True)
+            by_group_menu.prompt()
+        inline = False
+        def set_inline(val):
+            nonlocal inline
+            inline = val
+        inline_menu = Menu("Send rubrics as:", back = False)
+        inline_menu.add_item("PDF attachments", set_inline, False)
+        inline_menu.add_item("Tables in the email (no PDFs needed)", set_inline, True)
+        inline_menu.prompt()
+        #Who to send to
+        query = None
+        def set_query(val):
+            nonlocal query
+            while val and query is None:
+                query = input_query(self.blank_rubric)
+        to_menu = Menu("Send to:", back = False)
+        to_menu.add_item("Everyone", set_query, False)
+        to_menu.add_item("Only those matching a search", set_query, True)
+        to_menu.prompt()
         #Prepare subject
         subject = input("Email subject: ")
         #Prepare greeting
-        greeting = unquote(seeded_input("Email greeting (use %s for student name): ",\
+        greeting = unquote(seeded_input("Email greeting (use %s for student names): ",\
             "Dear %s,"))
         #Prepare email body
-        print("Email body (to break lines, end with \\):")
-        body = ""
+        known_fields = list(self.blank_rubric.get_merge_fields()) +\
+            MailMerge.ENTITY_FIELDS
+        print("Email body (to break lines, end with \\; for mail merge, use fields "\
+            "like {total}, {max} or {<category or front matter name>}):")
         while True:
-            body_piece = input()
-            body += body_piece
-            if len(body_piece) > 0 and body_piece[-1] == '\\':
-                body = body[:-1]
-            else:
+            body = ""
+            while True:
+                body_piece = input()
+                body += body_piece
+                if len(body_piece) > 0 and body_piece[-1] == '\\':
+                    body = body[:-1]
+                else:
+                    break
+            body = unquote(body)
+            #Catch bad fields now, not halfway through the class
+            try:
+                MailMerge(body, known_fields)
                 break
-        body = unquote(body)
+            except ValueError as err:
+                print("%s\nEmail body:"%str(err))
         #Prepare closing
         print("Email closing (e.g. your name):")
         closing = ""
@@ -703,11 +1437,34 @@ class Roster:
         email_template = EmailTemplate(message = body, closing = closing,\
             subject = subject, my_email = email_manager.get_email(),\
             my_name = email_manager.get_name(), greeting = greeting,\
-            pdf_prefix = pdf_prefix)
+            pdf_prefix = pdf_prefix, inline = inline)
+        email_template.set_merge_fields(known_fields)
+        recipients = self.get_email_recipients(pdf_prefix, by_group, inline)
+        if query is not None:
+            students = self.select_students(query)
+            recipients = [recipient for recipient in recipients\
+                if Roster.entity_matches(recipient[0], students)]
+            if len(recipients) == 0:
+                print("Nobody to email matches %s\n"%query)
+                return
+        if email_manager.writes_files():
+            #Everything can be looked over in the files, so write them all at once
+            email_msgs = []
+            for entity, pdf_students, atts, fields, views in recipients:
+                email_msgs.append(email_template.render(entity, attachments = atts,\
+                    pdf_students = pdf_students, fields = fields, rubrics = views))
+            failures = email_manager.deliver_locally(email_msgs)
+            print("\n%d messages written to %s, %d failed\n"%(len(email_msgs) -\
+                len(failures), email_manager.destination, len(failures)))
+            for email_msg, err in failures:
+                print("Message to %s NOT written: %s"%(email_msg['To'], str(err)))
+            if len(failures) > 0:
+                print()
+            return
         send_ok = True
         new_body = False
         previewed = False
-        fname = None
+        fnames = []
         global_atts = set()
         def send_not_ok():
             nonlocal send_ok
@@ -715,14 +1472,21 @@ class Roster:
         def edit_body():
             nonlocal new_body
             nonlocal body
-            body = seeded_input("Edit body: ", body)
+            while True:
+                body = seeded_input("Edit body: ", body)
+                try:
+                    email_template.get_merge(body)
+                    break
+                except ValueError as err:
+                    print(str(err))
             new_body = True
         def preview_pdf():
             nonlocal previewed
-            nonlocal fname
+            nonlocal fnames
             previewed = True
-            webbrowser.open_new(r'file://%s'%os.path.abspath(fname))
-            print_delay("")
+            for fname in fnames:
+                webbrowser.open_new(r'file://%s'%os.path.abspath(fname))
+                print_delay("")
         def preview_attachments():
             nonlocal global_atts
             nonlocal previewed
@@ -740,34 +1504,100 @@ class Roster:
         email_edit_menu.add_item("Edit body", edit_body)
         email_edit_menu.add_item("Preview PDF", preview_pdf)
         email_edit_menu.add_item("Preview Extra Attachments", preview_attachments)
+        #Ask before sending anyone the same email again
+        skip_all_sent = False
+        def skip_sent():
+            nonlocal send_ok
+            send_ok = False
+        def skip_all():
+            nonlocal skip_all_sent
+            skip_all_sent = True
+            skip_sent()
+        already_sent_menu = Menu("Already sent this email. Action", back = False)
+        already_sent_menu.add_item("Send it again", lambda : None)
+        already_sent_menu.add_item("Skip", skip_sent)
+        already_sent_menu.add_item("Skip everyone already sent this", skip_all)
+        #Render the next few emails while the current one is being reviewed
+        renderer = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        rendered = dict()
+        def prefetch(start):
+            for entity, pdf_students, atts, fields, views in\
+                    recipients[start:start + EMAIL_PREFETCH]:
+                if entity not in rendered or rendered[entity][0] != body:
+                    rendered[entity] = (body, renderer.submit(email_template.render,\
+                        entity, message = body, attachments = atts,\
+                        pdf_students = pdf_students, fields = fields, rubrics = views))
         #Log into email_manager
         email_manager.login()
-        #Go through students
-        for student in self.get_students():
-            fname = make_pdf_name(pdf_prefix, student)
-            global_atts = self.get_rubric(student).get_attachments()
-            if os.path.isfile(fname):
+        #Send approved emails in the background while reviewing the rest
+        sender = BackgroundSender(email_manager, outbox, report = False)
+        #Sendmail gets approved emails a batch at a time, like the files above
+        if email_manager.is_local():
+            batch_size = SENDMAIL_BATCH
+        else:
+            batch_size = 1
+        approved = []
+        try:
+            #Go through students or groups
+            for i in range(len(recipients)):
+                entity, pdf_students, global_atts, fields, views = recipients[i]
+                if inline:
+                    fnames = []
+                else:
+                    fnames = [make_pdf_name(pdf_prefix, s) for s in pdf_students]
                 send_ok = True
                 while True:
                     #Prep email
                     if not previewed:
-                        email_msg = email_template.render(student, message = body,\
-                                                            attachments = global_atts)
+                        prefetch(i)
+                        email_msg = rendered.pop(entity)[1].result()
+                        prefetch(i + 1)
+                        if outbox.get_state(email_msg['Message-ID']) == Outbox.SENT:
+                            print("Already sent to %s"%str(entity))
+                            if skip_all_sent:
+                                send_ok = False
+                            else:
+                                already_sent_menu.prompt()
+                            if not send_ok:
+                                print("Skipping...\n")
+                                break
                     #Offer to edit
                     new_body = False
                     previewed = False
                     print_email(email_msg)
+                    pending, sent, failed = sender.get_counts()
+                    print("[Sending: %d pending, %d sent, %d failed]"%\
+                        (pending + len(approved), sent, failed))
                     #Proof
                     email_edit_menu.prompt()
                     if not new_body and not previewed:
                         break
-                #Send
+                #Queue it up to send
                 if send_ok:
-                    email_manager.send_message(email_msg)
-            elif verbose:
-                print("File not found: %s\nSkipping...\n"%fname)
-        #Log out of email_manager
-        email_manager.logout()
+                    outbox.add(email_msg)
+                    approved.append(email_msg)
+                    if len(approved) >= batch_size:
+                        sender.submit_batch(approved)
+                        approved = []
+        finally:
+            #Don't bother rendering anything that won't be reviewed
+            for old_body, future in rendered.values():
+                future.cancel()
+            renderer.shutdown(wait = False)
+            #Whatever was approved still goes out
+            sender.submit_batch(approved)
+            pending = sender.get_counts()[0]
+            if pending > 0:
+                print("\nFinishing sending %d messages..."%pending)
+            failures = sender.finish()
+            pending, sent, failed = sender.get_counts()
+            print("\n%d messages sent, %d failed\n"%(sent, failed))
+            for email_msg, err in failures:
+                print("Message to %s NOT sent: %s"%(email_msg['To'], str(err)))
+            if len(failures) > 0:
+                print()
+            #Log out of email_manager
+            email_manager.logout()
 
 
 class ItemChangingText:
@@ -782,11 +1612,10 @@ class ItemChangingText:
         else:
             score = self.item.get_score()
             if score is None:
-                ret += " (out of %d)"%(self.item.get_value())
-            elif isinstance(score, int):
-                ret += " (%d/%d)"%(score, self.item.get_value())
+                ret += " (out of %s)"%score_to_string(self.item.get_value())
             else:
-                ret += " (%.2f/%d)"%(score, self.item.get_value())
+                ret += " (%s/%s)"%(score_to_string(score),\
+                    score_to_string(self.item.get_value()))
             if self.item.get_comment() != "":
                 ret += " \"%s\""%self.item.get_comment()
         if self.item.is_changed():
@@ -794,6 +1623,1301 @@ class ItemChangingText:
         return ret
 
 
+#Class for undoing and redoing grading edits
+#Each step is a list of (setter, old value, new value), so undoing a step
+#calls each setter with the old value, and redoing calls it with the new one
+class EditHistory:
+    history = None
+    @staticmethod
+    def get_edit_history():
+        if EditHistory.history is None:
+            EditHistory.history = EditHistory()
+        return EditHistory.history
+
+    def __init__(self, max_steps = EDIT_HISTORY_MAX_STEPS):
+        self.undo_stack = collections.deque(maxlen = max_steps)
+        self.redo_stack = []
+        #Step being built, and how many start_step calls it's nested in
+        self.step = None
+        self.step_depth = 0
+        #Are we in the middle of undoing or redoing?
+        self.replaying = False
+
+    #Group all the edits until the matching end_step into one step
+    def start_step(self):
+        if self.step_depth == 0:
+            self.step = []
+        self.step_depth += 1
+
+    def end_step(self):
+        self.step_depth -= 1
+        if self.step_depth == 0:
+            step = self.step
+            self.step = None
+            if len(step) > 0:
+                self.undo_stack.append(step)
+                self.redo_stack = []
+
+    #Record an edit
+    def record(self, setter, old, new):
+        if self.replaying or old == new:
+            return
+        if self.step is not None:
+            self.step.append((setter, old, new))
+        else:
+            self.undo_stack.append([(setter, old, new)])
+            self.redo_stack = []
+
+    def can_undo(self):
+        return len(self.undo_stack) > 0
+
+    def can_redo(self):
+        return len(self.redo_stack) > 0
+
+    #Undo the last step
+    #Returns how many edits were undone
+    def undo(self):
+        if not self.can_undo():
+            return 0
+        step = self.undo_stack.pop()
+        self.replaying = True
+        try:
+            for setter, old, new in reversed(step):
+                setter(old)
+        finally:
+            self.replaying = False
+        self.redo_stack.append(step)
+        return len(step)
+
+    #Redo the last undone step
+    #Returns how many edits were redone
+    def redo(self):
+        if not self.can_redo():
+            return 0
+        step = self.redo_stack.pop()
+        self.replaying = True
+        try:
+            for setter, old, new in step:
+                setter(new)
+        finally:
+            self.replaying = False
+        self.undo_stack.append(step)
+        return len(step)
+
+    #Forget everything
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack = []
+
+#Undo the last step, for menus
+def undo_edit():
+    count = EditHistory.get_edit_history().undo()
+    if count == 0:
+        print("Nothing to undo\n")
+    else:
+        print("Undid %d change%s\n"%(count, '' if count == 1 else 's'))
+
+#Redo the last undone step, for menus
+def redo_edit():
+    count = EditHistory.get_edit_history().redo()
+    if count == 0:
+        print("Nothing to redo\n")
+    else:
+        print("Redid %d change%s\n"%(count, '' if count == 1 else 's'))
+
+#Base class for the indexes a Roster keeps of everyone's grades (see
+#Roster.get_index); every edit is passed on to them, and each one keeps up
+#with the kinds of edits it cares about
+class RosterIndex:
+    #An item's score was set
+    def note_score(self, item, score):
+        pass
+
+    #An item's comment was set
+    def note_comment(self, item, old, new):
+        pass
+
+    #A rubric's front matter was set
+    def note_front_matter(self, rubric, label, old, new):
+        pass
+
+#Class for every student's scores in one students x items NumPy matrix, so
+#roster-wide statistics don't need every rubric customized and traversed
+#Columns are the leaf items of the rubric (items, and categories without
+#items), and graded is False wherever a score is blank
+#Item.set_score keeps it up to date
+class ScoreMatrix(RosterIndex):
+    def __init__(self, roster):
+        self.students = roster.get_students()
+        self.row_of = dict([(self.students[i], i) for i in range(len(self.students))])
+        #Columns: (item id, name, out of)
+        self.items = []
+        self.column_of = dict()
+        #Categories, with the TOTAL first: (name, out of, leaf item ids under it)
+        self.categories = []
+        #For each category with items, its formula (or None) and what its
+        #items are: ('category', index) or ('column', column)
+        self.formulas = dict()
+        def find_columns(item):
+            if isinstance(item, Category) and len(item.items) > 0:
+                index = len(self.categories)
+                self.categories.append(None)
+                ids = []
+                parts = []
+                for sub_item in item:
+                    sub_index = len(self.categories)
+                    ids += find_columns(sub_item)
+                    if isinstance(sub_item, Category) and len(sub_item.items) > 0:
+                        parts.append(('category', sub_index))
+                    elif sub_item.get_id() in self.column_of:
+                        parts.append(('column', self.column_of[sub_item.get_id()]))
+                self.categories[index] = (item.get_name(), item.get_value(), ids)
+                self.formulas[index] = (item.formula, parts)
+                return ids
+            if item.get_value() is None:
+                return []
+            self.column_of[item.get_id()] = len(self.items)
+            self.items.append((item.get_id(), item.get_name(), item.get_value()))
+            if isinstance(item, Category):
+                #A category scored all at once
+                self.categories.append((item.get_name(), item.get_value(),\
+                    [item.get_id()]))
+            return [item.get_id()]
+        find_columns(roster.blank_rubric.total)
+        self.values = numpy.zeros((len(self.students), len(self.items)))
+        self.graded = numpy.zeros((len(self.students), len(self.items)), dtype = bool)
+        #Which columns add up to each category
+        self.membership = numpy.zeros((len(self.categories), len(self.items)))
+        for i in range(len(self.categories)):
+            for item_id in self.categories[i][2]:
+                self.membership[i, self.column_of[item_id]] = 1
+        #Cells each item's score goes in, as (rows, column)
+        self.cells = dict()
+        #Items whose scores go in each column
+        self.column_items = [[] for i in range(len(self.items))]
+        #Scores to fill in, all at once at the end
+        rows_in = []
+        columns_in = []
+        scores_in = []
+        column_of = self.column_of
+        cells = self.cells
+        column_items = self.column_items
+        def add_cell(item, rows):
+            column = column_of.get(item.get_id())
+            if column is None:
+                return
+            cells[item] = (rows, column)
+            column_items[column].append(item)
+            score = item.get_score()
+            if score is not None:
+                rows_in.extend(rows)
+                columns_in.extend([column]*len(rows))
+                scores_in.extend([score]*len(rows))
+        def add_cells(item, rows):
+            if isinstance(item, Category) and len(item.children) > 0:
+                #Individualized; each child goes with one student
+                for student, child in item.children.items():
+                    if student in self.row_of:
+                        add_cells(child, [self.row_of[student]])
+            elif isinstance(item, Category) and len(item.items) > 0:
+                for sub_item in item.items:
+                    #Plain items are most of them, so handle them right here
+                    if type(sub_item) is Item:
+                        column = column_of[sub_item.id]
+                        cells[sub_item] = (rows, column)
+                        column_items[column].append(sub_item)
+                        if sub_item.score is not None:
+                            rows_in.extend(rows)
+                            columns_in.extend([column]*len(rows))
+                            scores_in.extend([sub_item.score]*len(rows))
+                    else:
+                        add_cells(sub_item, rows)
+            else:
+                add_cell(item, rows)
+        with PausedGC():
+            for entity in roster.graded_entities:
+                if isinstance(entity, FrozenGroup):
+                    add_cells(roster.rubrics[entity].total,\
+                        [self.row_of[s] for s in entity])
+                else:
+                    add_cells(roster.rubrics[entity].total, [self.row_of[entity]])
+        self.values[rows_in, columns_in] = scores_in
+        self.graded[rows_in, columns_in] = True
+
+    def set_cells(self, cells, score):
+        rows, column = cells
+        if score is None:
+            self.graded[rows, column] = False
+            self.values[rows, column] = 0
+        else:
+            self.graded[rows, column] = True
+            self.values[rows, column] = score
+
+    #An item's score was set
+    def note_score(self, item, score):
+        if item in self.cells:
+            self.set_cells(self.cells[item], score)
+
+    #Get the rows of the given students and groups
+    def get_rows(self, entities):
+        rows = []
+        for entity in entities:
+            if isinstance(entity, FrozenGroup):
+                rows += [self.row_of[student] for student in entity]
+            else:
+                rows.append(self.row_of[entity])
+        return rows
+
+    #Get names for the columns, with the category in front, like "SOFTWARE: Style"
+    def get_column_labels(self):
+        labels = [item[1] for item in self.items]
+        for i in range(1, len(self.categories)):
+            for column in self.get_category_columns(i):
+                if labels[column] != self.categories[i][0]:
+                    labels[column] = "%s: %s"%(self.categories[i][0], labels[column])
+        return labels
+
+    #Get the columns that add up to a category (an index into categories)
+    def get_category_columns(self, index):
+        return [self.column_of[item_id] for item_id in self.categories[index][2]]
+
+    #Change scores in bulk, all as one undo step
+    #rows are the students to change (None for everyone), and columns the
+    #columns to change
+    #change gets (scores, graded, out of), for just those rows and columns,
+    #and returns the new (scores, graded)
+    #Only items whose scores actually change are set
+    #Returns how many items were changed
+    def change_scores(self, columns, change, rows = None):
+        if rows is None:
+            rows = numpy.arange(len(self.students))
+        rows = numpy.asarray(rows, dtype = int)
+        columns = numpy.asarray(columns, dtype = int)
+        out_of = numpy.array([self.items[column][2] for column in columns], dtype = float)
+        old_scores = self.values[numpy.ix_(rows, columns)]
+        old_graded = self.graded[numpy.ix_(rows, columns)]
+        new_scores, new_graded = change(old_scores, old_graded, out_of)
+        #Where each student is in rows
+        position = numpy.full(len(self.students), -1, dtype = int)
+        position[rows] = numpy.arange(len(rows))
+        changed = 0
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            for j in range(len(columns)):
+                for item in self.column_items[columns[j]]:
+                    #Everyone sharing an item has the same score, so use any selected one
+                    i = position[self.cells[item][0]].max()
+                    if i < 0:
+                        continue
+                    if not new_graded[i, j]:
+                        score = None
+                    else:
+                        score = round(float(new_scores[i, j]), 2)
+                        if score == int(score):
+                            score = int(score)
+                    if score != item.get_score():
+                        item.set_score(score)
+                        changed += 1
+        finally:
+            history.end_step()
+        return changed
+
+    #Change comments in bulk, all as one undo step
+    #Returns how many items were changed
+    def set_comments(self, column, comment, rows = None):
+        selected = None if rows is None else set(rows)
+        changed = 0
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            for item in self.column_items[column]:
+                if selected is not None and selected.isdisjoint(self.cells[item][0]):
+                    continue
+                if item.get_comment() != comment:
+                    item.set_comment(comment)
+                    changed += 1
+        finally:
+            history.end_step()
+        return changed
+
+    #Changes for change_scores
+    #Give everyone this score
+    @staticmethod
+    def set_to(score):
+        return lambda scores, graded, out_of: (numpy.full(scores.shape, score,\
+            dtype = float), numpy.ones(graded.shape, dtype = bool))
+
+    #Add points to graded scores, keeping them between 0 and what they're out of
+    #If spread, the points are for each student's whole set of columns, and
+    #they're split up by how many points each column has left to give (or to
+    #take away, if negative)
+    @staticmethod
+    def add_points(points, spread = False):
+        def change(scores, graded, out_of):
+            if not spread:
+                added = numpy.full(scores.shape, float(points))
+            else:
+                if points >= 0:
+                    room = numpy.where(graded, out_of - scores, 0)
+                else:
+                    room = numpy.where(graded, scores, 0)
+                total_room = room.sum(axis = 1, keepdims = True)
+                with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+                    added = numpy.where(total_room > 0, points*room/total_room, 0)
+            return numpy.where(graded, numpy.clip(scores + added, 0, out_of), scores),\
+                graded
+        return change
+
+    #Multiply graded scores, keeping them between 0 and what they're out of
+    @staticmethod
+    def scale_points(factor):
+        return lambda scores, graded, out_of: (numpy.where(graded,\
+            numpy.clip(scores*factor, 0, out_of), scores), graded)
+
+    #Fill in blank scores, with full marks if score is None
+    @staticmethod
+    def fill_blanks(score = None):
+        def change(scores, graded, out_of):
+            fill = numpy.broadcast_to(out_of, scores.shape) if score is None else\
+                numpy.full(scores.shape, float(score))
+            return numpy.where(graded, scores, fill), numpy.ones(graded.shape, dtype = bool)
+        return change
+
+    #Get everyone's category scores, with the TOTAL first
+    #Returns (scores, graded), each students x categories
+    #A category is graded once everything in it is
+    def get_category_scores(self):
+        scores = self.values.dot(self.membership.T)
+        if any([formula is not None for formula, parts in self.formulas.values()]):
+            #Work up from the bottom, so each category uses its items' real scores
+            for index in sorted(self.formulas, reverse = True):
+                formula, parts = self.formulas[index]
+                part_scores = [scores[:, i] if kind == 'category' else self.values[:, i]\
+                    for kind, i in parts]
+                if formula is None:
+                    scores[:, index] = sum(part_scores)
+                else:
+                    scores[:, index] = formula.evaluate_many(part_scores)
+        graded = self.graded.astype(float).dot(self.membership.T) ==\
+            self.membership.sum(axis = 1)
+        return scores, graded
+
+    #Get (count, mean, median, stdev, min, max) of each column of scores,
+    #counting only graded ones; columns with nothing graded get NaN
+    @staticmethod
+    def get_summary(scores, graded):
+        data = numpy.where(graded, scores, numpy.nan)
+        with warnings.catch_warnings():
+            #Columns with nothing graded
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return (graded.sum(axis = 0), numpy.nanmean(data, axis = 0),\
+                numpy.nanmedian(data, axis = 0), numpy.nanstd(data, axis = 0, ddof = 1),\
+                numpy.nanmin(data, axis = 0), numpy.nanmax(data, axis = 0))
+
+    #Get a histogram of one column of graded scores, as (counts, bin edges)
+    @staticmethod
+    def get_histogram(scores, graded, out_of, bins = 10):
+        return numpy.histogram(scores[graded], bins = bins,\
+            range = (0, max(out_of, scores[graded].max() if graded.any() else 0)))
+
+    #Get the percentile rank of each score in one column: the percent of graded
+    #scores below it, counting ties as half below; NaN where it's not graded
+    @staticmethod
+    def get_percentile_ranks(scores, graded):
+        ranked = numpy.sort(scores[graded])
+        if len(ranked) == 0:
+            return numpy.full(scores.shape, numpy.nan)
+        below = numpy.searchsorted(ranked, scores, side = 'left')
+        ties = numpy.searchsorted(ranked, scores, side = 'right') - below
+        return numpy.where(graded, (below + ties/2)/len(ranked)*100, numpy.nan)
+
+    #Flag scores more than 1.5 interquartile ranges outside the middle half
+    #of each column
+    @staticmethod
+    def get_outliers(scores, graded):
+        data = numpy.where(graded, scores, numpy.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            q1, q3 = numpy.nanpercentile(data, [25, 75], axis = 0)
+        spread = 1.5*(q3 - q1)
+        with numpy.errstate(invalid = 'ignore'):
+            return graded & ((scores < q1 - spread) | (scores > q3 + spread))
+
+#Index of everyone's grades, for running Queries
+#Fields are named by path, like "SOFTWARE/Style"; scores of categories and the
+#TOTAL are fields too, and so is each piece of front matter
+#Everything is kept per student, and kept up to date as scores, comments and
+#front matter are set
+class GradeIndex(RosterIndex):
+    def __init__(self, roster):
+        self.fields = GradeIndex.get_fields(roster.blank_rubric)
+        self.students = set(roster.students)
+        self.names = dict([(student, str(student).lower()) for student in self.students])
+        self.path_of = dict()
+        for field in self.fields[0].values():
+            if field is not None and field[0] == GradeIndex.SCORE:
+                self.path_of[field[3]] = field[1]
+        #Which students each item and rubric go with, for keeping up with edits
+        self.students_of = dict()
+        self.rubric_students = dict()
+        #Scores of leaf items and categories (by id) and comments (by path),
+        #each per student
+        self.totals = collections.defaultdict(dict)
+        self.comments = collections.defaultdict(dict)
+        #How many scores, comments and front matter each student has filled in
+        self.filled = collections.Counter()
+        def add(item, students):
+            if isinstance(item, Category) and len(item.children) > 0:
+                #Individualized; each child goes with one student
+                for student, child in item.children.items():
+                    if student in self.students:
+                        add(child, [student])
+                return
+            self.students_of[item] = students
+            comment = item.get_comment()
+            if comment != '':
+                path = self.path_of.get(item.get_id())
+                for student in students:
+                    if path is not None:
+                        self.comments[path][student] = comment
+                    self.filled[student] += 1
+            if isinstance(item, Category) and len(item.items) > 0:
+                for sub_item in item.items:
+                    add(sub_item, students)
+            elif item.get_value() is not None and item.get_score() is not None:
+                scores = self.totals[item.get_id()]
+                for student in students:
+                    scores[student] = item.get_score()
+                    self.filled[student] += 1
+        self.front_matter = collections.defaultdict(dict)
+        for entity in roster.graded_entities:
+            rubric = roster.rubrics[entity]
+            students = list(entity) if isinstance(entity, FrozenGroup) else [entity]
+            self.rubric_students[rubric] = students
+            add(rubric.total, students)
+            for fm in rubric.frontmatter:
+                if rubric.frontmatter_dict[fm] is not None:
+                    for student in students:
+                        self.front_matter[fm][student] = rubric.frontmatter_dict[fm]
+                        self.filled[student] += 1
+        #How categories are put together, by id: the ids of the parts of each
+        #category, the category each part is in, and formulas
+        self.parts = dict()
+        self.parent = dict()
+        self.formulas = dict()
+        #Scores of categories, worked up from the bottom
+        def find_totals(item):
+            if not isinstance(item, Category) or len(item.items) == 0:
+                return self.totals[item.get_id()]
+            parts = [sub_item for sub_item in item.items\
+                if isinstance(sub_item, Category) and len(sub_item.items) > 0 or\
+                sub_item.get_value() is not None]
+            self.parts[item.get_id()] = [sub_item.get_id() for sub_item in parts]
+            self.formulas[item.get_id()] = item.formula
+            for sub_item in parts:
+                self.parent[sub_item.get_id()] = item.get_id()
+            part_totals = [find_totals(sub_item) for sub_item in parts]
+            graded = set(self.students).intersection(*part_totals)
+            totals = self.totals[item.get_id()]
+            for student in graded:
+                totals[student] = self.get_category_score(item.get_id(),\
+                    [part[student] for part in part_totals])
+            return totals
+        find_totals(roster.blank_rubric.total)
+        #Who hasn't been graded on each score field, and everyone else's scores
+        #in order (as a list of scores and a list of who has them)
+        self.ungraded = dict()
+        self.scores = dict()
+        for field in self.fields[0].values():
+            if field is None or field[0] != GradeIndex.SCORE:
+                continue
+            path = field[1]
+            totals = self.totals[field[3]]
+            ranked = sorted(totals.items(), key = lambda pair: pair[1])
+            self.scores[path] = ([pair[1] for pair in ranked], [pair[0] for pair in ranked])
+            self.ungraded[path] = self.students.difference(totals)
+
+    #Score of a category from the scores of its parts, like Category.get_score
+    def get_category_score(self, item_id, scores):
+        if self.formulas[item_id] is not None:
+            return self.formulas[item_id].evaluate(scores)
+        if None in scores:
+            return None
+        return sum(scores)
+
+    #Change a student's score for a leaf item or category (None for ungraded)
+    def set_total(self, item_id, student, score):
+        totals = self.totals[item_id]
+        old = totals.get(student)
+        if old == score:
+            return
+        path = self.path_of.get(item_id)
+        if old is not None:
+            del totals[student]
+            if path is not None:
+                scores, students = self.scores[path]
+                position = bisect.bisect_left(scores, old)
+                while students[position] != student:
+                    position += 1
+                del scores[position]
+                del students[position]
+        if score is not None:
+            totals[student] = score
+            if path is not None:
+                scores, students = self.scores[path]
+                position = bisect.bisect_right(scores, score)
+                scores.insert(position, score)
+                students.insert(position, student)
+        if path is not None:
+            if score is None:
+                self.ungraded[path].add(student)
+            else:
+                self.ungraded[path].discard(student)
+
+    #An item's score was set; update it and the categories it's in
+    def note_score(self, item, score):
+        if item not in self.students_of:
+            return
+        item_id = item.get_id()
+        if item_id in self.parts or item.get_value() is None:
+            #Not a score that counts
+            return
+        students = self.students_of[item]
+        for student in students:
+            old = self.totals[item_id].get(student)
+            if old is None and score is not None:
+                self.filled[student] += 1
+            elif old is not None and score is None:
+                self.filled[student] -= 1
+            self.set_total(item_id, student, score)
+        item_id = self.parent.get(item_id)
+        while item_id is not None:
+            for student in students:
+                self.set_total(item_id, student, self.get_category_score(item_id,\
+                    [self.totals[part].get(student) for part in self.parts[item_id]]))
+            item_id = self.parent.get(item_id)
+
+    #An item's comment was set
+    def note_comment(self, item, old, new):
+        if item not in self.students_of:
+            return
+        path = self.path_of.get(item.get_id())
+        for student in self.students_of[item]:
+            if path is not None:
+                if new == '':
+                    self.comments[path].pop(student, None)
+                else:
+                    self.comments[path][student] = new
+            if old == '' and new != '':
+                self.filled[student] += 1
+            elif old != '' and new == '':
+                self.filled[student] -= 1
+
+    #A rubric's front matter was set
+    def note_front_matter(self, rubric, label, old, new):
+        if rubric not in self.rubric_students:
+            return
+        for student in self.rubric_students[rubric]:
+            if new is None:
+                self.front_matter[label].pop(student, None)
+            else:
+                self.front_matter[label][student] = new
+            if old is None and new is not None:
+                self.filled[student] += 1
+            elif old is not None and new is None:
+                self.filled[student] -= 1
+
+    #Kinds of fields
+    SCORE = 'score'
+    FRONT_MATTER = 'front matter'
+
+    #Get the fields of a rubric, as (fields by lowercase path, paths by lowercase
+    #item name, path of the TOTAL)
+    #A score field is (SCORE, path, out of, item id, leaf item ids it adds up),
+    #and front matter is (FRONT_MATTER, name)
+    #Paths that appear more than once map to None
+    @staticmethod
+    def get_fields(rubric):
+        fields = dict()
+        by_name = dict()
+        def add_field(field):
+            key = field[1].lower()
+            fields[key] = None if key in fields else field
+        def find_fields(item, prefix):
+            path = prefix + item.get_name()
+            if isinstance(item, Category) and len(item.items) > 0:
+                ids = []
+                for sub_item in item.items:
+                    ids += find_fields(sub_item, '' if item is rubric.total else path + '/')
+            elif item.get_value() is not None:
+                ids = [item.get_id()]
+            else:
+                ids = []
+            add_field((GradeIndex.SCORE, path, item.get_value(), item.get_id(), ids))
+            if item is not rubric.total:
+                key = item.get_name().lower()
+                by_name[key] = None if key in by_name else path.lower()
+            return ids
+        find_fields(rubric.total, '')
+        for fm in rubric.frontmatter:
+            add_field((GradeIndex.FRONT_MATTER, fm))
+        return fields, by_name, rubric.total.get_name()
+
+    #Look up a field by its path, or just its name if that's unique
+    #Raises a ValueError if there's no such field
+    @staticmethod
+    def find_field(fields, name):
+        key = name.lower()
+        if key not in fields[0] and fields[1].get(key) is not None:
+            key = fields[1][key]
+        if fields[0].get(key) is None:
+            if key in fields[0] or key in fields[1]:
+                raise ValueError("More than one field is called %s; use its whole "\
+                    "path, like CATEGORY/Item"%name)
+            raise ValueError("No field called %s"%name)
+        return fields[0][key]
+
+    #Searches, each returning a set of students
+    def get_done(self):
+        return self.students - self.ungraded[self.fields[2]]
+
+    def get_started(self):
+        return set([student for student, count in self.filled.items() if count > 0])
+
+    def get_ungraded(self, field):
+        if field[0] == GradeIndex.FRONT_MATTER:
+            return self.students.difference(self.front_matter[field[1]])
+        return set(self.ungraded[field[1]])
+
+    def get_graded(self, field):
+        return self.students - self.get_ungraded(field)
+
+    #Scores compared to a value, using one of the QUERY_COMPARISONS
+    def compare_scores(self, field, comparison, value):
+        scores, students = self.scores[field[1]]
+        low = bisect.bisect_left(scores, value)
+        high = bisect.bisect_right(scores, value)
+        if comparison == '<':
+            return set(students[:low])
+        elif comparison == '<=':
+            return set(students[:high])
+        elif comparison == '>':
+            return set(students[high:])
+        elif comparison == '>=':
+            return set(students[low:])
+        elif comparison in ['=', '==']:
+            return set(students[low:high])
+        else:
+            return set(students[:low] + students[high:])
+
+    #Comments (or front matter) containing some text, ignoring case
+    def get_containing(self, field, text):
+        text = text.lower()
+        if field[0] == GradeIndex.FRONT_MATTER:
+            values = self.front_matter[field[1]]
+        else:
+            values = self.comments[field[1]]
+        return set([student for student, value in values.items() if text in value.lower()])
+
+    #Front matter equal to some text, ignoring case
+    def get_equal(self, field, text):
+        text = text.lower()
+        values = self.front_matter[field[1]]
+        return set([student for student, value in values.items() if value.lower() == text])
+
+    def get_named(self, text):
+        text = text.lower()
+        return set([student for student, name in self.names.items() if text in name])
+
+#A search over everyone's grades, like
+#   ungraded SOFTWARE/Style or PRESENTATION < 50%
+#It's compiled once, and then it can be run on any GradeIndex (see QUERY_HELP)
+class Query:
+    TOKEN = re.compile(r'\s*(?:"([^"]*)"|(<=|>=|!=|==|<|>|=|\(|\))|([^\s()<>=!"]+))')
+    def __init__(self, text, rubric):
+        self.text = text
+        self.fields = GradeIndex.get_fields(rubric)
+        #Tokens are (is it a plain word?, text)
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = Query.TOKEN.match(text, position)
+            if match is None:
+                raise ValueError("Unmatched quote in search: %s"%text[position:].strip())
+            if match.group(1) is not None:
+                self.tokens.append((False, match.group(1)))
+            else:
+                self.tokens.append((True, match.group(2) or match.group(3)))
+            position = match.end()
+        if len(self.tokens) == 0:
+            raise ValueError("Empty search")
+        self.position = 0
+        self.search = self.parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError("Unexpected \"%s\" in search"%self.tokens[self.position][1])
+
+    def __str__(self):
+        return self.text
+
+    #Get the set of students this matches
+    def select(self, index):
+        return self.search(index)
+
+    #Parsing, one level of precedence at a time
+    #Each returns a function from a GradeIndex to a set of students
+    def peek_word(self):
+        if self.position < len(self.tokens) and self.tokens[self.position][0]:
+            return self.tokens[self.position][1].lower()
+        return None
+
+    def next_token(self, expected):
+        if self.position >= len(self.tokens):
+            raise ValueError("Search ended early; expected %s"%expected)
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def parse_or(self):
+        search = self.parse_and()
+        while self.peek_word() == 'or':
+            self.position += 1
+            search = functools.partial(lambda a, b, index: a(index) | b(index),\
+                search, self.parse_and())
+        return search
+
+    def parse_and(self):
+        search = self.parse_not()
+        while self.peek_word() == 'and':
+            self.position += 1
+            search = functools.partial(lambda a, b, index: a(index) & b(index),\
+                search, self.parse_not())
+        return search
+
+    def parse_not(self):
+        if self.peek_word() == 'not':
+            self.position += 1
+            search = self.parse_not()
+            return lambda index: index.students - search(index)
+        return self.parse_atom()
+
+    def parse_atom(self):
+        word = self.peek_word()
+        if word == '(':
+            self.position += 1
+            search = self.parse_or()
+            if self.next_token("\")\"") != ')':
+                raise ValueError("Missing \")\" in search")
+            return search
+        elif word == 'done':
+            self.position += 1
+            return lambda index: index.get_done()
+        elif word == 'started':
+            self.position += 1
+            return lambda index: index.get_started()
+        elif word in ['graded', 'ungraded', 'missing']:
+            self.position += 1
+            field = GradeIndex.find_field(self.fields, self.next_token("a field"))
+            if word == 'graded':
+                return lambda index: index.get_graded(field)
+            return lambda index: index.get_ungraded(field)
+        elif word == 'name' and self.position + 1 < len(self.tokens) and\
+                self.tokens[self.position + 1] == (True, 'has'):
+            self.position += 2
+            text = self.next_token("a name")
+            return lambda index: index.get_named(text)
+        field = GradeIndex.find_field(self.fields, self.next_token("a search"))
+        comparison = self.next_token("has, =, <, etc. after %s"%field[1])
+        if comparison.lower() == 'has':
+            text = self.next_token("text after has")
+            return lambda index: index.get_containing(field, text)
+        if comparison not in QUERY_COMPARISONS:
+            raise ValueError("Expected has, =, <, etc. after %s, not %s"%(field[1],\
+                comparison))
+        value = self.next_token("a value after %s"%comparison)
+        if field[0] == GradeIndex.FRONT_MATTER:
+            if comparison in ['=', '==']:
+                return lambda index: index.get_equal(field, value)
+            elif comparison == '!=':
+                return lambda index: index.students - index.get_equal(field, value)
+            raise ValueError("%s is front matter; use has, = or !="%field[1])
+        try:
+            if value[-1] == '%':
+                number = float(value[:-1])*field[2]/100
+            else:
+                number = float(value)
+        except ValueError:
+            raise ValueError("Not a score: %s"%value)
+        return lambda index: index.compare_scores(field, comparison, number)
+
+#Ask for a Query (see QUERY_HELP), asking again if it doesn't make sense
+#Returns None if nothing is entered
+def input_query(rubric, msg = "Search (? for help): "):
+    while True:
+        text = input(msg).strip()
+        if text == '':
+            return None
+        if text == '?':
+            print(QUERY_HELP + "\n")
+            continue
+        try:
+            return Query(text, rubric)
+        except ValueError as err:
+            print(err)
+
+#Inverted index of every comment: each word goes to the items whose comments
+#have it, so finding comments doesn't mean reading all of them
+#Kept up to date as comments are set
+class CommentIndex(RosterIndex):
+    WORD = re.compile(r'\w+')
+    def __init__(self, roster):
+        self.words = collections.defaultdict(set)
+        #Whose each item is: (entity, student it's individualized for or None)
+        self.owners = dict()
+        #Path of each item id, like "SOFTWARE/Style"
+        self.paths = roster.blank_rubric.get_paths()
+        #Position of each entity, for putting matches in order
+        self.order = dict()
+        with PausedGC():
+            for entity in roster:
+                self.order[entity] = len(self.order)
+                self.add_items(roster.rubrics[entity].total, entity, None)
+
+    def add_items(self, item, entity, student):
+        if isinstance(item, Category) and len(item.children) > 0:
+            #Individualized; each child goes with one student
+            for child_student, child in item.children.items():
+                self.add_items(child, entity, child_student)
+            return
+        owner = (entity, student)
+        self.owners[item] = owner
+        if item.comment != '':
+            self.add_comment(item, item.comment)
+        if isinstance(item, Category):
+            for sub_item in item.items:
+                #Plain items are most of them, so handle them right here
+                if type(sub_item) is Item:
+                    self.owners[sub_item] = owner
+                    if sub_item.comment != '':
+                        self.add_comment(sub_item, sub_item.comment)
+                else:
+                    self.add_items(sub_item, entity, student)
+
+    #Get the words in some text, lowercase
+    @staticmethod
+    def get_words(text):
+        return CommentIndex.WORD.findall(text.lower())
+
+    def add_comment(self, item, comment):
+        for word in set(CommentIndex.get_words(comment)):
+            self.words[word].add(item)
+
+    def remove_comment(self, item, comment):
+        for word in set(CommentIndex.get_words(comment)):
+            items = self.words.get(word)
+            if items is not None:
+                items.discard(item)
+                if len(items) == 0:
+                    del self.words[word]
+
+    #An item's comment was set
+    def note_comment(self, item, old, new):
+        if item in self.owners:
+            self.remove_comment(item, old)
+            self.add_comment(item, new)
+
+    #Get the items whose comments have all the words in text, in that order
+    #(ignoring case and punctuation), sorted by entity and then by path
+    def search(self, text):
+        words = CommentIndex.get_words(text)
+        if len(words) == 0:
+            return []
+        candidates = sorted([self.words.get(word, set()) for word in set(words)], key = len)
+        found = candidates[0].intersection(*candidates[1:])
+        if len(words) > 1:
+            phrase = ' %s '%' '.join(words)
+            found = [item for item in found if phrase in\
+                ' %s '%' '.join(CommentIndex.get_words(item.get_comment()))]
+        return sorted(found, key = lambda item: (self.order[self.owners[item][0]],\
+            str(self.owners[item][1]), self.paths[item.get_id()]))
+
+    #Describe where an item is, like "Group 1: SOFTWARE/Style"
+    def describe(self, item):
+        entity, student = self.owners[item]
+        path = self.paths[item.get_id()]
+        if student is not None:
+            return "%s (%s): %s"%(str(entity), str(student), path)
+        return "%s: %s"%(str(entity), path)
+
+    #Replace text in the comments of some items, all as one undo step
+    #Text is matched the way search does, by whole words ignoring case and
+    #punctuation, so "off by one" replaces "Off-by-one" too
+    #Returns how many comments changed
+    @staticmethod
+    def replace(items, old, new):
+        words = CommentIndex.get_words(old)
+        if len(words) == 0:
+            pattern = re.compile(re.escape(old), re.IGNORECASE)
+        else:
+            pattern = re.compile(r'(?<!\w)%s(?!\w)'%r'\W+'.join(map(re.escape, words)),\
+                re.IGNORECASE)
+        changed = 0
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            for item in items:
+                comment = pattern.sub(lambda match: new, item.get_comment())
+                if comment != item.get_comment():
+                    item.set_comment(comment)
+                    changed += 1
+        finally:
+            history.end_step()
+        return changed
+
+#Every comment given on each item (by item id), for suggesting comments
+#while grading; most comments get given to more than one student
+#Kept up to date as comments are set
+class CommentBank(RosterIndex):
+    def __init__(self, roster):
+        #Comments on each item: comment -> [how many have it, when it was last given]
+        self.comments = collections.defaultdict(dict)
+        #Each item's comments, lowercase and sorted, for finding them by how they
+        #start; rebuilt when needed
+        self.sorted = dict()
+        #Each item's three-letter pieces of comments (lowercase) -> comments,
+        #for finding them by something in the middle
+        self.trigrams = collections.defaultdict(lambda: collections.defaultdict(set))
+        self.clock = 0
+        def add(item):
+            if item.get_comment() != '':
+                self.add_comment(item.get_id(), item.get_comment())
+        for entity in roster.graded_entities:
+            roster.rubrics[entity].total.traverse(add, ignore_blanks = False)
+
+    #Get the three-letter pieces of some text, lowercase
+    @staticmethod
+    def get_trigrams(text):
+        text = text.lower()
+        return set([text[i:i+3] for i in range(len(text) - 2)])
+
+    def add_comment(self, item_id, comment):
+        comments = self.comments[item_id]
+        if comment in comments:
+            comments[comment][0] += 1
+        else:
+            comments[comment] = [1, 0]
+            self.sorted.pop(item_id, None)
+            trigrams = self.trigrams[item_id]
+            for trigram in CommentBank.get_trigrams(comment):
+                trigrams[trigram].add(comment)
+        comments[comment][1] = self.clock
+
+    def remove_comment(self, item_id, comment):
+        comments = self.comments[item_id]
+        if comment not in comments:
+            return
+        comments[comment][0] -= 1
+        if comments[comment][0] == 0:
+            del comments[comment]
+            self.sorted.pop(item_id, None)
+            trigrams = self.trigrams[item_id]
+            for trigram in CommentBank.get_trigrams(comment):
+                trigrams[trigram].discard(comment)
+                if len(trigrams[trigram]) == 0:
+                    del trigrams[trigram]
+
+    #An item's comment was set
+    def note_comment(self, item, old, new):
+        self.clock += 1
+        if old != '':
+            self.remove_comment(item.get_id(), old)
+        if new != '':
+            self.add_comment(item.get_id(), new)
+
+    #Get up to limit comments given on an item that contain text (ignoring case),
+    #those starting with it first, and each of those most given (then most
+    #recently given) first
+    def suggest(self, item_id, text = '', limit = COMMENT_SUGGESTIONS):
+        comments = self.comments.get(item_id, dict())
+        def rank(found):
+            return heapq.nlargest(limit, found, key = lambda comment: comments[comment])
+        if text == '':
+            return rank(comments)
+        lower = text.lower()
+        if item_id not in self.sorted:
+            self.sorted[item_id] = sorted([(comment.lower(), comment) for comment in comments])
+        ranked = self.sorted[item_id]
+        start = bisect.bisect_left(ranked, (lower,))
+        end = start
+        while end < len(ranked) and ranked[end][0].startswith(lower):
+            end += 1
+        ret = rank([pair[1] for pair in ranked[start:end]])
+        if len(ret) < limit and len(lower) >= 3:
+            trigrams = self.trigrams.get(item_id, dict())
+            found = [trigrams.get(trigram, set()) for trigram in\
+                CommentBank.get_trigrams(lower)]
+            found.sort(key = len)
+            middle = found[0].intersection(*found[1:])
+            ret += rank([comment for comment in middle if lower in comment.lower() and\
+                not comment.lower().startswith(lower)])[:limit - len(ret)]
+        return ret
+
+#Input a comment for an item, offering comments given before on the same item:
+#up arrow goes through the most common ones, and tab completes what's typed
+#The comment is seeded with text, like seeded_input
+def comment_input(msg, item, text = ""):
+    bank = Roster.get_notified_index(CommentBank)
+    if bank is None:
+        return seeded_input(msg, text)
+    suggestions = [comment for comment in bank.suggest(item.get_id()) if comment != text]
+    if len(suggestions) > 0:
+        print("Comments given before (up arrow for these, tab to complete):")
+        for suggestion in suggestions:
+            print("  %s"%suggestion)
+    history_length = readline.get_current_history_length()
+    #Most common comes up first
+    for suggestion in reversed(suggestions):
+        readline.add_history(suggestion)
+    def completer(typed, state):
+        matches = bank.suggest(item.get_id(), typed)
+        if state < len(matches):
+            return matches[state]
+        return None
+    delims = readline.get_completer_delims()
+    #Complete the whole comment, not just the last word
+    readline.set_completer_delims('')
+    readline.set_completer(completer)
+    try:
+        return seeded_input(msg, text)
+    finally:
+        readline.set_completer()
+        readline.set_completer_delims(delims)
+        if not libedit:
+            #Take the suggestions back out of the history
+            for i in range(len(suggestions)):
+                readline.remove_history_item(history_length)
+
+#Queue of everything left to grade: each (entity, item) with an ungraded score
+#It goes through the roster in order, one entity's items after another, and
+#can also go through just one item for everyone
+#Kept up to date as scores are set, so cells cleared again come back
+class GradingQueue(RosterIndex):
+    def __init__(self, roster):
+        #Cells in order: (entity, student it's individualized for or None, item)
+        self.cells = []
+        self.position = dict()
+        #Item ids in rubric order, and the path of each
+        self.paths = roster.blank_rubric.get_paths()
+        self.item_ids = []
+        #Positions of the ungraded cells, overall and for each item id, and
+        #heaps of them for finding the first; skipped cells leave the heaps
+        self.ungraded = set()
+        self.ungraded_by_id = collections.defaultdict(set)
+        self.heap = []
+        self.heaps = collections.defaultdict(list)
+        def add_cells(item, entity, student):
+            if isinstance(item, Category) and len(item.children) > 0:
+                #Individualized; each child goes with one student
+                for child_student, child in item.children.items():
+                    add_cells(child, entity, child_student)
+            elif isinstance(item, Category) and len(item.items) > 0:
+                for sub_item in item.items:
+                    add_cells(sub_item, entity, student)
+            elif item.has_own_field() and item.get_value() is not None:
+                self.position[item] = len(self.cells)
+                self.cells.append((entity, student, item))
+                if item.get_id() not in self.heaps:
+                    self.item_ids.append(item.get_id())
+                    self.heaps[item.get_id()] = []
+                if item.get_score() is None:
+                    self.add_ungraded(item)
+        for entity in roster:
+            add_cells(roster.rubrics[entity].total, entity, None)
+
+    def add_ungraded(self, item):
+        position = self.position[item]
+        if position not in self.ungraded:
+            self.ungraded.add(position)
+            self.ungraded_by_id[item.get_id()].add(position)
+            heapq.heappush(self.heap, position)
+            heapq.heappush(self.heaps[item.get_id()], position)
+
+    #An item's score was set
+    def note_score(self, item, score):
+        if item not in self.position:
+            return
+        if score is None:
+            self.add_ungraded(item)
+        else:
+            position = self.position[item]
+            self.ungraded.discard(position)
+            self.ungraded_by_id[item.get_id()].discard(position)
+
+    #How many cells are left to grade, overall or for one item id
+    def count(self, item_id = None):
+        if item_id is None:
+            return len(self.ungraded)
+        return len(self.ungraded_by_id[item_id])
+
+    #Get the next cell to grade, overall or for one item id, or None if there
+    #aren't any (not counting skipped ones)
+    def peek(self, item_id = None):
+        heap = self.heap if item_id is None else self.heaps[item_id]
+        while len(heap) > 0 and heap[0] not in self.ungraded:
+            heapq.heappop(heap)
+        if len(heap) == 0:
+            return None
+        return self.cells[heap[0]]
+
+    #Leave a cell ungraded for now
+    def skip(self, item_id = None):
+        heap = self.heap if item_id is None else self.heaps[item_id]
+        if self.peek(item_id) is not None:
+            heapq.heappop(heap)
+
+    #Put skipped cells back
+    def unskip(self):
+        self.heap = list(self.ungraded)
+        heapq.heapify(self.heap)
+        for item_id, positions in self.ungraded_by_id.items():
+            self.heaps[item_id] = list(positions)
+            heapq.heapify(self.heaps[item_id])
+
+    #Describe a cell, like "Group 1: SOFTWARE/Style", with just the student for
+    #individualized categories
+    def describe(self, cell):
+        entity, student, item = cell
+        if student is not None:
+            entity = student
+        return "%s: %s"%(str(entity), self.paths[item.get_id()])
+
+#A scoring formula for a category, like "drop_lowest(scores, 1)" or
+#"0.4*{SOFTWARE} + 0.6*{PRESENTATION}", compiled once into a function
+#In a formula, scores and values are the scores and out-ofs of the category's
+#items in order, total and out_of are their sums, and {Name} is the score of
+#the item called Name
+#The same function works on scores for one student or, as NumPy arrays, on
+#scores for everyone at once
+class Formula:
+    #What a formula can be made of
+    NODES = tuple([getattr(ast, name) for name in ['Expression', 'BinOp', 'UnaryOp',\
+        'Add', 'Sub', 'Mult', 'Div', 'USub', 'UAdd', 'Call', 'Name', 'Load', 'List',\
+        'Tuple', 'Subscript', 'Index', 'Constant', 'Num'] if hasattr(ast, name)])
+    VARIABLES = ['scores', 'values', 'total', 'out_of']
+
+    def __init__(self, text, names, values):
+        self.text = text
+        self.values = list(values)
+        #Swap {Name} for the item's score
+        lower_names = [name.lower() for name in names]
+        def find_name(match):
+            name = match.group(1).strip().lower()
+            if lower_names.count(name) != 1:
+                raise ValueError("No single item called %s in formula: %s"%\
+                    (match.group(1), text))
+            return "scores[%d]"%lower_names.index(name)
+        expression = re.sub(r'\{([^{}]*)\}', find_name, text)
+        try:
+            tree = ast.parse(expression.strip(), mode = 'eval')
+        except SyntaxError:
+            raise ValueError("Invalid formula: %s"%text)
+        for node in ast.walk(tree):
+            if not isinstance(node, Formula.NODES):
+                raise ValueError("Can't use %s in formula: %s"%(type(node).__name__, text))
+            if isinstance(node, ast.Name) and node.id not in Formula.VARIABLES and\
+                    node.id not in Formula.FUNCTIONS:
+                raise ValueError("Unknown name %s in formula: %s"%(node.id, text))
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or\
+                    node.func.id not in Formula.FUNCTIONS or len(node.keywords) > 0):
+                raise ValueError("Can only call %s in formula: %s"%\
+                    (', '.join(sorted(Formula.FUNCTIONS)), text))
+            if type(node).__name__ in ['Constant', 'Num'] and\
+                    not isinstance(getattr(node, 'value', getattr(node, 'n', None)), (int, float)):
+                raise ValueError("Only numbers can be used in formula: %s"%text)
+        self.function = eval("lambda %s: (%s)"%(', '.join(Formula.VARIABLES),\
+            expression.strip()), dict(Formula.FUNCTIONS, __builtins__ = dict()))
+        #The out_of variable is what the items add up to
+        self.possible = sum(self.values)
+        #Best possible score: the formula with everything at full marks
+        try:
+            self.out_of = Formula.tidy(self.function(self.values, self.values,\
+                self.possible, self.possible))
+        except (IndexError, TypeError, ZeroDivisionError) as err:
+            raise ValueError("Invalid formula (%s): %s"%(str(err), text))
+        #Scoring has to agree with it, or full marks wouldn't be full marks
+        if self.evaluate(self.values) != self.out_of:
+            raise ValueError("Invalid formula (full marks don't give %s): %s"%\
+                (score_to_string(self.out_of), text))
+
+    def __str__(self):
+        return self.text
+
+    #Round off what floating point leaves behind, and make whole numbers ints
+    @staticmethod
+    def tidy(score):
+        score = round(float(score), 2)
+        if score == int(score):
+            return int(score)
+        return score
+
+    #Get the score for one student's scores (None if any are ungraded)
+    def evaluate(self, scores):
+        if None in scores:
+            return None
+        return Formula.tidy(self.function(scores, self.values, sum(scores),\
+            self.possible))
+
+    #Get everyone's scores from a list of arrays of scores, one per item
+    def evaluate_many(self, scores):
+        total = sum(scores)
+        return numpy.round(numpy.broadcast_to(self.function(scores, self.values, total,\
+            self.possible), total.shape).astype(float), 2)
+
+    #Functions formulas can use; each works on numbers or NumPy arrays
+    @staticmethod
+    def is_array(values):
+        return numpy is not None and any([isinstance(value, numpy.ndarray)\
+            for value in values])
+
+    @staticmethod
+    def formula_min(*args):
+        values = list(args[0]) if len(args) == 1 else list(args)
+        if Formula.is_array(values):
+            return functools.reduce(numpy.minimum, values)
+        return min(values)
+
+    @staticmethod
+    def formula_max(*args):
+        values = list(args[0]) if len(args) == 1 else list(args)
+        if Formula.is_array(values):
+            return functools.reduce(numpy.maximum, values)
+        return max(values)
+
+    #Total of all but the lowest n scores
+    @staticmethod
+    def drop_lowest(scores, n = 1):
+        if Formula.is_array(scores):
+            stacked = numpy.sort(numpy.array(numpy.broadcast_arrays(*scores)), axis = 0)
+            return stacked[int(n):].sum(axis = 0)
+        return sum(sorted(scores)[int(n):])
+
+    #Total of the highest n scores
+    @staticmethod
+    def keep_highest(scores, n = 1):
+        return Formula.drop_lowest(scores, len(scores) - n)
+
+    @staticmethod
+    def cap(score, limit):
+        return Formula.formula_min(score, limit)
+
+    @staticmethod
+    def at_least(score, limit):
+        return Formula.formula_max(score, limit)
+
+Formula.FUNCTIONS = {'min': Formula.formula_min, 'max': Formula.formula_max,\
+    'sum': sum, 'drop_lowest': Formula.drop_lowest, 'keep_highest': Formula.keep_highest,\
+    'cap': Formula.cap, 'at_least': Formula.at_least}
+
 #Class representing a grading item
 class Item:
     next_id = 0
@@ -809,6 +2933,8 @@ class Item:
 
     def set_comment(self, comment):
         global saved
+        EditHistory.get_edit_history().record(self.set_comment, self.comment, comment)
+        Roster.notify('note_comment', self, self.comment, comment)
         saved = False
         self.changed = True
         self.comment = comment
@@ -818,6 +2944,8 @@ class Item:
 
     def set_score(self, score):
         global saved
+        EditHistory.get_edit_history().record(self.set_score, self.score, score)
+        Roster.notify('note_score', self, score)
         saved = False
         self.changed = True
         self.score = score
@@ -832,7 +2960,7 @@ class Item:
         return self.name
 
     def __str__(self):
-        ret = "%s\t%d"%(self.get_name(), self.get_value())
+        ret = "%s\t%s"%(self.get_name(), score_to_string(self.get_value()))
         score = self.get_score()
         if score is not None:
             if isinstance(score, int):
@@ -856,12 +2984,27 @@ class Item:
     def individualize(self, group):
         pass
 
+    def regroup(self, group, carried):
+        pass
+
     def get_individual(self):
         return None
 
     def get_id(self):
         return self.id
 
+    #Key for this item in saved rubrics: (item id, individual)
+    def get_key(self):
+        if self.get_individual() is None:
+            return (self.get_id(), None)
+        else:
+            return (self.get_id(), str(self.get_individual()))
+
+    #Get the score saved in a RubricRecords, without loading it
+    #See Category.get_records_score for student
+    def get_records_score(self, records, student = None):
+        return records.get_item((self.get_id(), None))[0]
+
     def has_own_field(self):
         return True
 
@@ -885,6 +3028,8 @@ class Category(Item):
         self.respect_groups = respect_groups
         self.individual = None
         self.children = dict()
+        #Formula for the score, if it's not just the sum of the items
+        self.formula = None
 
     def add_item(self, item):
         self.items.append(item)
@@ -892,8 +3037,15 @@ class Category(Item):
     def get_value(self):
         if len(self.items) == 0:
             return self.value
+        if self.formula is not None:
+            return self.formula.out_of
         return sum([item.get_value() for item in self.items])
 
+    #Give this category a scoring formula (see Formula)
+    def set_formula(self, text):
+        self.formula = Formula(text, [item.name for item in self.items],\
+            [item.get_value() for item in self.items])
+
     def get_score(self):
         if len(self.children) > 0:
             max_score = None
@@ -907,6 +3059,8 @@ class Category(Item):
             return max_score
         if len(self.items) == 0:
             return self.score
+        if self.formula is not None:
+            return self.formula.evaluate([item.get_score() for item in self.items])
         ret = 0
         for item in self.items:
             if item.get_score() is None:
@@ -915,6 +3069,21 @@ class Category(Item):
                 ret += item.get_score()
         return ret
 
+    #Get the score saved in a RubricRecords, without loading it, the same way
+    #as get_score
+    #For a group's records, student picks whose individualized categories to use
+    def get_records_score(self, records, student = None):
+        if len(self.items) == 0:
+            if student is not None and self.is_individual():
+                return records.get_item((self.get_id(), str(student)))[0]
+            return records.get_item((self.get_id(), None))[0]
+        scores = [item.get_records_score(records, student) for item in self.items]
+        if self.formula is not None:
+            return self.formula.evaluate(scores)
+        if None in scores:
+            return None
+        return sum(scores)
+
     def get_name(self):
         nget = super().get_name()
         if self.individual is not None:
@@ -939,6 +3108,35 @@ class Category(Item):
             for item in self:
                 item.individualize(group)
 
+    #Redo individualize for a group whose members changed
+    #carried is a dict from (item id, student) to individualized Category,
+    #used for students who came from other groups
+    def regroup(self, group, carried):
+        if self.is_individual():
+            children = dict()
+            for student in group:
+                if student in self.children:
+                    child = self.children[student]
+                elif (self.get_id(), student) in carried:
+                    child = carried[(self.get_id(), student)]
+                else:
+                    child = self.copy()
+                child.individual = student
+                children[student] = child
+            self.children = children
+        else:
+            for item in self:
+                item.regroup(group, carried)
+
+    #Add all individualized categories to ret,
+    #as a dict from (item id, student) to Category
+    def get_individual_categories(self, ret):
+        for student in self.children:
+            ret[(self.get_id(), student)] = self.children[student]
+        for item in self:
+            if isinstance(item, Category):
+                item.get_individual_categories(ret)
+
     def has_own_field(self):
         return self.value is not None
 
@@ -987,6 +3185,7 @@ class Category(Item):
         new_cat.comment = ref.comment
         new_cat.children = dict()
         new_cat.id = ref.id
+        new_cat.formula = ref.formula
         #for key in self.children:
         #    new_cat.children[key] = self.children[key].copy()
         if reference_student is None:
@@ -1008,7 +3207,12 @@ class Category(Item):
         def fill_scores_action(item):
             if item.get_score() is None:
                 item.set_score(item.get_value())
-        self.traverse(fill_scores_action)
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            self.traverse(fill_scores_action)
+        finally:
+            history.end_step()
 
     #Mark this Category and all its children as saved
     def save(self):
@@ -1031,6 +3235,529 @@ class Category(Item):
         return ret
 
 
+#Class representing the saved contents of one rubric:
+#front matter values, attachments, and the score and comment of each item
+#Items are keyed on (item id, individual), where individual is None or the
+#name of the student an individualized category belongs to
+class RubricRecords:
+    def __init__(self):
+        self.frontmatter = dict()
+        self.attachments = set()
+        self.items = dict()
+
+    def __eq__(self, other):
+        return isinstance(other, RubricRecords) and\
+            self.frontmatter == other.frontmatter and\
+            self.attachments == other.attachments and self.items == other.items
+
+    #Get the (score, comment) for a key
+    def get_item(self, key):
+        return self.items.get(key, (None, ''))
+
+    #Set the (score, comment) for a key, dropping it if it is blank
+    def set_item(self, key, score, comment):
+        if score is None and comment == '':
+            self.items.pop(key, None)
+        else:
+            self.items[key] = (score, comment)
+
+    #Read in a string created by export
+    #If comment_table (a list of comments) is given, comments are
+    #stored as indices into it
+    @staticmethod
+    def parse(rubric_repr, old = False, comment_table = None):
+        records = RubricRecords()
+        for line in rubric_repr.split('\n'):
+            if line.strip() == '':
+                continue
+            line_pieces = line.split(get_rubric_save_separator(old))
+            if line_pieces[0][0] == get_rubric_front_matter_save_indicator(old):
+                #Front matter
+                records.frontmatter[line_pieces[0][1:]] = line_pieces[1]
+                continue
+            elif line_pieces[0][0] == get_rubric_attachment_indicator(old):
+                #Attachment
+                records.attachments.add(line_pieces[0][1:])
+                continue
+            the_id = int(line_pieces[0])
+            if len(line_pieces[1]) > 0 and not is_number(line_pieces[1]):
+                #We have an individualized thing
+                individual_str = line_pieces[1]
+                del line_pieces[1]
+            else:
+                individual_str = None
+            the_score = line_pieces[1]
+            if the_score == '':
+                the_score = None
+            elif the_score.find('.') >= 0:
+                the_score = float(the_score)
+            else:
+                the_score = int(the_score)
+            the_comment = get_rubric_save_separator(old).join(line_pieces[2:])
+            if comment_table is not None:
+                if the_comment != '':
+                    the_comment = comment_table[int(the_comment)]
+            else:
+                #Many students share the same comments
+                the_comment = sys.intern(the_comment)
+            records.items[(the_id, individual_str)] = (the_score, the_comment)
+        return records
+
+    #Read in just the scores from a string created by export, for when only
+    #totals are needed
+    #Front matter, attachments, comments and blank scores are left out
+    @staticmethod
+    def parse_scores(rubric_repr, old = False):
+        records = RubricRecords()
+        separator = get_rubric_save_separator(old)
+        for line in rubric_repr.split('\n'):
+            #Only items start with a digit (their id)
+            if len(line) == 0 or not line[0].isdigit():
+                continue
+            line_pieces = line.split(separator, 3)
+            if len(line_pieces[1]) > 0 and not is_number(line_pieces[1]):
+                #Individualized
+                key = (int(line_pieces[0]), line_pieces[1])
+                the_score = line_pieces[2]
+            else:
+                key = (int(line_pieces[0]), None)
+                the_score = line_pieces[1]
+            if the_score == '':
+                continue
+            elif the_score.find('.') >= 0:
+                records.items[key] = (float(the_score), '')
+            else:
+                records.items[key] = (int(the_score), '')
+        return records
+
+    #Convert to a string that can be imported
+    #If comment_table (a dict from comment to index) is given, comments are
+    #written as indices into it, and new comments are added to it
+    #If canonical, front matter and items are sorted too, so the same records
+    #always give the same string (attachments always are, since they're a set)
+    def export(self, comment_table = None, canonical = False):
+        ret = []
+        frontmatter = self.frontmatter
+        items = self.items
+        if canonical:
+            frontmatter = sorted(frontmatter)
+            items = sorted(items, key = lambda key: (key[0], key[1] is not None,\
+                key[1] or ''))
+        #Front matter
+        for fm in frontmatter:
+            ret.append('%s%s%s%s\n'%(RUBRIC_FRONT_MATTER_SAVE_INDICATOR, fm,\
+                RUBRIC_SAVE_SEPARATOR, self.frontmatter[fm]))
+        for key in items:
+            the_id, individual_str = key
+            score, comment = self.items[key]
+            if score is None:
+                score = ''
+            elif isinstance(score, int):
+                score = '%d'%score
+            else:
+                score = '%.2f'%score
+            if comment_table is not None and comment != '':
+                if comment not in comment_table:
+                    comment_table[comment] = len(comment_table)
+                comment = str(comment_table[comment])
+            if individual_str is None:
+                ret.append("%d%s%s%s%s\n"%(the_id, RUBRIC_SAVE_SEPARATOR,\
+                    score, RUBRIC_SAVE_SEPARATOR, comment))
+            else:
+                ret.append("%d%s%s%s%s%s%s\n"%(the_id, RUBRIC_SAVE_SEPARATOR,\
+                    individual_str, RUBRIC_SAVE_SEPARATOR, score,\
+                    RUBRIC_SAVE_SEPARATOR, comment))
+        #Add on attachments
+        for att in sorted(self.attachments):
+            ret.append('%s%s\n'%(RUBRIC_ATTACHMENT_INDICATOR, att))
+        return ''.join(ret)
+
+#Read a save file
+#Returns a dict from entity name to RubricRecords
+#If scores_only, only scores are read (see RubricRecords.parse_scores)
+def read_save_file(file, scores_only = False):
+    old = False
+    comment_table = None
+    ret = dict()
+    cur_entity = None
+    buffer = []
+    def flush_buffer():
+        nonlocal buffer
+        if len(buffer) > 0:
+            if cur_entity is None:
+                raise KeyError("Rubric data without an entity")
+            if scores_only:
+                ret[cur_entity] = RubricRecords.parse_scores(''.join(buffer), old)
+            else:
+                ret[cur_entity] = RubricRecords.parse(''.join(buffer), old,\
+                    comment_table)
+            buffer = []
+    with open_save_file(file, 'r') as fd:
+        first_line = True
+        for line_long in fd:
+            if comment_table is not None and len(line_long) > 0 and\
+                    line_long[0] == SAVE_COMMENT_TABLE_INDICATOR:
+                #String table entry; keep its whitespace intact
+                if not scores_only:
+                    comment_table.append(sys.intern(line_long[1:].rstrip('\n')))
+                continue
+            line = line_long.strip()
+            if len(line) == 0:
+                continue
+            if first_line:
+                first_line = False
+                if line == SAVE_VERSION_HEADER_V2:
+                    comment_table = []
+                    continue
+                elif line != SAVE_VERSION_HEADER:
+                    old = True
+                else:
+                    continue
+            if line[0] == get_roster_save_symbol(old):
+                flush_buffer()
+                cur_entity = line[1:]
+                #Make sure an entity with nothing graded still shows up
+                ret[cur_entity] = RubricRecords()
+            else:
+                buffer.append("%s\n"%line)
+        flush_buffer()
+    return ret
+
+#Write a save file
+#records is a dict from entity name to RubricRecords
+#Comments are stored once each in a string table at the top of the file,
+#and the rubrics refer to them by index
+def write_save_file(file, records, compression = None):
+    #Export the rubrics first, so the string table is complete
+    comment_table = dict()
+    exported = []
+    for entity_str in records:
+        exported.append("%s%s\n"%(ROSTER_SAVE_SYMBOL, entity_str))
+        exported.append("%s\n"%records[entity_str].export(comment_table))
+    with open_save_file(file, 'w', compression) as fd:
+        #Write the header to indicate the version
+        fd.write("%s\n"%SAVE_VERSION_HEADER_V2)
+        #Write the string table, in index order
+        for comment in comment_table:
+            fd.write("%s%s\n"%(SAVE_COMMENT_TABLE_INDICATOR, comment))
+        fd.write(''.join(exported))
+
+#Pick the merged value out of a common ancestor's value and each grader's value
+#Returns (merged value, list of (grader index, value) for every distinct change)
+#More than one distinct change is a conflict
+def merge_value(base_value, values):
+    changes = []
+    changed_values = []
+    for i in range(len(values)):
+        if values[i] != base_value and values[i] not in changed_values:
+            changes.append((i, values[i]))
+            changed_values.append(values[i])
+    if len(changes) == 0:
+        return base_value, changes
+    return changes[0][1], changes
+
+#Three-way merge of saved rubrics
+#base is the common ancestor and others are from each grader; all are dicts
+#from entity name to RubricRecords
+#Scores, comments, front matter and attachments are merged separately, with
+#items keyed on (item id, individual)
+#On a conflict, resolve(entity name, field, base value, changes) picks the
+#value to use, where field is ('score', key), ('comment', key) or
+#('frontmatter', name), and changes is a list of (grader index, value)
+#If resolve is None, the first grader to change it wins
+#Returns the merged records and a list of conflicts, as
+#(entity name, field, base value, changes, value used)
+def merge_records(base, others, resolve = None):
+    merged = dict()
+    conflicts = []
+    def merge_field(entity_str, field, base_value, values):
+        value, changes = merge_value(base_value, values)
+        if len(changes) > 1:
+            if resolve is not None:
+                value = resolve(entity_str, field, base_value, changes)
+            conflicts.append((entity_str, field, base_value, changes, value))
+        return value
+    entity_strs = list(base)
+    for other in others:
+        for entity_str in other:
+            if entity_str not in base and entity_str not in entity_strs:
+                entity_strs.append(entity_str)
+    for entity_str in entity_strs:
+        base_records = base.get(entity_str, RubricRecords())
+        other_records = [other.get(entity_str, base_records) for other in others]
+        records = RubricRecords()
+        #Front matter
+        fms = list(base_records.frontmatter)
+        for other in other_records:
+            fms += [fm for fm in other.frontmatter if fm not in fms]
+        for fm in fms:
+            value = merge_field(entity_str, ('frontmatter', fm),\
+                base_records.frontmatter.get(fm),\
+                [other.frontmatter.get(fm) for other in other_records])
+            if value is not None:
+                records.frontmatter[fm] = value
+        #Attachments; adding and removing can't conflict
+        atts = set(base_records.attachments)
+        for other in other_records:
+            atts.update(other.attachments)
+        for att in atts:
+            present, changes = merge_value(att in base_records.attachments,\
+                [att in other.attachments for other in other_records])
+            if present:
+                records.attachments.add(att)
+        #Items
+        keys = list(base_records.items)
+        for other in other_records:
+            keys += [key for key in other.items if key not in base_records.items]
+        for key in dict.fromkeys(keys):
+            base_score, base_comment = base_records.get_item(key)
+            score = merge_field(entity_str, ('score', key), base_score,\
+                [other.get_item(key)[0] for other in other_records])
+            comment = merge_field(entity_str, ('comment', key), base_comment,\
+                [other.get_item(key)[1] for other in other_records])
+            records.set_item(key, score, comment)
+        merged[entity_str] = records
+    return merged, conflicts
+
+#Find every difference between two saved rubrics
+#Returns a list of (field, old value, new value), where field is as in
+#merge_records, or ('attachment', path) with values of whether it is attached
+def diff_records(old, new):
+    ret = []
+    for fm in dict.fromkeys(list(old.frontmatter) + list(new.frontmatter)):
+        if old.frontmatter.get(fm) != new.frontmatter.get(fm):
+            ret.append((('frontmatter', fm), old.frontmatter.get(fm),\
+                new.frontmatter.get(fm)))
+    for key in dict.fromkeys(list(old.items) + list(new.items)):
+        old_score, old_comment = old.get_item(key)
+        new_score, new_comment = new.get_item(key)
+        if old_score != new_score:
+            ret.append((('score', key), old_score, new_score))
+        if old_comment != new_comment:
+            ret.append((('comment', key), old_comment, new_comment))
+    for att in sorted(old.attachments ^ new.attachments):
+        ret.append((('attachment', att), att in old.attachments,\
+            att in new.attachments))
+    return ret
+
+#Class for the snapshot history kept next to a save file
+#Each entity's saved rubric is stored once per distinct content, named by its
+#hash, and each snapshot just lists the hash for every entity
+class SnapshotStore:
+    def __init__(self, save_file):
+        self.directory = save_file + SNAPSHOT_DIRECTORY_EXTENSION
+        self.object_directory = os.path.join(self.directory, 'objects')
+        self.snapshot_directory = os.path.join(self.directory, 'snapshots')
+
+    #Write a file so it is either all there or not there at all
+    @staticmethod
+    def write_atomic(fname, text):
+        tmp_fname = "%s.%d.tmp"%(fname, os.getpid())
+        with open(tmp_fname, 'w', encoding = 'utf-8') as fd:
+            fd.write(text)
+        os.replace(tmp_fname, fname)
+
+    def get_object_file(self, the_hash):
+        return os.path.join(self.object_directory, the_hash[:2], the_hash[2:])
+
+    #Store a saved rubric, unless it is already stored
+    #Returns its hash
+    def add_object(self, records):
+        text = records.export(canonical = True)
+        the_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        fname = self.get_object_file(the_hash)
+        if not os.path.isfile(fname):
+            os.makedirs(os.path.dirname(fname), exist_ok = True)
+            SnapshotStore.write_atomic(fname, text)
+        return the_hash
+
+    def get_object(self, the_hash):
+        with open(self.get_object_file(the_hash), 'r', encoding = 'utf-8') as fd:
+            return RubricRecords.parse(fd.read())
+
+    #Names of all snapshots, oldest first
+    def get_names(self):
+        if not os.path.isdir(self.snapshot_directory):
+            return []
+        return sorted(os.listdir(self.snapshot_directory))
+
+    #Get a dict from entity name to hash for a snapshot
+    def get_manifest(self, name):
+        ret = dict()
+        with open(os.path.join(self.snapshot_directory, name), 'r',\
+                encoding = 'utf-8') as fd:
+            for line in fd:
+                line = line.rstrip('\n')
+                if len(line) > 0:
+                    the_hash, entity_str = line.split(RUBRIC_SAVE_SEPARATOR, 1)
+                    ret[entity_str] = the_hash
+        return ret
+
+    #Record a snapshot of records (a dict from entity name to RubricRecords)
+    #Returns the name of the snapshot, or None if nothing changed since the last one
+    def record(self, records):
+        manifest = dict()
+        for entity_str in records:
+            manifest[entity_str] = self.add_object(records[entity_str])
+        names = self.get_names()
+        if len(names) > 0 and self.get_manifest(names[-1]) == manifest:
+            return None
+        os.makedirs(self.snapshot_directory, exist_ok = True)
+        name = time.strftime("%Y-%m-%d_%H-%M-%S")
+        counter = 1
+        while name in names:
+            counter += 1
+            name = "%s_%03d"%(time.strftime("%Y-%m-%d_%H-%M-%S"), counter)
+        SnapshotStore.write_atomic(os.path.join(self.snapshot_directory, name),\
+            ''.join(["%s%s%s\n"%(manifest[entity_str], RUBRIC_SAVE_SEPARATOR,\
+            entity_str) for entity_str in manifest]))
+        return name
+
+    #Get a dict from entity name to RubricRecords for a snapshot
+    #If entity_strs is given, only get those entities
+    def load(self, name, entity_strs = None):
+        manifest = self.get_manifest(name)
+        ret = dict()
+        for entity_str in manifest:
+            if entity_strs is None or entity_str in entity_strs:
+                ret[entity_str] = self.get_object(manifest[entity_str])
+        return ret
+
+    #Find the differences between two snapshots
+    #Returns a list of (entity name, diff_records output),
+    #only for entities that changed
+    def diff(self, old_name, new_name):
+        old_manifest = self.get_manifest(old_name)
+        new_manifest = self.get_manifest(new_name)
+        ret = []
+        for entity_str in dict.fromkeys(list(old_manifest) + list(new_manifest)):
+            old_hash = old_manifest.get(entity_str)
+            new_hash = new_manifest.get(entity_str)
+            #Same hash means same contents, so no need to look
+            if old_hash == new_hash:
+                continue
+            old = RubricRecords() if old_hash is None else self.get_object(old_hash)
+            new = RubricRecords() if new_hash is None else self.get_object(new_hash)
+            ret.append((entity_str, diff_records(old, new)))
+        return ret
+
+#Read everyone's totals for one assignment, from its save file
+#Runs in a separate process, so it reads its own roster and rubric
+#Returns the total's out-of, and a dict from student name to total (None if
+#not fully graded)
+def read_gradebook_totals(student_file, rubric_file, save_file):
+    roster = Roster(student_file)
+    #Items are numbered in the order they're read, so number them the same
+    #way a grading session with just this rubric would
+    next_id = Item.next_id
+    Item.next_id = 0
+    try:
+        rubric = Rubric(rubric_file)
+    finally:
+        Item.next_id = next_id
+    records = read_save_file(save_file, scores_only = True)
+    ret = dict()
+    for student in roster.students:
+        group = roster.get_group(student)
+        if group is None:
+            ret[str(student)] = rubric.total.get_records_score(records.get(str(student),\
+                RubricRecords()))
+        else:
+            ret[str(student)] = rubric.total.get_records_score(records.get(str(group),\
+                RubricRecords()), student)
+    return rubric.total.get_value(), ret
+
+#Class representing the assignments of a course, for combining their grades
+#Each line of the file is an assignment:
+#name rubric_file save_file weight [student_file]
+#with ~ for spaces in the name, like in student files
+#student_file is for assignments with different groups than everyone else;
+#students are matched by name
+#Files are relative to the gradebook file
+class Gradebook:
+    #Constructor
+    def __init__(self, from_file):
+        #List of (name, rubric file, save file, weight, student file or None)
+        self.assignments = []
+        directory = os.path.dirname(from_file)
+        fd = open(from_file, 'r')
+        line_counter = 0
+        try:
+            for line_long in fd:
+                line_counter += 1
+                line = line_long.strip()
+                if len(line) == 0 or line[0] == GRADEBOOK_COMMENT:
+                    continue
+                tokens = line.split()
+                if len(tokens) not in [4, 5] or not is_number(tokens[3]):
+                    raise ValueError("Invalid syntax in %s, Line %d: %s"%\
+                        (from_file, line_counter, line_long))
+                files = [os.path.join(directory, fil) for fil in tokens[1:3] + tokens[4:]]
+                if len(files) == 2:
+                    files.append(None)
+                self.assignments.append((tokens[0].replace(GRADEBOOK_NBSP, ' '),\
+                    files[0], files[1], float(tokens[3]), files[2]))
+        except:
+            fd.close()
+            print("An error occurred when building the Gradebook\n")
+            raise
+        fd.close()
+        if len(self.assignments) == 0:
+            raise ValueError("No assignments in %s"%from_file)
+
+    #Get everyone's totals for every assignment, reading the save files at
+    #the same time in separate processes
+    #Returns a list of what read_gradebook_totals does, one per assignment
+    def get_totals(self, student_file):
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            futures = []
+            for name, rubric_file, save_file, weight, own_student_file in self.assignments:
+                if own_student_file is None:
+                    own_student_file = student_file
+                futures.append(executor.submit(read_gradebook_totals,\
+                    own_student_file, rubric_file, save_file))
+            return [future.result() for future in futures]
+
+    #Export every assignment's total, and the weighted total as a percent,
+    #into a CSV file, alphabetized
+    #The weighted total is left blank until every assignment is graded
+    def export_csv(self, student_file, csv_filename):
+        students = Roster(student_file).get_students()
+        totals = self.get_totals(student_file)
+        total_weight = sum([assignment[3] for assignment in self.assignments])
+        def score_csv(score):
+            if score is None:
+                return ""
+            elif isinstance(score, int):
+                return str(score)
+            else:
+                return "%.2f"%score
+        fd = open(csv_filename, 'w')
+        try:
+            fd.write("%s,%s,%s,%s\n"%("Last", "First", ','.join(["%s (%s)"%\
+                (assignment[0], score_csv(out_of)) for assignment, (out_of, scores) in\
+                zip(self.assignments, totals)]), "Weighted"))
+            for student in students:
+                scores = [assignment_totals[1].get(str(student)) for assignment_totals\
+                    in totals]
+                if None in scores or total_weight == 0:
+                    weighted = None
+                else:
+                    weighted = 0
+                    for assignment, (out_of, _), score in zip(self.assignments,\
+                            totals, scores):
+                        if out_of != 0:
+                            weighted += assignment[3]*score/out_of
+                    weighted = 100*weighted/total_weight
+                fd.write("%s,%s,%s,%s\n"%(student.lname, student.fname,\
+                    ','.join([score_csv(score) for score in scores]),\
+                    score_csv(weighted)))
+        except:
+            fd.close()
+            raise
+        fd.close()
+        print("CSV %s written successfully\n"%csv_filename[csv_filename.rfind(os.sep)+1:])
+
 class FrontmatterChangingText:
     def __init__(self, fm, fm_dict):
         self.fm = fm
@@ -1072,6 +3799,8 @@ class Rubric:
         self.total = Category("TOTAL")
         #Keep track of current category
         current_category = self.total
+        #Formulas, compiled once all the items are in: category -> (formula, line)
+        formulas = dict()
         #Open the file
         fd = open(from_file, 'r')
         line_counter = 0
@@ -1087,6 +3816,13 @@ class Rubric:
                 if line[0] == RUBRIC_FRONT_MATTER:
                     self.frontmatter.append(line[1:])
                     self.frontmatter_dict[line[1:]] = None
+                #Check if it's a scoring formula for the current category
+                #(or for the TOTAL, before any categories)
+                elif line[0] == RUBRIC_FORMULA:
+                    if current_category in formulas:
+                        raise ValueError("Second formula for %s in %s, Line %d: %s"%\
+                            (current_category.name, from_file, line_counter, line_long))
+                    formulas[current_category] = (line[1:], line_counter)
                 #Check if it's a category
                 elif line[0] == RUBRIC_CATEGORY:
                     cat_name = line[1:]
@@ -1137,6 +3873,16 @@ class Rubric:
                         print("Invalid syntax in %s, Line %d: %s"%\
                             (from_file, line_counter, line[point_sep_idx:]))
                         raise
+            #Categories' formulas first, since the TOTAL's depends on them
+            for category in sorted(formulas, key = lambda cat: cat is self.total):
+                formula, formula_line = formulas[category]
+                if len(category.items) == 0:
+                    raise ValueError("Formula for %s, which has no items, in %s, Line %d"%\
+                        (category.name, from_file, formula_line))
+                try:
+                    category.set_formula(formula)
+                except ValueError as err:
+                    raise ValueError("%s in %s, Line %d"%(str(err), from_file, formula_line))
         except:
             #Be sure to close the file if an error happens
             fd.close()
@@ -1161,6 +3907,15 @@ class Rubric:
         if isinstance(graded_entity, FrozenGroup):
             self.total.individualize(graded_entity)
 
+    #Redo individualize for a group whose members changed
+    #See Category.regroup for carried
+    def regroup(self, group, carried):
+        self.total.regroup(group, carried)
+        self.changed = True
+        #The menus list individualized categories, so they need rebuilding
+        self.menu = None
+        self.auto_comment_menu = None
+
     #Create a copy of this rubric
     #Then, modify the copy to only use children defined by the given student
     def customize(self, student):
@@ -1206,10 +3961,19 @@ class Rubric:
         self.total.traverse(checker, accumulator, ignore_blanks = False)
         return ret
 
+    #Set the value of one piece of front matter
+    def set_front_matter_value(self, label, val):
+        global saved
+        EditHistory.get_edit_history().record(functools.partial(\
+            self.set_front_matter_value, label), self.frontmatter_dict[label], val)
+        Roster.notify('note_front_matter', self, label, self.frontmatter_dict[label], val)
+        saved = False
+        self.changed = True
+        self.frontmatter_dict[label] = val
+
     #Set front matter for this rubric
     def set_front_matter(self):
         def modify_front_matter(label):
-            global saved
             fm_text = self.frontmatter_dict[label]
             if fm_text is None:
                 fm_text = ""
@@ -1220,9 +3984,7 @@ class Rubric:
                 print("\nCanceled\n")
                 return
             else:
-                saved = False
-                self.changed = True
-                self.frontmatter_dict[label] = val
+                self.set_front_matter_value(label, val)
         if len(self.frontmatter) == 1:
             modify_front_matter(self.frontmatter[0])
             return
@@ -1256,21 +4018,26 @@ class Rubric:
             self.total.traverse(traverser, ignore_blanks = False)
         self.auto_comment_menu.prompt()
 
-    def remove_attachment(self, att):
+    #Attach or detach a file
+    def set_attached(self, att, attached):
         global saved
-        self.attachments.remove(att)
+        EditHistory.get_edit_history().record(functools.partial(\
+            self.set_attached, att), att in self.attachments, attached)
+        if attached:
+            self.attachments.add(att)
+        else:
+            self.attachments.discard(att)
         saved = False
         self.changed = True
 
+    def remove_attachment(self, att):
+        self.set_attached(att, False)
+
     def add_attachment(self, att):
-        global saved
         if os.path.isfile(att):
-            self.attachments.add(att)
+            self.set_attached(att, True)
         else:
             print("Error: File not found: %s"%att)
-            return
-        saved = False
-        self.changed = True
 
     #Get attachments
     def get_attachments(self):
@@ -1319,12 +4086,16 @@ class Rubric:
             self.menu.add_item(ChangingText(fm_update_text, fm_set,\
                 self.some_front_matter), self.set_front_matter)
         self.total.add_items_to_menu(self.menu)
+        self.menu.add_item("Quick entry (like: 3 8.5 \"comment\" or Style=9 :\"nice\")",\
+            self.quick_entry)
         self.menu.add_item(ChangingText("Add comment to auto-scored category (in progress)",\
             "Add comment to auto-scored category", self.is_auto_comment_in_progress),\
             self.add_auto_comment)
         #Add attachments to the thing
         self.menu.add_item("Manage attachments", self.manage_attachments)
         self.menu.add_item("Set rest to 100%", self.total.fill_scores)
+        self.menu.add_item("Undo", undo_edit)
+        self.menu.add_item("Redo", redo_edit)
         return self.menu
 
     def grade(self):
@@ -1339,110 +4110,245 @@ class Rubric:
     def is_changed(self):
         return self.changed or self.total.is_deep_changed()
 
-    #Convert to a string that can be imported
-    def export_rubric(self):
-        def transcriber(item):
-            score = item.get_score()
-            if item.has_own_field() and (score is not None or item.get_comment() != ''):
-                if item.get_individual() is not None:
-                    if score is not None:
-                        if isinstance(score, int):
-                            return "%d%s%s%s%d%s%s\n"%(item.get_id(), RUBRIC_SAVE_SEPARATOR,\
-                                str(item.get_individual()), RUBRIC_SAVE_SEPARATOR,\
-                                score, RUBRIC_SAVE_SEPARATOR, item.get_comment())
-                        else:
-                            return "%d%s%s%s%.2f%s%s\n"%(item.get_id(), RUBRIC_SAVE_SEPARATOR,\
-                                str(item.get_individual()), RUBRIC_SAVE_SEPARATOR,\
-                                score, RUBRIC_SAVE_SEPARATOR, item.get_comment())
-                    else:
-                        return "%d%s%s%s%s%s\n"%(item.get_id(), RUBRIC_SAVE_SEPARATOR,\
-                            str(item.get_individual()), RUBRIC_SAVE_SEPARATOR,\
-                            RUBRIC_SAVE_SEPARATOR, item.get_comment())
-                else:
-                    if score is not None:
-                        if isinstance(score, int):
-                            return "%d%s%d%s%s\n"%(item.get_id(), RUBRIC_SAVE_SEPARATOR,\
-                                score, RUBRIC_SAVE_SEPARATOR, item.get_comment())
-                        else:
-                            return "%d%s%.2f%s%s\n"%(item.get_id(), RUBRIC_SAVE_SEPARATOR,\
-                                score, RUBRIC_SAVE_SEPARATOR, item.get_comment())
-                    else:
-                        return "%d%s%s%s\n"%(item.get_id(), RUBRIC_SAVE_SEPARATOR,\
-                            RUBRIC_SAVE_SEPARATOR, item.get_comment())
-            elif not item.has_own_field() and item.get_comment() != '':
-                if item.get_individual() is not None:
-                    return "%d%s%s%s%s%s\n"%(item.get_id(), RUBRIC_SAVE_SEPARATOR,\
-                        str(item.get_individual()), RUBRIC_SAVE_SEPARATOR,\
-                        RUBRIC_SAVE_SEPARATOR, item.get_comment())
-                else:
-                    return "%d%s%s%s\n"%(item.get_id(), RUBRIC_SAVE_SEPARATOR,\
-                        RUBRIC_SAVE_SEPARATOR, item.get_comment())
+    #Get every item in this rubric, keyed on (item id, individual)
+    def get_items_by_key(self):
+        ret = dict()
+        def action(item):
+            ret[item.get_key()] = item
+        self.total.traverse(action, ignore_blanks = False)
+        return ret
+
+    #Get the front matter, scores, comments and attachments in order, without
+    #which individual anything belongs to, so customized rubrics can be compared
+    def get_contents(self):
+        ret = [self.frontmatter_dict[fm] for fm in self.frontmatter]
+        def action(item):
+            if item.has_own_field():
+                ret.append((item.get_score(), item.get_comment()))
             else:
-                return ""
-        ret = ""
-        #Front matter
-        for fm in self.frontmatter:
-            fdv = self.frontmatter_dict[fm]
-            if fdv is not None:
-                ret += '%s%s%s%s\n'%(RUBRIC_FRONT_MATTER_SAVE_INDICATOR, fm,\
-                    RUBRIC_SAVE_SEPARATOR, fdv)
-        def accumulator(add_str):
-            nonlocal ret
-            ret += add_str
-        self.total.traverse(transcriber, accumulator, ignore_blanks = False)
-        #Add on attachments
-        for att in self.attachments:
-            ret += '%s%s\n'%(RUBRIC_ATTACHMENT_INDICATOR, att)
-        self.save()
+                ret.append((None, item.get_comment()))
+        self.total.traverse(action, ignore_blanks = False)
+        ret.append(frozenset(self.attachments))
         return ret
 
-    #Import a string created by export
-    def import_rubric(self, rubric_repr, old = False):
-        #Read in the things that need to be imported
-        lines = rubric_repr.split('\n')
-        insertions = dict()
-        for line in lines:
-            if line.strip() == '':
-                continue
-            line_pieces = line.split(get_rubric_save_separator(old))
-            if line_pieces[0][0] == get_rubric_front_matter_save_indicator(old):
-                #Front matter
-                self.frontmatter_dict[line_pieces[0][1:]] = line_pieces[1]
-                continue
-            elif line_pieces[0][0] == get_rubric_attachment_indicator(old):
-                #Attachment
-                self.attachments.add(line_pieces[0][1:])
+    #Get the items with their own scores, in menu order, and a label for each,
+    #like "SOFTWARE/Style", or "DEDUCTION (Ann Smith)" if it's individualized
+    def get_gradable_items(self):
+        items = []
+        self.total.traverse(lambda item: items.append(item))
+        individuals = dict()
+        def find_individuals(item, student):
+            if student is not None:
+                individuals[item] = student
+            if isinstance(item, Category):
+                for child_student, child in item.children.items():
+                    find_individuals(child, child_student)
+                for sub_item in item.items:
+                    find_individuals(sub_item, student)
+        find_individuals(self.total, None)
+        paths = self.get_paths()
+        labels = []
+        for item in items:
+            label = paths[item.get_id()]
+            if item in individuals:
+                label += " (%s)"%str(individuals[item])
+            labels.append(label)
+        return items, labels
+
+    #Enter several grades and comments on one line (see QUICK_ENTRY_HELP)
+    def quick_entry(self):
+        items, labels = self.get_gradable_items()
+        text = ""
+        while True:
+            try:
+                text = seeded_input("Grades (? for help, blank to cancel): ", text).strip()
+            except KeyboardInterrupt:
+                print("\nCanceled")
+                return
+            if text == '':
+                return
+            if text == '?':
+                print(QUICK_ENTRY_HELP + "\n")
+                text = ""
                 continue
-            the_id = int(line_pieces[0])
-            if len(line_pieces[1]) > 0 and not is_number(line_pieces[1]):
-                #We have an individualized thing
-                individual_str = line_pieces[1]
-                del line_pieces[1]
+            try:
+                entries = parse_quick_entry(text, items, labels)
+                break
+            except ValueError as err:
+                print("Error: %s"%str(err))
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            for item, score, comment in entries:
+                if score != QUICK_ENTRY_SKIP:
+                    item.set_score(score)
+                if comment is not None:
+                    item.set_comment(comment)
+        finally:
+            history.end_step()
+        for item, score, comment in entries:
+            label = labels[items.index(item)]
+            print("%s: %s/%s%s"%(label, '-' if item.get_score() is None else\
+                str(item.get_score()), score_to_string(item.get_value()),\
+                '' if comment is None else\
+                " \"%s\""%comment))
+        print()
+
+    #Get the path of each item by id, like "SOFTWARE/Style"
+    def get_paths(self):
+        paths = dict()
+        def find_paths(item, prefix):
+            paths[item.get_id()] = prefix + item.get_name()
+            if isinstance(item, Category):
+                for sub_item in item.items:
+                    find_paths(sub_item, '' if item is self.total else\
+                        paths[item.get_id()] + '/')
+        find_paths(self.total, '')
+        return paths
+
+    #Get the values of mail-merge fields for this rubric, as strings
+    #See MailMerge for the names; categories that share a name go by their
+    #path instead, like "SOFTWARE/Testing", numbered if that's shared too,
+    #like "Testing (2)"
+    #In a group's rubric, individualized categories list everyone's, like
+    #"Ann: 5, Bob: 4"
+    def get_merge_fields(self):
+        def fmt_score(score):
+            if score is None:
+                return ""
+            elif isinstance(score, int):
+                return str(score)
             else:
-                individual_str = None
-            the_score = line_pieces[1]
-            if the_score == '':
-                the_score = None
-            elif the_score.find('.') >= 0:
-                the_score = float(the_score)
+                return "%.2f"%score
+        fields = dict()
+        for fm in self.frontmatter:
+            fields[fm] = "" if self.frontmatter_dict[fm] is None else\
+                self.frontmatter_dict[fm]
+        #Each category (by id), with an entry per individual if it's individualized
+        by_id = dict()
+        ids_by_name = collections.defaultdict(set)
+        def action(item):
+            if isinstance(item, Category):
+                value = item.get_value()
+                by_id.setdefault(item.get_id(), []).append((item.get_individual(),\
+                    fmt_score(item.get_score()), fmt_score(value),\
+                    item.get_comment()))
+                ids_by_name[item.name].add(item.get_id())
+        self.total.traverse(action, ignore_blanks = False)
+        paths = self.get_paths()
+        names = dict([(item_id, name) for name in ids_by_name\
+            for item_id in ids_by_name[name]])
+        used = set()
+        for item_id, values in by_id.items():
+            name = names[item_id]
+            if len(ids_by_name[name]) > 1:
+                name = paths[item_id]
+                number = 1
+                while name in used:
+                    number += 1
+                    name = "%s (%d)"%(paths[item_id], number)
+            used.add(name)
+            if len(values) == 1 or values[0][0] is None:
+                individual, score, value, comment = values[0]
+                fields[name] = score
+                fields['comment:' + name] = comment
             else:
-                the_score = int(the_score)
-            the_comment = get_rubric_save_separator(old).join(line_pieces[2:])
-            insertions[(the_id, individual_str)] = (the_score, the_comment)
-        #Actually do the importing
-        def importer(item):
-            nonlocal insertions
-            if item.get_individual() is None:
-                key = (item.get_id(), None)
+                fields[name] = ', '.join(["%s: %s"%(individual.fname, score)\
+                    for individual, score, value, comment in values])
+                fields['comment:' + name] = ', '.join(["%s: %s"%(individual.fname,\
+                    comment) for individual, score, value, comment in values])
+            fields['max:' + name] = values[0][2]
+        fields['total'] = fmt_score(self.total.get_score())
+        fields['max'] = score_to_string(self.total.get_value())
+        return fields
+
+    #Get the saved contents of this rubric
+    def get_records(self):
+        records = RubricRecords()
+        for fm in self.frontmatter:
+            if self.frontmatter_dict[fm] is not None:
+                records.frontmatter[fm] = self.frontmatter_dict[fm]
+        def transcriber(item):
+            if item.has_own_field():
+                records.set_item(item.get_key(), item.get_score(), item.get_comment())
             else:
-                key = (item.get_id(), str(item.get_individual()))
-            if key in insertions:
+                records.set_item(item.get_key(), None, item.get_comment())
+        self.total.traverse(transcriber, ignore_blanks = False)
+        records.attachments = set(self.attachments)
+        return records
+
+    #Put saved contents into this rubric
+    #If replace, anything not in the records is cleared
+    def set_records(self, records, replace = False):
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            self.set_records_step(records, replace)
+        finally:
+            history.end_step()
+
+    def set_records_step(self, records, replace):
+        for fm in self.frontmatter:
+            if fm in records.frontmatter:
+                if self.frontmatter_dict[fm] != records.frontmatter[fm]:
+                    self.set_front_matter_value(fm, records.frontmatter[fm])
+            elif replace and self.frontmatter_dict[fm] is not None:
+                self.set_front_matter_value(fm, None)
+        for att in records.attachments - self.attachments:
+            self.set_attached(att, True)
+        if replace:
+            for att in self.attachments - records.attachments:
+                self.set_attached(att, False)
+        def importer(item):
+            key = item.get_key()
+            if key in records.items or replace:
                 #Insert it!
-                if item.has_own_field():
-                    item.set_score(insertions[key][0])
-                item.set_comment(insertions[key][1])
-                del insertions[key]
+                score, comment = records.get_item(key)
+                if item.has_own_field() and item.get_score() != score:
+                    item.set_score(score)
+                if item.get_comment() != comment:
+                    item.set_comment(comment)
         self.total.traverse(importer, ignore_blanks = False)
+
+    #Make the scores and comments (and front matter, if front_matter) match
+    #records from another rubric, setting only what's different
+    #Individualized categories are left alone, since they go with students
+    def copy_records(self, records, front_matter = False):
+        history = EditHistory.get_edit_history()
+        history.start_step()
+        try:
+            if front_matter:
+                for fm in self.frontmatter:
+                    if self.frontmatter_dict[fm] != records.frontmatter.get(fm):
+                        self.set_front_matter_value(fm, records.frontmatter.get(fm))
+            def importer(item):
+                if isinstance(item, Category) and len(item.children) > 0:
+                    return
+                score, comment = records.get_item(item.get_key())
+                if item.has_own_field() and item.get_score() != score:
+                    item.set_score(score)
+                if item.get_comment() != comment:
+                    item.set_comment(comment)
+                if isinstance(item, Category):
+                    for sub_item in item.items:
+                        importer(sub_item)
+            importer(self.total)
+        finally:
+            history.end_step()
+
+    #Convert to a string that can be imported
+    #If comment_table (a dict from comment to index) is given, comments are
+    #written as indices into it, and new comments are added to it
+    def export_rubric(self, comment_table = None):
+        ret = self.get_records().export(comment_table)
+        self.save()
+        return ret
+
+    #Import a string created by export
+    #If comment_table (a list of comments) is given, comments are
+    #stored as indices into it
+    def import_rubric(self, rubric_repr, old = False, comment_table = None):
+        self.set_records(RubricRecords.parse(rubric_repr, old, comment_table))
         self.save()
 
     #Get comma-separated list of categories
@@ -1500,8 +4406,8 @@ class Rubric:
             else:
                 score = "%.2f"%score
             if item == self.total:
-                ret.append("{\\Large \\textbf{%s}}&{\\Large \\textbf{%d}}&{\\Large \\textbf{%s}}&%s\\\\\\hline\n"\
-                    %(make_tex_word(item.get_name()), item.get_value(),\
+                ret.append("{\\Large \\textbf{%s}}&{\\Large \\textbf{%s}}&{\\Large \\textbf{%s}}&%s\\\\\\hline\n"\
+                    %(make_tex_word(item.get_name()), score_to_string(item.get_value()),\
                     score, make_tex_word(item.get_comment())))
                 return
             elif isinstance(item, Category):
@@ -1511,8 +4417,9 @@ class Rubric:
             else:
                 str1 = ""
                 str2 = ""
-            ret.append("\\textbf{%s}&%s%d%s&%s%s%s&%s\\\\\\hline\n"%\
-                (make_tex_word(item.get_name()), str1, item.get_value(), str2, str1, score,\
+            ret.append("\\textbf{%s}&%s%s%s&%s%s%s&%s\\\\\\hline\n"%\
+                (make_tex_word(item.get_name()), str1, score_to_string(item.get_value()),\
+                str2, str1, score,\
                 str2, make_tex_word(item.get_comment())))
         self.total.traverse(traverser, ignore_blanks = False)
         ret.append("&&&\\\\\\hline\n")
@@ -1522,6 +4429,86 @@ class Rubric:
         del ret[0]
         return '\n'.join(ret) + '\n'
 
+    #Get the rows of the grade table, in the same order as get_tex, with the
+    #total last: (name, out of, score, comment, kind), where kind is 'total',
+    #'category' or 'item'
+    def get_rows(self):
+        rows = []
+        def traverser(item):
+            score = item.get_score()
+            if score is None:
+                score = ""
+            elif isinstance(score, int):
+                score = str(score)
+            else:
+                score = "%.2f"%score
+            if item == self.total:
+                kind = 'total'
+            elif isinstance(item, Category):
+                kind = 'category'
+            else:
+                kind = 'item'
+            rows.append((item.get_name(), score_to_string(item.get_value()), score,\
+                item.get_comment().replace("\\n", "\n"), kind))
+        self.total.traverse(traverser, ignore_blanks = False)
+        rows.append(rows.pop(0))
+        return rows
+
+    #Get the lines at the top of the rubric, as in write_tex
+    def get_header_lines(self, student, group=None):
+        if group is None:
+            ret = ["%s %s"%(student.fname, student.lname)]
+        else:
+            ret = ["Group %d"%group.number]
+        for fm in self.frontmatter:
+            if self.frontmatter_dict[fm] is not None:
+                ret.append("%s: %s"%(fm, self.frontmatter_dict[fm]))
+        if group is not None:
+            ret.append("Members: %s"%', '.join(['%s %s'%(s.fname, s.lname)\
+                for s in group]))
+            ret.append("Graded Member: %s %s"%(student.fname, student.lname))
+        return ret
+
+    #Get the rubric as plain text, for the body of an email
+    def get_text(self, student, group=None):
+        rows = self.get_rows()
+        def get_name(row):
+            return ("  " if row[4] == 'item' else "") + row[0]
+        name_width = max([len(get_name(row)) for row in rows] + [5])
+        value_width = max([len(str(row[1])) for row in rows] + [5])
+        score_width = max([len(row[2]) for row in rows] + [6])
+        fmt = "%%-%ds  %%%ds  %%%ds  %%s"%(name_width, value_width, score_width)
+        ret = self.get_header_lines(student, group) + ['']
+        ret.append((fmt%("", "TOTAL", "POINTS", "COMMENTS")).rstrip())
+        for row in rows:
+            if row[4] != 'item':
+                ret.append('')
+            #Line up comments that span lines under the first one
+            comment = row[3].replace("\n", "\n" + " "*(name_width + value_width +\
+                score_width + 6))
+            ret.append((fmt%(get_name(row), row[1], row[2], comment)).rstrip())
+        return '\n'.join(ret) + '\n'
+
+    #Get the rubric as an HTML table, for the body of an email
+    def get_html(self, student, group=None):
+        ret = ['<p>%s</p>'%'<br>\n'.join(['<b>%s</b>'%html.escape(line) if i == 0 else\
+            html.escape(line) for i, line in\
+            enumerate(self.get_header_lines(student, group))])]
+        ret.append('<table border="1" cellpadding="4" style="border-collapse: collapse">')
+        ret.append('<tr><th></th><th>TOTAL</th><th>POINTS</th><th>COMMENTS</th></tr>')
+        for name, value, score, comment, kind in self.get_rows():
+            cells = [html.escape(name), str(value), html.escape(score),\
+                html.escape(comment).replace('\n', '<br>')]
+            cells[0] = '<b>%s</b>'%cells[0]
+            if kind != 'item':
+                cells[1] = '<b>%s</b>'%cells[1]
+                cells[2] = '<b>%s</b>'%cells[2]
+            if kind == 'total':
+                cells = ['<big>%s</big>'%cell for cell in cells[:3]] + cells[3:]
+            ret.append('<tr><td>%s</td></tr>'%'</td><td>'.join(cells))
+        ret.append('</table>')
+        return '\n'.join(ret) + '\n'
+
     #Write a .tex file for this rubric
     def write_tex(self, fname, student=None, group=None, header=None):
         with open(fname, 'w') as fd:
@@ -1646,8 +4633,131 @@ class Menu:
     def add_item(self, text, callback, *args):
         self.items.append(MenuItem(text, callback, *args))
 
+#Turn a grade as typed into a score: None if it's blank, and a float only if
+#it has a decimal point
+#Raises a ValueError if it can't be parsed
+def parse_grade(grade):
+    grade = grade.strip()
+    if len(grade) == 0:
+        return None
+    elif "." in grade:
+        return float(grade)
+    else:
+        return int(grade)
+
+#Parse a line of grades and comments for some items (see QUICK_ENTRY_HELP)
+#items and labels are from Rubric.get_gradable_items; scores without names
+#start at the first item with no score
+#Returns a list of (item, score, comment), where score is QUICK_ENTRY_SKIP if
+#it's not changing and comment is None if it's not changing
+#Raises a ValueError saying what's wrong
+QUICK_ENTRY_SKIP = '_'
+QUICK_ENTRY_TOKEN = re.compile(r'\s*(?:"([^"]*)"|([=:])|([^\s"=:]+))')
+def parse_quick_entry(text, items, labels):
+    #Tokens are (kind, text), where kind is 'quoted', 'symbol' or 'word'
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = QUICK_ENTRY_TOKEN.match(text, position)
+        if match is None:
+            raise ValueError("Unmatched quote: %s"%text[position:].strip())
+        if match.group(1) is not None:
+            tokens.append(('quoted', match.group(1)))
+        elif match.group(2) is not None:
+            tokens.append(('symbol', match.group(2)))
+        else:
+            tokens.append(('word', match.group(3)))
+        position = match.end()
+    #Items can go by their label, their path or just their name, if that's unique
+    by_name = collections.defaultdict(set)
+    for i in range(len(items)):
+        for name in [labels[i], labels[i].split(' (')[0], items[i].get_name()]:
+            by_name[name.lower()].add(i)
+    def find_item(name):
+        found = by_name.get(name.lower(), set())
+        if len(found) == 0:
+            raise ValueError("No item called %s"%name)
+        elif len(found) > 1:
+            raise ValueError("More than one item is called %s: %s"%(name,\
+                ', '.join([labels[i] for i in sorted(found)])))
+        return next(iter(found))
+    def read_score(token):
+        if token == QUICK_ENTRY_SKIP:
+            return QUICK_ENTRY_SKIP
+        try:
+            score = parse_grade(token)
+        except ValueError:
+            raise ValueError("Cannot parse grade: %s"%token)
+        if score is None:
+            raise ValueError("Missing grade")
+        return score
+    def is_score(token):
+        try:
+            read_score(token)
+            return True
+        except ValueError:
+            return False
+    #Entries by item index: [score, comment]
+    entries = dict()
+    def set_score(index, score):
+        entry = entries.setdefault(index, [QUICK_ENTRY_SKIP, None])
+        if entry[0] != QUICK_ENTRY_SKIP:
+            raise ValueError("Two grades for %s"%labels[index])
+        entry[0] = score
+    last = None
+    cursor = 0
+    while cursor < len(items) and items[cursor].get_score() is not None:
+        cursor += 1
+    i = 0
+    while i < len(tokens):
+        kind, token = tokens[i]
+        following = tokens[i + 1] if i + 1 < len(tokens) else (None, None)
+        if kind == 'symbol' and token == ':' or kind == 'quoted' and\
+                following != ('symbol', '=') and following != ('symbol', ':'):
+            #A comment for the last item
+            if kind == 'symbol':
+                i += 1
+                if i >= len(tokens) or tokens[i][0] == 'symbol':
+                    raise ValueError("Missing comment after :")
+                token = tokens[i][1]
+            if last is None:
+                raise ValueError("Comment \"%s\" comes before any item"%token)
+            if entries[last][1] is not None:
+                raise ValueError("Two comments for %s"%labels[last])
+            entries[last][1] = token
+            i += 1
+        elif kind == 'symbol':
+            raise ValueError("Unexpected %s"%token)
+        elif kind == 'word' and is_score(token) and following != ('symbol', '='):
+            #A score for the next item
+            if cursor >= len(items):
+                raise ValueError("More scores than items, starting at %s"%token)
+            last = cursor
+            set_score(last, read_score(token))
+            cursor += 1
+            i += 1
+        elif following == ('symbol', '='):
+            #A score by name, maybe with a comment right after
+            last = find_item(token)
+            if i + 2 >= len(tokens) or tokens[i + 2][0] != 'word':
+                raise ValueError("Missing grade after %s="%token)
+            set_score(last, read_score(tokens[i + 2][1]))
+            cursor = last + 1
+            i += 3
+        elif following == ('symbol', ':'):
+            #Just a comment, by name
+            last = find_item(token)
+            entries.setdefault(last, [QUICK_ENTRY_SKIP, None])
+            cursor = last + 1
+            i += 1
+        else:
+            raise ValueError("Not a grade or comment: %s"%token)
+    return [(items[index], entries[index][0], entries[index][1])\
+        for index in sorted(entries)]
+
 def assign_grade(item):
-    print("Grading %s, out of %d"%(item.get_name(), item.get_value()))
+    print("Grading %s, out of %s"%(item.get_name(), score_to_string(item.get_value())))
     msg = "Enter grade, blank to clear, or CTRL+C to cancel: "
     try:
         old_grade = item.get_score()
@@ -1656,15 +4766,8 @@ def assign_grade(item):
         else:
             old_grade = str(old_grade)
         grade = seeded_input(msg, old_grade)
-        if len(grade) == 0:
-            item.set_score(None)
-        else:
-            if "." in grade:
-                grade = float(grade)
-            else:
-                grade = int(grade)
-            item.set_score(grade)
-            #print(item.is_changed())
+        item.set_score(parse_grade(grade))
+        #print(item.is_changed())
     except KeyboardInterrupt:
         print("\nCanceled")
     except ValueError:
@@ -1673,18 +4776,14 @@ def assign_grade(item):
 def assign_comment(item):
     score = item.get_score()
     if score is not None:
-        if isinstance(score, int):
-            print("Comment for %s, score of %d/%d"%(item.get_name(),\
-                score, item.get_value()))
-        else:
-            print("Comment for %s, score of %.2f/%d"%(item.get_name(),\
-                score, item.get_value()))
+        print("Comment for %s, score of %s/%s"%(item.get_name(),\
+            score_to_string(score), score_to_string(item.get_value())))
     else:
         print("Comment for %s, score TBD"%item.get_name())
     msg = "Please enter comment, or CTRL+C to cancel: "
     old_comment = item.get_comment()
     try:
-        comment = seeded_input(msg, old_comment)
+        comment = comment_input(msg, item, old_comment)
     except KeyboardInterrupt:
         print("\nCanceled")
         return
@@ -1711,14 +4810,10 @@ class ChangingText:
 
 class EditMenu(Menu):
     def __init__(self, grade_item):
-        def score_to_string(score):
-            if isinstance(score, int):
-                return "%d"%score
-            else:
-                return "%.2f"%score
         super().__init__("Action on %s:"%grade_item.get_name(), menued = False)
         self.add_item(ChangingText("Grade", lambda item:\
-            "Update Grade (%s/%d)"%(score_to_string(item.get_score()), item.get_value()),\
+            "Update Grade (%s/%s)"%(score_to_string(item.get_score()),\
+            score_to_string(item.get_value())),\
             lambda item: item.get_score() is None, grade_item),\
             assign_grade, grade_item)
         self.add_item(ChangingText("Comment", lambda item:\
@@ -1760,6 +4855,62 @@ class MenuManager:
         while len(self.menu_stack) > 0:
             self.menu_stack[-1].prompt()
 
+#Class for an advisory lock file next to a save file,
+#so two sessions don't silently clobber the same save
+class SaveLock:
+    def __init__(self, file):
+        self.file = file
+        self.lock_file = file + SAVE_LOCK_EXTENSION
+        self.token = "%s@%s %d %s"%(getpass.getuser(), socket.gethostname(),\
+            os.getpid(), time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.held = False
+
+    #Get a description of who holds the lock, or None if nobody does
+    def get_holder(self):
+        try:
+            with open(self.lock_file, 'r') as fd:
+                return fd.read().strip()
+        except FileNotFoundError:
+            return None
+
+    #Is the lock held by a dead session on this machine?
+    def is_stale(self):
+        holder = self.get_holder()
+        if holder is None:
+            return True
+        pieces = holder.split()
+        if len(pieces) < 2 or not is_number(pieces[1]) or\
+                pieces[0].split('@')[-1] != socket.gethostname():
+            return False
+        try:
+            os.kill(int(pieces[1]), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    #Try to take the lock
+    #If force, take it even if someone else has it
+    def acquire(self, force = False):
+        try:
+            fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not force and not self.is_stale():
+                return False
+            fd = os.open(self.lock_file, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+        with os.fdopen(fd, 'w') as lfd:
+            lfd.write("%s\n"%self.token)
+        self.held = True
+        return True
+
+    #Give up the lock, if we still have it
+    def release(self):
+        if self.held:
+            self.held = False
+            if self.get_holder() == self.token:
+                os.remove(self.lock_file)
+
 class FileManager:
     FILE_KEY = "FILE"
     CSV_KEY = "CSV"
@@ -1770,6 +4921,37 @@ class FileManager:
             self.directory += os.sep
         self.files = dict({FileManager.FILE_KEY:None, FileManager.CSV_KEY:None,\
             FileManager.PDF_KEY:None})
+        #Lock on the current save file
+        self.lock = None
+
+    #Lock a save file, releasing the lock on the previous one
+    #Returns whether the file may be used
+    def lock_save_file(self, fil):
+        if self.lock is not None and self.lock.file == fil:
+            return True
+        new_lock = SaveLock(fil)
+        if not new_lock.acquire():
+            confirmed = False
+            def confirm(to_confirm):
+                nonlocal confirmed
+                confirmed = to_confirm
+            confirm_menu = Menu("Warning: %s is locked by %s. Use it anyway?"%\
+                (fil, new_lock.get_holder()), back = False)
+            confirm_menu.add_item("No", confirm, False)
+            confirm_menu.add_item("Yes", confirm, True)
+            confirm_menu.prompt()
+            if not confirmed:
+                return False
+            new_lock.acquire(force = True)
+        self.release_lock()
+        self.lock = new_lock
+        return True
+
+    #Release the lock on the current save file
+    def release_lock(self):
+        if self.lock is not None:
+            self.lock.release()
+            self.lock = None
 
     def get_cond_file(self, msg, key, exister = lambda a,s: a + s,\
             confirmer = "Warning: %s already exists. Overwrite?",
@@ -1809,13 +4991,20 @@ class FileManager:
                 return a + s
             else:
                 return a + s + extension
-        return self.get_cond_file("File to save into: ", FileManager.FILE_KEY,\
+        old_file = self.files[FileManager.FILE_KEY]
+        fil = self.get_cond_file("File to save into: ", FileManager.FILE_KEY,\
             save_as = save_as, exister = the_exister)
+        if fil is not None and extension == "" and not self.lock_save_file(fil):
+            self.files[FileManager.FILE_KEY] = old_file
+            return None
+        return fil
 
     def get_open_file(self):
         fil = files_input("File to open: ", self.directory)
         if not os.path.isfile(self.directory + fil):
             raise FileNotFoundError("File %s not found"%fil)
+        if not self.lock_save_file(self.directory + fil):
+            return None
         self.files[FileManager.FILE_KEY] = fil
         return self.directory + self.files[FileManager.FILE_KEY]
 
@@ -1842,6 +5031,156 @@ class FileManager:
             exister = lambda a, s: '.',\
             confirmer = "Warning: Prefix %s already in use. Overwrite?")
 
+#Class for a token bucket rate limiter that threads can share
+#Tokens come in at rate per second, and up to burst can pile up
+class RateLimiter:
+    def __init__(self, rate, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    #Wait until a token is available, then take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+#Class for sending emails in the background over a pool of SMTP connections,
+#no faster than the provider allows
+#Copies go in the Sent folder as with EmailManager.send_message
+#If outbox is given, messages are marked sent or failed in it
+#If report, a line is printed for every message
+class BackgroundSender:
+    def __init__(self, email_manager, outbox = None, report = True):
+        self.email_manager = email_manager
+        self.outbox = outbox
+        self.report = report
+        self.work = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.sent = 0
+        self.failures = []
+        self.limiter = RateLimiter(email_manager.messages_per_minute/60,\
+            burst = email_manager.max_connections)
+        self.threads = []
+        for i in range(email_manager.max_connections):
+            thread = threading.Thread(target = self.worker, daemon = True)
+            thread.start()
+            self.threads.append(thread)
+
+    #Queue up a message to send
+    def submit(self, email_msg):
+        self.submit_batch([email_msg])
+
+    #Queue up several messages to go together
+    #Delivering locally, they're handed over all at once (see
+    #EmailManager.deliver_locally); over SMTP, they're sent one by one
+    def submit_batch(self, email_msgs):
+        if len(email_msgs) == 0:
+            return
+        with self.lock:
+            self.pending += len(email_msgs)
+        self.work.put(list(email_msgs))
+
+    #Get how many messages are (pending, sent, failed)
+    def get_counts(self):
+        with self.lock:
+            return self.pending, self.sent, len(self.failures)
+
+    #Wait for everything to be sent
+    #Returns a list of (message, exception) for messages that failed
+    def finish(self):
+        for thread in self.threads:
+            self.work.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.failures
+
+    #Record that a message couldn't be sent (with self.lock held)
+    def record_failure(self, email_msg, err):
+        self.failures.append((email_msg, err))
+        self.pending -= 1
+        if self.outbox is not None:
+            self.outbox.mark_failed(email_msg, err)
+        if self.report:
+            print("Message to %s NOT sent: %s"%(email_msg['To'], str(err)))
+
+    #Record that a message was sent (with self.lock held)
+    def record_sent(self, email_msg):
+        #Record it right away, so it's never sent twice
+        if self.outbox is not None:
+            if self.email_manager.writes_files():
+                #Only written to a file, so a real mailing shouldn't skip it
+                self.outbox.discard(email_msg)
+            else:
+                self.outbox.mark_sent(email_msg)
+        self.pending -= 1
+        self.sent += 1
+        if self.report:
+            print("Message sent to %s"%email_msg['To'])
+
+    def worker(self):
+        manager = self.email_manager
+        smtp_server = None
+        try:
+            while True:
+                email_msgs = self.work.get()
+                if email_msgs is None:
+                    return
+                if manager.is_dummy():
+                    with self.lock:
+                        for email_msg in email_msgs:
+                            manager.send_message(email_msg)
+                            #Nothing was really sent, so a real mailing shouldn't skip it
+                            if self.outbox is not None:
+                                self.outbox.discard(email_msg)
+                            self.pending -= 1
+                            self.sent += 1
+                    continue
+                if manager.is_local():
+                    failures = manager.deliver_locally(email_msgs)
+                    errors = dict([(id(email_msg), err) for email_msg, err in failures])
+                    with self.lock:
+                        for email_msg in email_msgs:
+                            if id(email_msg) in errors:
+                                self.record_failure(email_msg, errors[id(email_msg)])
+                            else:
+                                self.record_sent(email_msg)
+                    continue
+                for email_msg in email_msgs:
+                    try:
+                        smtp_server = manager.send_with_retries(smtp_server, email_msg,\
+                            self.limiter)
+                    except OSError as err:
+                        smtp_server = None
+                        with self.lock:
+                            self.record_failure(email_msg, err)
+                        continue
+                    #IMAP connection can only be used by one thread at a time
+                    with self.lock:
+                        self.record_sent(email_msg)
+                        if manager.copy_to_sent:
+                            try:
+                                manager.copy_message_to_sent(email_msg)
+                            except (imaplib.IMAP4.error, ValueError, OSError) as err:
+                                print("Message to %s NOT copied to %s: %s"%\
+                                    (email_msg['To'], manager.sent_folder, str(err)))
+        finally:
+            if smtp_server is not None:
+                try:
+                    smtp_server.quit()
+                except smtplib.SMTPException:
+                    pass
+
 #Class for error for exiting email early
 class EmailManagerCanceled(Exception):
     def __init__(self, msg):
@@ -1850,12 +5189,30 @@ class EmailManagerCanceled(Exception):
 #Class for managing email stuff
 class EmailManager:
     dummy_mode = 'Dummy'
+    #Modes that deliver without any servers or passwords
+    maildir_mode = 'Maildir'
+    eml_mode = 'EML'
+    sendmail_mode = 'Sendmail'
+    local_modes = {
+        maildir_mode:"Maildir to write into: ",
+        eml_mode:"Directory to write .eml files into: ",
+        sendmail_mode:"Sendmail command: "
+    }
     known_modes = {
         'Gmail':['imap.gmail.com', 'SSL', 'smtp.gmail.com', 'SSL', 'Sent'],
         'Microsoft':['outlook.office365.com', 'SSL', 'smtp.office365.com',\
             'STARTTLS', 'Sent Items']
     }
-    def __init__(self, from_file = None, special_mode = None, verbose = False):
+    #Messages per minute and simultaneous SMTP connections allowed
+    known_send_limits = {
+        'Gmail':[60, 3],
+        'Microsoft':[30, 3]
+    }
+    default_send_limits = [30, 2]
+    #If copy_to_sent is off, sent messages aren't stored in the Sent folder
+    #(e.g. Gmail already does that for messages sent through SMTP)
+    def __init__(self, from_file = None, special_mode = None, verbose = False,\
+            copy_to_sent = True):
         def get_out():
             raise EmailManagerCanceled("Canceled Email Setup")
         def get_out_prompt(menu):
@@ -1865,15 +5222,7 @@ class EmailManager:
                 get_out()
         ok = False
         the_file = from_file
-        self.name = ""
-        self.email = ""
-        self.imap = ""
-        self.smtp = ""
-        self.sent_folder = "Sent"
-        self.verbose = verbose
-        self.imap_server = None
-        self.smtp_server = None
-        self.dummy = False
+        self.set_defaults(verbose, copy_to_sent)
         while not ok:
             if special_mode == EmailManager.dummy_mode:
                 self.dummy = True
@@ -1887,11 +5236,14 @@ class EmailManager:
                 self.email = seeded_input("Enter your email address: ", self.email)
                 if special_mode in EmailManager.known_modes:
                     #Gmail or Microsoft
-                    self.imap = EmailManager.known_modes[special_mode][0]
-                    self.imap_auth = EmailManager.known_modes[special_mode][1]
-                    self.smtp = EmailManager.known_modes[special_mode][2]
-                    self.smtp_auth = EmailManager.known_modes[special_mode][3]
-                    self.sent_folder = EmailManager.known_modes[special_mode][4]
+                    self.set_known_mode(special_mode)
+                elif special_mode in EmailManager.local_modes:
+                    #Maildir, .eml files or sendmail
+                    self.mode = special_mode
+                    if self.destination == "" and special_mode == EmailManager.sendmail_mode:
+                        self.destination = SENDMAIL_COMMAND
+                    self.destination = seeded_input(\
+                        EmailManager.local_modes[special_mode], self.destination)
                 else:
                     #IMAP server
                     self.imap = seeded_input("IMAP server: ", self.imap)
@@ -1925,8 +5277,15 @@ class EmailManager:
 
                     if lines[0] in EmailManager.known_modes:
                         #First line is Gmail or Microsoft
+                        self.set_known_mode(lines[0])
+                        self.name = lines[1]
+                        self.email = lines[2]
+                    elif lines[0] in EmailManager.local_modes:
+                        #First line is Maildir, EML or Sendmail
+                        self.mode = lines[0]
                         self.name = lines[1]
                         self.email = lines[2]
+                        self.destination = lines[3]
                     else:
                         self.name = lines[0]
                         self.email = lines[1]
@@ -1946,9 +5305,12 @@ class EmailManager:
             print()
             print("Name: %s"%self.name)
             print("Email: %s"%self.email)
-            print("IMAP: %s, Auth = %s"%(self.imap, self.imap_auth))
-            print("SMTP: %s, Auth = %s"%(self.smtp, self.smtp_auth))
-            print("Sent folder: %s"%self.sent_folder)
+            if self.is_local():
+                print("%s: %s"%(self.mode, self.destination))
+            else:
+                print("IMAP: %s, Auth = %s"%(self.imap, self.imap_auth))
+                print("SMTP: %s, Auth = %s"%(self.smtp, self.smtp_auth))
+                print("Sent folder: %s"%self.sent_folder)
             print()
             ok_menu = Menu("Everything look ok?", back = False)
             ok_menu.add_item("Yes", lambda : None)
@@ -1956,7 +5318,8 @@ class EmailManager:
             ok_menu.add_item("Cancel", get_out)
             get_out_prompt(ok_menu)
 
-        ok = False
+        #Nothing to log into locally
+        ok = self.is_local()
         sent_changed = False
         while not ok:
             try:
@@ -1966,7 +5329,8 @@ class EmailManager:
                 sent_changed = False
                 #Try logging into IMAP server
                 try:
-                    self.imap_login()
+                    if self.copy_to_sent:
+                        self.imap_login()
                     try:
                         self.smtp_login()
                     except smtplib.SMTPException:
@@ -2001,9 +5365,13 @@ class EmailManager:
                         overwrite_warning_menu.prompt()
                         raise EmailManagerCanceled("Entered existing filename")
                 with open(fname, 'w') as cfd:
-                    for item in [self.name, self.email, self.imap,\
+                    if self.is_local():
+                        items = [self.mode, self.name, self.email, self.destination]
+                    else:
+                        items = [self.name, self.email, self.imap,\
                             self.imap_auth, self.smtp, self.smtp_auth,\
-                            self.sent_folder]:
+                            self.sent_folder]
+                    for item in items:
                         cfd.write("%s\n"%item)
             save_config_menu.add_item("No", lambda : None)
             save_config_menu.add_item("Yes", save_email_config)
@@ -2012,6 +5380,52 @@ class EmailManager:
             except EmailManagerCanceled:
                 pass
 
+    #Settings before anything is entered
+    def set_defaults(self, verbose, copy_to_sent):
+        self.name = ""
+        self.email = ""
+        self.imap = ""
+        self.smtp = ""
+        self.sent_folder = "Sent"
+        self.verbose = verbose
+        self.copy_to_sent = copy_to_sent
+        self.messages_per_minute, self.max_connections =\
+            EmailManager.default_send_limits
+        self.imap_server = None
+        self.smtp_server = None
+        self.dummy = False
+        #One of local_modes, or None to use the servers
+        self.mode = None
+        self.destination = ""
+
+    #Make a manager from the given settings, without any prompts or logging in
+    #(for scripts, like the email benchmark)
+    #Servers can be "host" or "host:port"
+    @staticmethod
+    def from_settings(name, email, password, imap, imap_auth, smtp, smtp_auth,\
+            sent_folder = "Sent", verbose = False, copy_to_sent = True):
+        manager = EmailManager.__new__(EmailManager)
+        manager.set_defaults(verbose, copy_to_sent)
+        manager.name = name
+        manager.email = email
+        manager.password = password
+        manager.imap = imap
+        manager.imap_auth = imap_auth
+        manager.smtp = smtp
+        manager.smtp_auth = smtp_auth
+        manager.sent_folder = sent_folder
+        return manager
+
+    #Use the servers and limits of Gmail or Microsoft
+    def set_known_mode(self, mode):
+        self.imap = EmailManager.known_modes[mode][0]
+        self.imap_auth = EmailManager.known_modes[mode][1]
+        self.smtp = EmailManager.known_modes[mode][2]
+        self.smtp_auth = EmailManager.known_modes[mode][3]
+        self.sent_folder = EmailManager.known_modes[mode][4]
+        self.messages_per_minute, self.max_connections =\
+            EmailManager.known_send_limits[mode]
+
     #Get your name
     def get_name(self):
         return self.name
@@ -2022,11 +5436,16 @@ class EmailManager:
 
     #Log into both servers
     def login(self):
-        self.imap_login()
+        if self.is_local():
+            return
+        if self.copy_to_sent:
+            self.imap_login()
         self.smtp_login()
 
     #Log out from both servers
     def logout(self):
+        if self.is_local():
+            return
         self.imap_logout()
         self.smtp_logout()
 
@@ -2045,11 +5464,16 @@ class EmailManager:
             return
         #Initialize/Authenticate
         if self.imap_auth == 'SSL':
-            self.imap_server = imaplib.IMAP4_SSL(host=self.imap)
+            host, port = split_server(self.imap, imaplib.IMAP4_SSL_PORT)
+            self.imap_server = imaplib.IMAP4_SSL(host=host, port=port)
         else:
-            self.imap_server = imaplib.IMAP4(host=self.imap)
+            host, port = split_server(self.imap, imaplib.IMAP4_PORT)
+            self.imap_server = imaplib.IMAP4(host=host, port=port)
             if self.imap_auth == 'STARTTLS':
                 self.imap_server.starttls()
+        #imaplib sends the end of an APPEND separately from the message, so
+        #don't let it wait for the server to acknowledge the message first
+        self.imap_server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         if self.verbose:
             print("Logging into IMAP...")
         #Log in to server
@@ -2061,12 +5485,9 @@ class EmailManager:
             sel = self.imap_server.select('"%s"'%self.sent_folder)
             if sel[0] != 'OK':
                 raise ValueError("Invalid Sent folder: %s"%str(sel))
-            elif verbose:
+            elif self.verbose:
                 print("Selected Sent folder: %s"%self.sent_folder)
-            val = sel[1][0]
-            self.message_count_init = int(val)
-            if verbose:
-                print("%d messages in %s\n"%(self.message_count_init, self.sent_folder))
+                print("%d messages in %s\n"%(int(sel[1][0]), self.sent_folder))
         except:
             self.imap_server = None
             raise
@@ -2084,23 +5505,30 @@ class EmailManager:
             if self.verbose:
                 print("SMTP: Already logged in")
             return
+        self.smtp_server = self.new_smtp_connection()
+
+    #Open and log into a new connection to the SMTP server
+    def new_smtp_connection(self):
         #Initialize/Authenticate
         if self.smtp_auth == 'SSL':
-            self.smtp_server = smtplib.SMTP_SSL(host=self.smtp)
+            host, port = split_server(self.smtp, smtplib.SMTP_SSL_PORT)
+            smtp_server = smtplib.SMTP_SSL(host=host, port=port)
         else:
-            self.smtp_server = smtplib.SMTP(host=self.smtp)
+            host, port = split_server(self.smtp, smtplib.SMTP_PORT)
+            smtp_server = smtplib.SMTP(host=host, port=port)
             if self.smtp_auth == 'STARTTLS':
-                self.smtp_server.starttls()
+                smtp_server.starttls()
         if self.verbose:
             print("Logging into SMTP...")
         #Log in to server
         try:
-            self.smtp_server.login(self.email, self.password)
+            smtp_server.login(self.email, self.password)
             if self.verbose:
                 print("Logged in!\n")
         except:
-            self.smtp_server = None
+            smtp_server.close()
             raise
+        return smtp_server
 
     #Log out from IMAP server
     def imap_logout(self):
@@ -2117,7 +5545,7 @@ class EmailManager:
     #Log out from SMTP server
     def smtp_logout(self):
         if self.dummy:
-            if verbose:
+            if self.verbose:
                 print("Dummy: smtp logout")
             return
         if self.smtp_server is not None:
@@ -2131,50 +5559,196 @@ class EmailManager:
             self.smtp_server = None
 
     #Send the email message
-    #Store a copy in the sent folder
+    #Store a copy in the sent folder, unless copy_to_sent is off
     def send_message(self, email_msg):
         if self.dummy:
             if self.verbose:
                 print("Dummy: send message")
             return
+        if self.is_local():
+            failures = self.deliver_locally([email_msg])
+            if len(failures) > 0:
+                raise failures[0][1]
+            return
+        #SMTP stuff
+        self.smtp_server.send_message(email_msg)
+        print("Message sent")
         #IMAP stuff
-        #Copy the message
+        #It's already sent, so failing to copy it mustn't look like failing to send
+        if self.copy_to_sent:
+            try:
+                self.copy_message_to_sent(email_msg)
+            except (imaplib.IMAP4.error, ValueError, OSError) as err:
+                print("Message to %s NOT copied to %s: %s"%(email_msg['To'],\
+                    self.sent_folder, str(err)))
+
+    #Store a copy of a message in the sent folder, already marked as read
+    #Returns the UID of the copy if the server reports it (UIDPLUS), or None
+    def copy_message_to_sent(self, email_msg):
         date = imaplib.Time2Internaldate(time.time())
-        app = self.imap_server.append('"%s"'%self.sent_folder, None, date, bytes(email_msg))
+        app = self.imap_server.append('"%s"'%self.sent_folder, '(\\Seen)', date,\
+            bytes(email_msg))
         if app[0] != 'OK':
             raise ValueError("Copying to %s failed: %s"%(self.sent_folder, str(app)))
-        if verbose:
-            print("Message copied to %s"%self.sent_folder)
-        #Mark it as read
-        try:
-            srch = self.imap_server.search(None, '(UNSEEN)')
-            if srch[0] != 'OK':
-                raise(ValueError("Search for unread messages failed: %s"%str(srch)))
-            for msg in srch[1]:
+        uid = None
+        if 'UIDPLUS' in self.imap_server.capabilities:
+            #Response looks like [APPENDUID <uidvalidity> <uid>] ...
+            for resp in app[1]:
+                if isinstance(resp, bytes):
+                    match = re.search(rb'APPENDUID \d+ (\d+)', resp)
+                    if match:
+                        uid = int(match.group(1))
+                        break
+        if self.verbose:
+            if uid is None:
+                print("Message copied to %s"%self.sent_folder)
+            else:
+                print("Message copied to %s (UID %d)"%(self.sent_folder, uid))
+        return uid
+
+    #Send one message over smtp_server (None to connect first), retrying
+    #temporary failures with backoff and reconnecting if disconnected
+    #Returns the connection to keep using
+    def send_with_retries(self, smtp_server, email_msg, limiter):
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                if smtp_server is None:
+                    smtp_server = self.new_smtp_connection()
+                smtp_server.send_message(email_msg)
+                return smtp_server
+            except smtplib.SMTPResponseException as err:
+                #4xx codes are temporary
+                error = err
+                temporary = 400 <= err.smtp_code < 500
+            except smtplib.SMTPServerDisconnected as err:
+                error = err
+                temporary = True
+                smtp_server = None
+            except smtplib.SMTPException as err:
+                error = err
+                temporary = False
+            except OSError as err:
+                #Network trouble
+                error = err
+                temporary = True
+                smtp_server = None
+            attempt += 1
+            if not temporary or attempt > EMAIL_SEND_RETRIES:
+                if smtp_server is not None:
+                    try:
+                        smtp_server.quit()
+                    except smtplib.SMTPException:
+                        pass
+                raise error
+            if self.verbose:
+                print("Temporary failure sending to %s (%s); retrying"%\
+                    (email_msg['To'], str(error)))
+            time.sleep(EMAIL_SEND_BACKOFF*2**(attempt - 1))
+
+    #Send a batch of approved messages; see BackgroundSender
+    #Returns a list of (message, exception) for messages that failed
+    def send_batch(self, email_msgs, outbox = None):
+        sender = BackgroundSender(self, outbox)
+        if self.is_local():
+            for start in range(0, len(email_msgs), SENDMAIL_BATCH):
+                sender.submit_batch(email_msgs[start:start + SENDMAIL_BATCH])
+        else:
+            for email_msg in email_msgs:
+                sender.submit(email_msg)
+        return sender.finish()
+
+    #Write messages into the Maildir or the .eml directory, or hand them to
+    #the sendmail command, without any servers
+    #Returns a list of (message, exception) for messages that failed
+    def deliver_locally(self, email_msgs):
+        failures = []
+        if self.mode == EmailManager.sendmail_mode:
+            for start in range(0, len(email_msgs), SENDMAIL_BATCH):
+                failures += self.pipe_to_sendmail(email_msgs[start:start + SENDMAIL_BATCH])
+        elif self.mode == EmailManager.maildir_mode:
+            try:
+                maildir = mailbox.Maildir(self.destination, create = True)
+            except OSError as err:
+                return [(email_msg, err) for email_msg in email_msgs]
+            for email_msg in email_msgs:
                 try:
-                    if int(msg) >= self.message_count_init:
-                        stor = self.imap_server.store(msg, '+FLAGS', '\\Seen')
-                        if stor[0] != 'OK':
-                            raise(ValueError("Failed to mark message as read: %s"%str(stor)))
-                    elif verbose:
-                        print(int(msg), srch)
-                        print("Message marked as read")
-                except ValueError:
-                    raise(ValueError("Failed to mark message as read, weird error: %s"%str(msg)))
-        except ValueError as er:
-            print("Message NOT marked as read")
-            print("Exception: ")
-            print(er)
-            print()
-
-        #SMTP stuff
-        self.smtp_server.send_message(email_msg)
-        print("Message sent")
+                    maildir.add(email_msg)
+                except OSError as err:
+                    failures.append((email_msg, err))
+        else:
+            for email_msg in email_msgs:
+                try:
+                    self.write_eml(email_msg)
+                except OSError as err:
+                    failures.append((email_msg, err))
+        if self.verbose:
+            print("%s: %d messages delivered to %s"%(self.mode,\
+                len(email_msgs) - len(failures), self.destination))
+        return failures
+
+    #Write a message to an .eml file named after whoever it's to
+    #Writing the same message again replaces the old file
+    def write_eml(self, email_msg):
+        os.makedirs(self.destination, exist_ok = True)
+        addresses = [addr for name, addr in email.utils.getaddresses([email_msg['To']])]
+        fname = os.path.join(self.destination,\
+            re.sub(r'[^\w@.+-]', '_', ','.join(addresses)) + '.eml')
+        tmp_fname = "%s.%d.tmp"%(fname, os.getpid())
+        with open(tmp_fname, 'wb') as fd:
+            fd.write(bytes(email_msg))
+        os.replace(tmp_fname, fname)
+
+    #Run the sendmail command for each message all at once, and wait for them
+    #Returns a list of (message, exception) for messages that failed
+    def pipe_to_sendmail(self, email_msgs):
+        args = shlex.split(self.destination)
+        failures = []
+        procs = []
+        for email_msg in email_msgs:
+            try:
+                proc = subprocess.Popen(args, stdin = subprocess.PIPE,\
+                    stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+            except OSError as err:
+                failures.append((email_msg, err))
+                continue
+            procs.append((email_msg, proc))
+        if len(procs) == 0:
+            return failures
+        #Feed each one its message while reading what it says, so none of them
+        #can get stuck writing to a full stderr
+        def feed(email_msg, proc):
+            return proc.communicate(bytes(email_msg))[1]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(procs)) as executor:
+            results = [executor.submit(feed, email_msg, proc) for email_msg, proc in procs]
+            for (email_msg, proc), result in zip(procs, results):
+                err_text = result.result().decode('utf-8', 'replace').strip()
+                if proc.returncode != 0:
+                    failures.append((email_msg, OSError("%s exited with status %d: %s"\
+                        %(args[0], proc.returncode, err_text))))
+        return failures
 
     #Is this manager a dummy?
     def is_dummy(self):
         return self.dummy
 
+    #Does this manager deliver locally instead of through the servers?
+    def is_local(self):
+        return self.mode in EmailManager.local_modes
+
+    #Does this manager only write files, so nothing actually gets sent?
+    def writes_files(self):
+        return self.mode in [EmailManager.maildir_mode, EmailManager.eml_mode]
+
+#Split a server like "host:port" into (host, port)
+#If there's no port, it's default_port
+def split_server(server, default_port):
+    host, sep, port = server.rpartition(':')
+    if sep == '' or not port.isdigit():
+        return server, default_port
+    return host, int(port)
+
 def print_delay(stuff):
     print(stuff)
     input("Press [ENTER] to continue...")
@@ -2186,14 +5760,21 @@ if __name__ == '__main__':
     #After -r should be rubric file
     #After -s should be students file
     #Can also have -v (verbose)
+    #Can also have -n (don't copy sent emails to the Sent folder)
     #Can also have -o
     #-o followed by folder where stuff should be stored (default is current dir)
+    #Or, -g followed by a gradebook file (see Gradebook) instead of -r, to
+    #write a .csv of every assignment's grades and exit
     rubric_file = None
+    gradebook_file = None
     student_file = None
     verbose = False
+    copy_to_sent = True
     out_dir = '.'
     usage_str = 'usage: python3 rubric-grading.py -r rubric_file -s '\
-        'student_file [-v] [-o output directory]\n'
+        'student_file [-v] [-n] [-o output directory]\n'\
+        '       python3 rubric-grading.py -g gradebook_file -s '\
+        'student_file [-o output directory]\n'
     if len(sys.argv) == 1:
         #No arguments provided
         #Display usage string
@@ -2204,6 +5785,8 @@ if __name__ == '__main__':
         if arg[0] == '-':
             if arg == '-v':
                 verbose = True
+            elif arg == '-n':
+                copy_to_sent = False
             else:
                 flag = arg
         else:
@@ -2213,11 +5796,24 @@ if __name__ == '__main__':
                 student_file = arg
             elif flag == '-o':
                 out_dir = arg
+            elif flag == '-g':
+                gradebook_file = arg
             else:
                 print('Unexpected argument: %s'%arg)
                 print(usage_str)
                 sys.exit(0)
             flag = None
+    if gradebook_file is not None:
+        if student_file is None:
+            print('Error: No students provided')
+            print(usage_str)
+            sys.exit(0)
+        csv_file = os.path.basename(gradebook_file)
+        if '.' in csv_file:
+            csv_file = csv_file[:csv_file.rfind('.')]
+        Gradebook(gradebook_file).export_csv(student_file,\
+            os.path.join(out_dir, csv_file + '.csv'))
+        sys.exit(0)
     if rubric_file is None:
         print('Error: No rubric provided')
         print(usage_str)
@@ -2249,6 +5845,7 @@ if __name__ == '__main__':
 
     #Stuff for saving when exiting
     file_manager = FileManager(out_dir)
+    atexit.register(file_manager.release_lock)
     def save(save_as=False):
         try:
             fil = file_manager.get_save_file(save_as)
@@ -2284,6 +5881,8 @@ if __name__ == '__main__':
             return
         except KeyboardInterrupt:
             return
+        if fil is None:
+            return
         try:
             roster.load(fil)
         except KeyError:
@@ -2339,40 +5938,669 @@ if __name__ == '__main__':
     main_menu.add_item(ChangingText("Quit", "Quit*", is_saved), exit_with_save_prompt)
     main_menu.add_item("Display Roster", print_delay, roster)
     main_menu.add_item("Display Rubric", print_delay, rubric)
-    #Menu for viewing student rubrics
-    student_menu = Menu("Select a student:", menued = False)
     def print_rubric(entity):
         print_delay(roster.get_rubric(entity))
-    for student in roster.get_students():
-        student_menu.add_item(MenuEntityTextUpdater(student), print_rubric, student)
+    def grade_entity(entity):
+        #So comments given to others can be suggested
+        roster.get_index(CommentBank)
+        roster.get_rubric(entity).grade()
+    #Menu for viewing student rubrics
+    student_menu = Menu("Select a student:", menued = False)
     #main_menu.add_item("View Rubric by Student", menu_manager.add_menu, student_menu)
     main_menu.add_item("View Rubric by Student", student_menu.prompt)
     if roster.is_using_groups():
         #Menu for viewing group rubrics
         group_menu = Menu("Select a group:", menued = False)
-        for group in roster:
-            group_menu.add_item(MenuEntityTextUpdater(group), print_rubric, group)
         #main_menu.add_item("View Rubric by Group", menu_manager.add_menu, group_menu)
         main_menu.add_item("View Rubric by Group", group_menu.prompt)
         #Menu for editing rubrics
         grade_menu = Menu("Select a group:")
-        for group in roster:
-            grade_menu.add_item(MenuEntityTextUpdater(group),\
-                roster.get_rubric(group).grade)
         main_menu.add_item("Grade a group", menu_manager.add_menu, grade_menu)
     else:
         #Menu for editing rubrics
         grade_menu = Menu("Select a student:")
-        for student in roster:
-            grade_menu.add_item(MenuEntityTextUpdater(student),\
-                roster.get_rubric(student).grade)
         main_menu.add_item("Grade a student", menu_manager.add_menu, grade_menu)
+    #Fill in (or refill, if the roster changed) the menus of entities
+    def fill_entity_menus():
+        #Keep the Back items
+        del student_menu.items[1:]
+        del grade_menu.items[1:]
+        for student in roster.get_students():
+            student_menu.add_item(MenuEntityTextUpdater(student), print_rubric, student)
+        if roster.is_using_groups():
+            del group_menu.items[1:]
+            for group in roster:
+                group_menu.add_item(MenuEntityTextUpdater(group), print_rubric, group)
+        for entity in roster:
+            grade_menu.add_item(MenuEntityTextUpdater(entity), grade_entity, entity)
+    fill_entity_menus()
+    #Grade whoever matches a search
+    def search_roster():
+        try:
+            query = input_query(roster.blank_rubric)
+        except KeyboardInterrupt:
+            print()
+            return
+        if query is None:
+            return
+        entities = roster.select_entities(query)
+        if len(entities) == 0:
+            print("Nobody matches %s\n"%query)
+            return
+        if roster.is_using_groups():
+            results_menu = Menu("Select a group matching %s:"%query)
+        else:
+            results_menu = Menu("Select a student matching %s:"%query)
+        for entity in entities:
+            results_menu.add_item(MenuEntityTextUpdater(entity), grade_entity, entity)
+        menu_manager.add_menu(results_menu)
+    main_menu.add_item("Search Roster", search_roster)
+    #Find comments by the words in them, and change them all at once
+    def search_comments():
+        try:
+            text = input("Words to find in comments: ").strip()
+        except KeyboardInterrupt:
+            print()
+            return
+        if text == '':
+            return
+        index = roster.get_index(CommentIndex)
+        matches = index.search(text)
+        if len(matches) == 0:
+            print("No comments mention %s\n"%text)
+            return
+        for item in matches:
+            score = item.get_score()
+            print("%s [%s/%s]\n    %s"%(index.describe(item), '-' if score is None else\
+                str(score), score_to_string(item.get_value()), item.get_comment()))
+        print("\n%d comment%s\n"%(len(matches), '' if len(matches) == 1 else 's'))
+        def replace_text():
+            try:
+                old = seeded_input("Text to replace: ", text)
+                new = input("Replace with: ")
+            except KeyboardInterrupt:
+                print()
+                return
+            if old != '':
+                changed = CommentIndex.replace(matches, old, new)
+                print("Changed %d comment%s\n"%(changed, '' if changed == 1 else 's'))
+        def set_all():
+            try:
+                comment = seeded_input("Comment to give: ", matches[0].get_comment())
+            except KeyboardInterrupt:
+                print()
+                return
+            history = EditHistory.get_edit_history()
+            history.start_step()
+            try:
+                for item in matches:
+                    item.set_comment(comment)
+            finally:
+                history.end_step()
+        comment_menu = Menu("Select option:", menued = False)
+        comment_menu.add_item("Replace text in these comments", replace_text)
+        comment_menu.add_item("Set all these comments", set_all)
+        comment_menu.prompt()
+    main_menu.add_item("Search Comments", search_comments)
+    #Grade one cell after another, asking only for what each one needs: one
+    #item for everyone, or (if item_id is None) whatever's left in order
+    def grade_cells(item_id):
+        queue = roster.get_index(GradingQueue)
+        #So comments given to others can be suggested
+        roster.get_index(CommentBank)
+        queue.unskip()
+        print("Blank to skip, CTRL+C to stop; full marks don't ask for a comment\n")
+        while True:
+            cell = queue.peek(item_id)
+            if cell is None:
+                print("Nothing left to grade%s\n"%('' if queue.count(item_id) == 0\
+                    else " but what was skipped"))
+                return
+            item = cell[2]
+            print("%s (out of %s, %d left)"%(queue.describe(cell),\
+                score_to_string(item.get_value()),\
+                queue.count(item_id)))
+            try:
+                score = parse_grade(input("Score: "))
+            except KeyboardInterrupt:
+                print("\n")
+                return
+            except ValueError:
+                print("Error: Cannot parse grade\n")
+                continue
+            if score is None:
+                queue.skip(item_id)
+                print()
+                continue
+            history = EditHistory.get_edit_history()
+            history.start_step()
+            try:
+                item.set_score(score)
+                if score != item.get_value():
+                    try:
+                        comment = comment_input("Comment: ", item, item.get_comment())
+                        if comment != item.get_comment():
+                            item.set_comment(comment)
+                    except KeyboardInterrupt:
+                        print()
+            finally:
+                history.end_step()
+            print()
+    def grade_by_item():
+        queue = roster.get_index(GradingQueue)
+        item_menu = Menu("Grade which item for everyone?", menued = False)
+        item_menu.add_item("Whatever's next (%d left)"%queue.count(), grade_cells, None)
+        for item_id in queue.item_ids:
+            item_menu.add_item("%s (%d left)"%(queue.paths[item_id], queue.count(item_id)),\
+                grade_cells, item_id)
+        item_menu.prompt()
+    main_menu.add_item("Grade by Item", grade_by_item)
+    #Copy one rubric's grades to others, e.g. for identical submissions
+    def choose_entity(msg):
+        chosen = None
+        def choose(entity):
+            nonlocal chosen
+            chosen = entity
+        entity_menu = Menu(msg, menued = False)
+        for entity in roster:
+            entity_menu.add_item(MenuEntityTextUpdater(entity), choose, entity)
+        entity_menu.prompt()
+        return chosen
+    #Read numbers like "1 3 5-7" for entities in a list, starting from 1
+    def parse_entity_numbers(text, entities):
+        chosen = []
+        for piece in text.replace(',', ' ').split():
+            ends = piece.split('-')
+            if len(ends) > 2 or not all([end.isdigit() for end in ends]):
+                raise ValueError("Not a number or range: %s"%piece)
+            first, last = int(ends[0]), int(ends[-1])
+            if first < 1 or last > len(entities) or first > last:
+                raise ValueError("Out of range: %s"%piece)
+            chosen += entities[first - 1:last]
+        return chosen
+    def clone_grades():
+        source = choose_entity("Copy grades from:")
+        if source is None:
+            return
+        targets = None
+        def choose_some():
+            nonlocal targets
+            entities = [entity for entity in roster if entity != source]
+            for i in range(len(entities)):
+                print("%3d: %s"%(i + 1, str(MenuEntityTextUpdater(entities[i]))))
+            while True:
+                try:
+                    text = input("Copy to (numbers like 1 3 5-7): ")
+                except KeyboardInterrupt:
+                    print()
+                    return
+                try:
+                    targets = parse_entity_numbers(text, entities)
+                    return
+                except ValueError as err:
+                    print("Error: %s"%str(err))
+        def choose_matching():
+            nonlocal targets
+            try:
+                query = input_query(roster.blank_rubric)
+            except KeyboardInterrupt:
+                print()
+                return
+            if query is not None:
+                targets = roster.select_entities(query)
+        def choose_everyone():
+            nonlocal targets
+            targets = list(roster)
+        to_menu = Menu("Copy grades from %s to:"%str(source), menued = False)
+        to_menu.add_item("Some (by number)", choose_some)
+        to_menu.add_item("Everyone matching a search", choose_matching)
+        to_menu.add_item("Everyone", choose_everyone)
+        to_menu.prompt()
+        if targets is None:
+            return
+        targets = [target for target in targets if target != source]
+        if len(targets) == 0:
+            print("Nobody to copy to\n")
+            return
+        front_matter = None
+        def set_front_matter(val):
+            nonlocal front_matter
+            front_matter = val
+        confirm_menu = Menu("Replace the scores and comments of %d rubric%s?"%(len(targets),\
+            '' if len(targets) == 1 else 's'), back = False)
+        confirm_menu.add_item("Cancel", lambda : None)
+        confirm_menu.add_item("Yes", set_front_matter, False)
+        if len(roster.blank_rubric.frontmatter) > 0:
+            confirm_menu.add_item("Yes, and the front matter too", set_front_matter, True)
+        confirm_menu.prompt()
+        if front_matter is None:
+            return
+        roster.clone_rubric(source, targets, front_matter)
+        print("Copied grades from %s to %d rubric%s\n"%(str(source), len(targets),\
+            '' if len(targets) == 1 else 's'))
+    main_menu.add_item("Copy Grades", clone_grades)
+
+    main_menu.add_item("Undo", undo_edit)
+    main_menu.add_item("Redo", redo_edit)
 
     #Menu items for saving and loading
     main_menu.add_item("Save", save, False)
     main_menu.add_item("Save As", save, True)
     main_menu.add_item(ChangingText("Load", "Load*", is_saved), load_with_save_prompt)
 
+    #Switch to a new version of the roster file
+    def resync_roster():
+        try:
+            fil = files_input("New roster file, or CTRL+C to cancel: ").strip()
+        except KeyboardInterrupt:
+            print("\nCanceled\n")
+            return
+        if not os.path.isfile(fil):
+            print("Error: File %s not found\n"%fil)
+            return
+        try:
+            added, removed, regrouped = roster.resync(fil)
+        except ValueError as err:
+            print("Error: %s\n"%str(err))
+            return
+        fill_entity_menus()
+        for label, entity_strs in [("Added", added), ("Removed", removed),\
+                ("Regrouped", regrouped)]:
+            for entity_str in entity_strs:
+                print("%s: %s"%(label, entity_str))
+        print("Roster resynced: %d added, %d removed, %d regrouped\n"%\
+            (len(added), len(removed), len(regrouped)))
+    main_menu.add_item("Resync Roster", resync_roster)
+
+    #Merge saves from several graders
+    def merge_saves():
+        def get_file(msg):
+            while True:
+                fil = files_input(msg, file_manager.directory).strip()
+                if fil == '' or os.path.isfile(file_manager.directory + fil):
+                    return fil
+                print("Error: File %s not found"%fil)
+        try:
+            base_file = get_file("Common ancestor save file (blank if none), "\
+                "or CTRL+C to cancel: ")
+            grader_files = []
+            while True:
+                fil = get_file("Grader save file (blank when done), "\
+                    "or CTRL+C to cancel: ")
+                if fil == '':
+                    break
+                grader_files.append(fil)
+        except KeyboardInterrupt:
+            print("\nCanceled\n")
+            return
+        if len(grader_files) == 0:
+            print("No grader saves to merge\n")
+            return
+        #Someone may still be grading in one of these
+        for fil in grader_files:
+            holder = SaveLock(file_manager.directory + fil).get_holder()
+            if holder is not None and (file_manager.lock is None or\
+                    holder != file_manager.lock.token):
+                print("Warning: %s is locked by %s; it may still be in use"%(fil, holder))
+        def format_value(value):
+            if value is None:
+                return "(blank)"
+            elif isinstance(value, str):
+                return "\"%s\""%value
+            elif isinstance(value, int):
+                return "%d"%value
+            else:
+                return "%.2f"%value
+        def resolve(entity_str, field, base_value, changes):
+            chosen = base_value
+            def choose(value):
+                nonlocal chosen
+                chosen = value
+            resolve_menu = Menu("Conflict in %s, %s:"%(entity_str,\
+                roster.describe_field(field)), back = False)
+            for i, value in changes:
+                resolve_menu.add_item("%s: %s"%(grader_files[i], format_value(value)),\
+                    choose, value)
+            resolve_menu.add_item("Common ancestor: %s"%format_value(base_value),\
+                choose, base_value)
+            resolve_menu.prompt()
+            return chosen
+        try:
+            if base_file == '':
+                base_file = None
+            else:
+                base_file = file_manager.directory + base_file
+            conflicts = roster.merge_saves(base_file,\
+                [file_manager.directory + fil for fil in grader_files], resolve)
+        except KeyboardInterrupt:
+            print("\nMerge canceled\n")
+            return
+        except KeyError:
+            print("Invalid file; failed to merge")
+            print()
+            return
+        print("Merged %d saves with %d conflicts\n"%(len(grader_files), len(conflicts)))
+        for entity_str, field, base_value, changes, value in conflicts:
+            print("%s, %s: used %s"%(entity_str, roster.describe_field(field),\
+                format_value(value)))
+        if len(conflicts) > 0:
+            print()
+        save(True)
+
+    def merge_with_save_prompt():
+        global saved
+        if not saved:
+            save_warning_menu = Menu("Overwrite unsaved changes?", back = False)
+            save_warning_menu.add_item("Cancel", lambda : None)
+            save_warning_menu.add_item("Merge and Overwrite", merge_saves)
+            save_warning_menu.prompt()
+        else:
+            merge_saves()
+    main_menu.add_item("Merge Grader Saves", merge_with_save_prompt)
+
+    #Snapshot history of the current save file
+    def get_snapshot_store():
+        fil = file_manager.files[FileManager.FILE_KEY]
+        if fil is None:
+            print("Nothing saved yet, so there are no snapshots\n")
+            return None
+        store = SnapshotStore(file_manager.directory + fil)
+        if len(store.get_names()) == 0:
+            print("No snapshots of %s yet\n"%fil)
+            return None
+        return store
+    def choose_snapshot(store, msg):
+        chosen = None
+        def choose(name):
+            nonlocal chosen
+            chosen = name
+        choose_menu = Menu(msg, menued = False)
+        for name in store.get_names():
+            choose_menu.add_item(name, choose, name)
+        choose_menu.prompt()
+        return chosen
+    def list_snapshots():
+        store = get_snapshot_store()
+        if store is None:
+            return
+        names = store.get_names()
+        for i in range(len(names)):
+            if i == 0:
+                print("%s (%d entities)"%(names[i], len(store.get_manifest(names[i]))))
+            else:
+                print("%s (%d entities changed)"%(names[i],\
+                    len(store.diff(names[i-1], names[i]))))
+        print_delay("")
+    def diff_snapshots():
+        store = get_snapshot_store()
+        if store is None:
+            return
+        old_name = choose_snapshot(store, "Select older snapshot:")
+        if old_name is None:
+            return
+        new_name = choose_snapshot(store, "Select newer snapshot:")
+        if new_name is None:
+            return
+        def format_value(value):
+            if value is None:
+                return "(blank)"
+            elif isinstance(value, bool):
+                return "attached" if value else "not attached"
+            elif isinstance(value, str):
+                return "\"%s\""%value
+            elif isinstance(value, int):
+                return "%d"%value
+            else:
+                return "%.2f"%value
+        diffs = store.diff(old_name, new_name)
+        for entity_str, entity_diffs in diffs:
+            print(entity_str)
+            for field, old_value, new_value in entity_diffs:
+                print("\t%s: %s -> %s"%(roster.describe_field(field),\
+                    format_value(old_value), format_value(new_value)))
+        if len(diffs) == 0:
+            print("No differences")
+        print_delay("")
+    def restore_snapshot(whole_roster):
+        store = get_snapshot_store()
+        if store is None:
+            return
+        name = choose_snapshot(store, "Select snapshot to restore from:")
+        if name is None:
+            return
+        if whole_roster:
+            roster.restore_snapshot(store, name)
+            print("Restored roster from %s\n"%name)
+            return
+        entity_menu = Menu("Select entity to restore:", menued = False)
+        def restore_entity(entity):
+            roster.restore_snapshot(store, name, entity)
+            print("Restored %s from %s\n"%(str(entity), name))
+        for entity in roster:
+            entity_menu.add_item(MenuEntityTextUpdater(entity), restore_entity, entity)
+        entity_menu.prompt()
+    snapshot_menu = Menu("Snapshots:", menued = False)
+    snapshot_menu.add_item("List Snapshots", list_snapshots)
+    snapshot_menu.add_item("Diff Two Snapshots", diff_snapshots)
+    snapshot_menu.add_item("Restore One Rubric", restore_snapshot, False)
+    snapshot_menu.add_item("Restore Whole Roster", restore_snapshot, True)
+    main_menu.add_item("Snapshots", snapshot_menu.prompt)
+
+    #Roster-wide statistics, from everyone's scores at once
+    def get_score_matrix():
+        if numpy is None:
+            print("Statistics and bulk grading need NumPy (pip install numpy)\n")
+            return None
+        return roster.get_index(ScoreMatrix)
+    def format_stat(value):
+        if numpy.isnan(value):
+            return "-"
+        return "%.2f"%value
+    def choose_category(matrix):
+        chosen = None
+        def choose(index):
+            nonlocal chosen
+            chosen = index
+        choose_menu = Menu("Select category:", menued = False)
+        for i in range(len(matrix.categories)):
+            choose_menu.add_item(matrix.categories[i][0], choose, i)
+        choose_menu.prompt()
+        return chosen
+    def print_summary(names, out_ofs, scores, graded):
+        stats = ScoreMatrix.get_summary(scores, graded)
+        width = max([len(name) for name in names])
+        print("%-*s %7s %7s %7s %7s %7s %7s %7s"%(width, "", "Out of", "Graded",\
+            "Mean", "Median", "Stdev", "Min", "Max"))
+        for i in range(len(names)):
+            print("%-*s %7s %7d %s"%(width, names[i], score_to_string(out_ofs[i]), stats[0][i],\
+                ' '.join(["%7s"%format_stat(stat[i]) for stat in stats[1:]])))
+        print_delay("")
+    def category_summary():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        scores, graded = matrix.get_category_scores()
+        print_summary([cat[0] for cat in matrix.categories],\
+            [cat[1] for cat in matrix.categories], scores, graded)
+    def item_summary():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        print_summary([item[1] for item in matrix.items],\
+            [item[2] for item in matrix.items], matrix.values, matrix.graded)
+    def histogram():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        index = choose_category(matrix)
+        if index is None:
+            return
+        scores, graded = matrix.get_category_scores()
+        counts, edges = ScoreMatrix.get_histogram(scores[:, index], graded[:, index],\
+            matrix.categories[index][1])
+        biggest = max(counts.max(), 1)
+        print("%s (%d graded)"%(matrix.categories[index][0], graded[:, index].sum()))
+        for i in range(len(counts)):
+            print("%7.2f - %7.2f | %s %d"%(edges[i], edges[i + 1],\
+                '#'*int(round(counts[i]*50/biggest)), counts[i]))
+        print_delay("")
+    def percentile_ranks():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        index = choose_category(matrix)
+        if index is None:
+            return
+        scores, graded = matrix.get_category_scores()
+        ranks = ScoreMatrix.get_percentile_ranks(scores[:, index], graded[:, index])
+        #Highest first, and anyone not graded last
+        order = numpy.argsort(-numpy.where(graded[:, index], scores[:, index],\
+            -numpy.inf), kind = 'stable')
+        width = max([len(str(student)) for student in matrix.students])
+        for row in order:
+            if graded[row, index]:
+                print("%-*s %7s %6.1f%%"%(width, str(matrix.students[row]),\
+                    format_stat(scores[row, index]), ranks[row]))
+            else:
+                print("%-*s (not graded)"%(width, str(matrix.students[row])))
+        print_delay("")
+    def outliers():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        scores, graded = matrix.get_category_scores()
+        medians = ScoreMatrix.get_summary(scores, graded)[2]
+        flags = ScoreMatrix.get_outliers(scores, graded)
+        rows, columns = numpy.nonzero(flags)
+        for row, column in sorted(zip(rows, columns), key = lambda cell: cell[1]):
+            print("%s: %s %s (median %s)"%(matrix.categories[column][0],\
+                str(matrix.students[row]), format_stat(scores[row, column]),\
+                format_stat(medians[column])))
+        if len(rows) == 0:
+            print("No outliers")
+        print_delay("")
+    statistics_menu = Menu("Statistics:", menued = False)
+    statistics_menu.add_item("Category Summary", category_summary)
+    statistics_menu.add_item("Item Summary", item_summary)
+    statistics_menu.add_item("Histogram", histogram)
+    statistics_menu.add_item("Percentile Ranks", percentile_ranks)
+    statistics_menu.add_item("Outliers", outliers)
+    main_menu.add_item("Statistics", statistics_menu.prompt)
+
+    #Grade changes for everyone (or everyone matching a search) at once, each
+    #undoable as one step
+    def choose_column(matrix, categories_too = False):
+        chosen = None
+        def choose(columns, is_category):
+            nonlocal chosen
+            chosen = (columns, is_category)
+        choose_menu = Menu("Select item:", menued = False)
+        if categories_too:
+            for i in range(len(matrix.categories)):
+                choose_menu.add_item("[%s]"%matrix.categories[i][0], choose,\
+                    matrix.get_category_columns(i), True)
+        labels = matrix.get_column_labels()
+        for column in range(len(labels)):
+            choose_menu.add_item(labels[column], choose, [column], False)
+        choose_menu.prompt()
+        return chosen
+    def input_number(msg):
+        try:
+            return float(input(msg))
+        except ValueError:
+            print("Not a number\n")
+        except KeyboardInterrupt:
+            print()
+        return None
+    #Who bulk grading is for: everyone, or whoever matches a search
+    bulk_query = None
+    def get_bulk_rows(matrix):
+        if bulk_query is None:
+            return None
+        return matrix.get_rows(roster.select_students(bulk_query))
+    def set_bulk_query():
+        global bulk_query
+        try:
+            bulk_query = input_query(roster.blank_rubric,\
+                "Search (? for help, blank for everyone): ")
+        except KeyboardInterrupt:
+            print()
+    def report_bulk_change(changed):
+        print("Changed %d item%s\n"%(changed, '' if changed == 1 else 's'))
+    def bulk_set_score():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        chosen = choose_column(matrix)
+        if chosen is None:
+            return
+        score = input_number("Score to give: ")
+        if score is not None:
+            report_bulk_change(matrix.change_scores(chosen[0], ScoreMatrix.set_to(score),\
+                get_bulk_rows(matrix)))
+    def bulk_add_points():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        chosen = choose_column(matrix, categories_too = True)
+        if chosen is None:
+            return
+        if chosen[1]:
+            msg = "Points to add (split among its items, negative to take away): "
+        else:
+            msg = "Points to add (negative to take away): "
+        points = input_number(msg)
+        if points is not None:
+            report_bulk_change(matrix.change_scores(chosen[0],\
+                ScoreMatrix.add_points(points, spread = chosen[1]), get_bulk_rows(matrix)))
+    def bulk_scale_points():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        chosen = choose_column(matrix, categories_too = True)
+        if chosen is None:
+            return
+        factor = input_number("Multiply scores by: ")
+        if factor is not None:
+            report_bulk_change(matrix.change_scores(chosen[0],\
+                ScoreMatrix.scale_points(factor), get_bulk_rows(matrix)))
+    def bulk_fill_blanks(score):
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        report_bulk_change(matrix.change_scores(range(len(matrix.items)),\
+            ScoreMatrix.fill_blanks(score), get_bulk_rows(matrix)))
+    def bulk_set_comment():
+        matrix = get_score_matrix()
+        if matrix is None:
+            return
+        chosen = choose_column(matrix)
+        if chosen is None:
+            return
+        column = chosen[0][0]
+        #Start from a comment someone already has
+        seed = ""
+        for item in matrix.column_items[column]:
+            if item.get_comment() != "":
+                seed = item.get_comment()
+                break
+        try:
+            comment = seeded_input("Comment to give: ", seed)
+        except KeyboardInterrupt:
+            print()
+            return
+        report_bulk_change(matrix.set_comments(column, comment, get_bulk_rows(matrix)))
+    bulk_menu = Menu("Bulk Grade (all at once):", menued = False)
+    bulk_menu.add_item(ChangingText("Who: Everyone", lambda : "Who: Matching %s"%bulk_query,\
+        lambda : bulk_query is None), set_bulk_query)
+    bulk_menu.add_item("Set a Score", bulk_set_score)
+    bulk_menu.add_item("Add Points (Curve)", bulk_add_points)
+    bulk_menu.add_item("Scale Points (Curve)", bulk_scale_points)
+    bulk_menu.add_item("Fill Blanks with Full Marks", bulk_fill_blanks, None)
+    bulk_menu.add_item("Fill Blanks with Zero", bulk_fill_blanks, 0)
+    bulk_menu.add_item("Set a Comment", bulk_set_comment)
+    main_menu.add_item("Bulk Grade", bulk_menu.prompt)
+
     #Export CSV
     def export_csv(save_as):
         try:
@@ -2389,17 +6617,20 @@ if __name__ == '__main__':
     pdf_menu.add_item("Cancel", lambda : None)
     pdf_flag_list = ["Completed", "In Progress", "All"]
     pdf_save_as = False
-    def export_pdf(flag):
+    #If students is given, only those students' PDFs are written
+    def export_pdf(flag, students = None):
+        only = students
         try:
-            fil = file_manager.get_pdf_prefix(roster.get_ok_students(only_finished =\
-                flag == pdf_flag_list[0], all = flag == pdf_flag_list[-1]),\
-                pdf_save_as)
+            if students is None:
+                students = roster.get_ok_students(only_finished =\
+                    flag == pdf_flag_list[0], all = flag == pdf_flag_list[-1])
+            fil = file_manager.get_pdf_prefix(students, pdf_save_as)
         except KeyboardInterrupt:
             fil = None
         if fil is not None:
             try:
                 roster.export_pdfs(fil, only_finished = flag == pdf_flag_list[0],\
-                    all = flag == pdf_flag_list[-1], verbose = verbose)
+                    all = flag == pdf_flag_list[-1], verbose = verbose, students = only)
             except Exception as e:
                 print("Fatal error occurred; not all PDFs written")
                 print("Exception: ")
@@ -2407,6 +6638,20 @@ if __name__ == '__main__':
                 print()
     for flag in pdf_flag_list:
         pdf_menu.add_item(flag, export_pdf, flag)
+    def export_pdf_matching():
+        try:
+            query = input_query(roster.blank_rubric)
+        except KeyboardInterrupt:
+            print()
+            return
+        if query is None:
+            return
+        students = roster.select_students(query)
+        if len(students) == 0:
+            print("Nobody matches %s\n"%query)
+            return
+        export_pdf(None, students)
+    pdf_menu.add_item("Matching a search", export_pdf_matching)
     def prompt_pdf(save_as):
         global pdf_save_as
         pdf_save_as = save_as
@@ -2444,6 +6689,8 @@ if __name__ == '__main__':
                 email_config_file = None
                 if isinstance(val, str):
                     email_mode = val
+                else:
+                    email_mode = None
         def get_out_here():
             raise EmailManagerCanceled("canceled")
         manager_setup_menu.add_item("Back", get_out_here)
@@ -2454,6 +6701,12 @@ if __name__ == '__main__':
             'Gmail')
         manager_setup_menu.add_item("Manual Microsoft", set_email_config_file,\
             'Microsoft')
+        manager_setup_menu.add_item("Write to Maildir", set_email_config_file,\
+            EmailManager.maildir_mode)
+        manager_setup_menu.add_item("Write .eml files", set_email_config_file,\
+            EmailManager.eml_mode)
+        manager_setup_menu.add_item("Pipe to local sendmail", set_email_config_file,\
+            EmailManager.sendmail_mode)
         manager_setup_menu.add_item("Use Dummy (for testing)", set_email_config_file,\
             EmailManager.dummy_mode)
         #Supports email
@@ -2461,7 +6714,8 @@ if __name__ == '__main__':
             global email_manager
             global email_config_file
             try:
-                if email_manager is None or email_manager.is_dummy():
+                if email_manager is None or email_manager.is_dummy() or\
+                        email_manager.is_local():
                     while True:
                         manager_setup_menu.prompt()
                         if email_config_file != 0:
@@ -2469,7 +6723,8 @@ if __name__ == '__main__':
                         else:
                             email_config_file = None
                     email_manager = EmailManager(from_file = email_config_file,\
-                        verbose = verbose, special_mode = email_mode)
+                        verbose = verbose, special_mode = email_mode,\
+                        copy_to_sent = copy_to_sent)
                 try:
                     prefix = file_manager.get_open_pdf_prefix()
                     roster.email_students(prefix, email_manager)
@@ -2482,6 +6737,23 @@ if __name__ == '__main__':
             except KeyboardInterrupt:
                 print("\nEmail Setup Canceled")
         main_menu.add_item("Email PDFs", email_students)
+        def email_outbox_status():
+            try:
+                prefix = file_manager.get_open_pdf_prefix()
+            except KeyboardInterrupt:
+                print("\nCanceled\n")
+                return
+            if prefix is None:
+                return
+            outbox = Outbox(prefix + OUTBOX_EXTENSION)
+            outbox.print_status()
+            outbox_menu = Menu("Select option:", menued = False)
+            outbox_menu.add_item("Queue failed messages to send again",\
+                outbox.requeue_failed)
+            outbox_menu.add_item("Forget sent messages",\
+                outbox.clear_sent)
+            outbox_menu.prompt()
+        main_menu.add_item("Email Outbox Status", email_outbox_status)
 
     menu_manager.add_menu(main_menu)
     try: